@@ -153,6 +153,9 @@ if [ -z "${DRY_RUN}" ]; then
   done
 fi
 
+# The dispatcher sending the emails of the outbox runs outside of the service.
+"$(dirname "$0")/send_outbox.sh"
+
 echo -e "\033[32mServer Deployed!\033[0m"
 
 
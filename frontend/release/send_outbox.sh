@@ -0,0 +1,32 @@
+#!/bin/bash
+# Restart the dispatcher sending the emails of the outbox, see
+# frontend/server/asynchronous/send_outbox.py.
+#
+# It runs forever with the latest version of the frontend-flask task
+# definition: run this script after each deployment of the server, deploy.sh
+# does it.
+
+set -e
+
+readonly STARTED_BY="send-outbox"
+
+echo -e "\033[32mStopping the previous outbox dispatchers…\033[0m"
+for task in $(aws ecs list-tasks --started-by "${STARTED_BY}" --desired-status RUNNING \
+    --query 'taskArns[]' --output text); do
+  if [ -z "${DRY_RUN}" ]; then
+    aws ecs stop-task --task "${task}" --reason "Restarting the outbox dispatcher" > /dev/null
+  fi
+done
+
+echo -e "\033[32mStarting the outbox dispatcher…\033[0m"
+if [ -z "${DRY_RUN}" ]; then
+  aws ecs run-task \
+    --task-definition frontend-flask \
+    --started-by "${STARTED_BY}" \
+    --overrides '{
+      "containerOverrides": [{
+        "name": "flask",
+        "command": ["python", "bob_emploi/frontend/asynchronous/send_outbox.py"]
+      }]
+    }' > /dev/null
+fi
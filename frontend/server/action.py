@@ -16,7 +16,8 @@ from bob_emploi.frontend.api import user_pb2
 _ANY_COMPANY_REGEXP = re.compile('^(.*) une entreprise')
 
 
-def instantiate(action, user_proto, project, template, database, for_email=False):
+def instantiate(
+        action, user_proto, project, template, database, for_email=False, scoring_project=None):
     """Instantiate a newly created action from a template.
 
     Args:
@@ -26,6 +27,8 @@ def instantiate(action, user_proto, project, template, database, for_email=False
         template: the action template to instantiate.
         database: a MongoDB client to get stats and info.
         for_email: whether the action is to be sent in an email.
+        scoring_project: the ScoringProject for this project if the caller
+            has one already, so that its cached data is reused.
     Returns:
         the populated action for chaining.
     """
@@ -39,8 +42,9 @@ def instantiate(action, user_proto, project, template, database, for_email=False
     action.title_feminine = template.title_feminine
     action.short_description = template.short_description
     action.short_description_feminine = template.short_description_feminine
-    scoring_project = scoring.ScoringProject(
-        project, user_proto.profile, user_proto.features_enabled, database)
+    if not scoring_project:
+        scoring_project = scoring.ScoringProject(
+            project, user_proto.profile, user_proto.features_enabled, database)
     action.link = scoring_project.populate_template(template.link)
     action.how_to = template.how_to
     action.status = action_pb2.ACTION_UNREAD
@@ -3,14 +3,24 @@
 See http://go/bob:advisor-design.
 """
 import collections
+from concurrent import futures
+import contextlib
 import logging
 import os
+import random
+import threading
+import time
 
-import mailjet_rest
+try:
+    import flask
+except ImportError:
+    flask = None
+from google.protobuf import json_format
+from pymongo import monitoring
 
 from bob_emploi.frontend import french
-from bob_emploi.frontend import mail
 from bob_emploi.frontend import now
+from bob_emploi.frontend import outbox
 from bob_emploi.frontend import proto
 from bob_emploi.frontend import scoring
 from bob_emploi.frontend.api import action_pb2
@@ -22,45 +32,180 @@ _ScoredAdvice = collections.namedtuple('ScoredAdvice', ['advice', 'score'])
 
 _EMAIL_ACTIVATION_ENABLED = not os.getenv('DEBUG', '')
 
+# Pool of workers to compute advice for batches of users.
+_BATCH_EXECUTOR = futures.ThreadPoolExecutor(max_workers=4)
 
-def maybe_advise(user, project, database, base_url='http://localhost:3000'):
+# Maximum number of users computed together in a batch: users sharing the same
+# market data are split in chunks of this size, so that results keep flowing.
+_BATCH_CHUNK_SIZE = 50
+
+# Same as the ticks of the server, to time the scoring models in requests.
+_Tick = collections.namedtuple('Tick', ['name', 'time'])
+
+# Scoring models that take longer than this number of seconds are logged, but
+# only for a sample of them.
+_SLOW_MODEL_SECONDS = .2
+_SLOW_MODEL_LOG_RATE = .1
+
+# Calls, time in seconds, DB calls and errors of each scoring model in this
+# process, see get_model_stats.
+_MODEL_STATS = collections.defaultdict(collections.Counter)
+_MODEL_STATS_LOCK = threading.Lock()
+
+# The stats of the scoring model that is running in each thread, if any.
+_CURRENT_MODEL = threading.local()
+
+
+class ModelCommandListener(monitoring.CommandListener):
+    """Count the MongoDB commands run by the scoring models.
+
+    Register it in the event_listeners of the MongoClient used by the advisor.
+    """
+
+    def started(self, event):
+        stats = getattr(_CURRENT_MODEL, 'stats', None)
+        if stats is not None:
+            stats['db_calls'] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def get_model_stats():
+    """Get the stats of each scoring model since the start of the process.
+
+    Returns:
+        a dict of stats keyed by scoring model names. Each of them is a dict
+        with the number of calls, the time in seconds spent in the model, the
+        number of DB calls that it made, and the number of errors it raised.
+    """
+    with _MODEL_STATS_LOCK:
+        return {
+            name: {key: stats[key] for key in ('calls', 'seconds', 'db_calls', 'errors')}
+            for name, stats in _MODEL_STATS.items()}
+
+
+@contextlib.contextmanager
+def _measure_model(model_name, scoring_project):
+    stats = collections.Counter(calls=1)
+    previous_stats = getattr(_CURRENT_MODEL, 'stats', None)
+    _CURRENT_MODEL.stats = stats
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        stats['errors'] += 1
+        raise
+    finally:
+        end = time.time()
+        _CURRENT_MODEL.stats = previous_stats
+        stats['seconds'] = end - start
+        with _MODEL_STATS_LOCK:
+            _MODEL_STATS[model_name].update(stats)
+        if flask and flask.has_request_context() and hasattr(flask.g, 'ticks'):
+            flask.g.ticks.append(_Tick('Model {}'.format(model_name), end))
+            if not hasattr(flask.g, 'scoring_models'):
+                flask.g.scoring_models = collections.defaultdict(collections.Counter)
+            flask.g.scoring_models[model_name].update(stats)
+        if stats['seconds'] > _SLOW_MODEL_SECONDS and random.random() < _SLOW_MODEL_LOG_RATE:
+            logging.warning(
+                'Slow scoring model "%s": %.3f seconds, %d DB calls for:\n%s\n%s\n%s',
+                model_name, stats['seconds'], stats['db_calls'],
+                json_format.MessageToJson(scoring_project.user_profile),
+                json_format.MessageToJson(scoring_project.features_enabled),
+                json_format.MessageToJson(scoring_project.details))
+
+
+def maybe_advise(
+        user, project, database, base_url='http://localhost:3000', scoring_project=None,
+        send_email=True):
     """Check if a project needs advice and populate all advice fields if not.
 
     Args:
         user: the full user info.
         project: the project to advise. This proto will be modified.
+        scoring_project: an optional ScoringProject for this project, e.g. one
+            returned by prefetch_scoring_projects.
+        send_email: whether to send the activation email when the project gets
+            advised. If False, the caller should call send_activation_email
+            itself, e.g. once the project is saved.
+    Returns:
+        whether the project got advised.
     """
-    if project.is_incomplete:
-        return
-    if _maybe_recommend_advice(user, project, database) and project.advices:
-        try:
-            _send_activation_email(user, project, database, base_url)
-        except mailjet_rest.client.ApiError as error:
-            logging.warning('Could not send the activation email: %s', error)
+    if not _needs_advice(user, project):
+        return False
+    _recommend_advice(user, project, database, scoring_project)
+    if not project.advices:
+        return False
+    if send_email:
+        send_activation_email(user, project, database, base_url)
+    return True
 
 
-def _maybe_recommend_advice(user, project, database):
-    if user.features_enabled.advisor != user_pb2.ACTIVE or project.advices:
-        return False
-    advices = compute_advices_for_project(user, project, database)
+def _needs_advice(user, project):
+    return not project.is_incomplete and \
+        user.features_enabled.advisor == user_pb2.ACTIVE and not project.advices
+
+
+def _recommend_advice(user, project, database, scoring_project):
+    advices = compute_advices_for_project(user, project, database, scoring_project)
     for piece_of_advice in advices.advices:
         piece_of_advice.status = project_pb2.ADVICE_RECOMMENDED
     project.advices.extend(advices.advices[:])
-    return True
 
 
-def compute_advices_for_project(user, project, database):
+def prefetch_scoring_projects(user, database):
+    """Prepare the scoring of all the user's projects that need advice.
+
+    The market data needed by the scoring models is fetched at once for all
+    those projects.
+
+    Returns:
+        a list with a ScoringProject for each of the user's projects, or None
+        if the project does not need any advice.
+    """
+    scoring_projects = [
+        scoring.ScoringProject(
+            project, user.profile, user.features_enabled, database, now=now.get())
+        if _needs_advice(user, project) else None
+        for project in user.projects]
+    _prefetch(user, [p for p in scoring_projects if p], database)
+    return scoring_projects
+
+
+def _prefetch(user, scoring_projects, database):
+    # Scoring models that call slow partners' APIs have a prefetch method:
+    # start those calls first, so that they run while we get the market data.
+    for module in _advice_modules(database):
+        if not module.is_ready_for_prod and not user.features_enabled.alpha:
+            continue
+        scoring_model = scoring.get_scoring_model(module.trigger_scoring_model)
+        if not hasattr(scoring_model, 'prefetch'):
+            continue
+        for scoring_project in scoring_projects:
+            scoring_model.prefetch(scoring_project)
+    scoring.prefetch(scoring_projects)
+
+
+def compute_advices_for_project(user, project, database, scoring_project=None):
     """Advise on a user project.
 
     Args:
         user: the user's data, mainly used for their profile and features_enabled.
         project: the project data. It will not be modified.
         database: access to the MongoDB with market data.
+        scoring_project: an optional ScoringProject for this project, if
+            missing one is created and its market data prefetched.
     Returns:
         an Advices protobuffer containing a list of recommendations.
     """
-    scoring_project = scoring.ScoringProject(
-        project, user.profile, user.features_enabled, database, now=now.get())
+    if not scoring_project:
+        scoring_project = scoring.ScoringProject(
+            project, user.profile, user.features_enabled, database, now=now.get())
+        _prefetch(user, [scoring_project], database)
     scores = {}
     advice_modules = _advice_modules(database)
     advice = project_pb2.Advices()
@@ -77,7 +222,8 @@ def compute_advices_for_project(user, project, database):
             scores[module.advice_id] = 3
         else:
             try:
-                scores[module.advice_id] = scoring_model.score(scoring_project)
+                with _measure_model(module.trigger_scoring_model, scoring_project):
+                    scores[module.advice_id] = scoring_model.score(scoring_project)
             except Exception:  # pylint: disable=broad-except
                 logging.exception(
                     'Scoring "%s" crashed for:\n%s\n%s',
@@ -101,12 +247,66 @@ def compute_advices_for_project(user, project, database):
 
         incompatible_modules.update(module.incompatible_advice_ids)
 
-        _compute_extra_data(piece_of_advice, module, scoring_project)
-        _maybe_override_advice_data(piece_of_advice, module, scoring_project)
+        with _measure_model(module.trigger_scoring_model, scoring_project):
+            _compute_extra_data(piece_of_advice, module, scoring_project)
+            _maybe_override_advice_data(piece_of_advice, module, scoring_project)
 
     return advice
 
 
+def compute_advices_for_users(users, database):
+    """Advise on the first project of many users.
+
+    Users are grouped by target job group and département, so that the
+    market data of a group is fetched once and shared by all its projects,
+    and groups are computed concurrently on a bounded pool of workers.
+
+    Args:
+        users: a list of users' data, each of them with at least one project.
+        database: access to the MongoDB with market data.
+    Yields:
+        a tuple with the index of the user in the list and the Advices for
+        their first project, as soon as they are computed, so not in order.
+    """
+    groups = collections.defaultdict(list)
+    for index, user in enumerate(users):
+        project = user.projects[0]
+        groups[project.target_job.job_group.rome_id,
+               project.mobility.city.departement_id].append(index)
+
+    pending_groups = [
+        _BATCH_EXECUTOR.submit(
+            _compute_advices_for_group, users, indices[start:start + _BATCH_CHUNK_SIZE],
+            database)
+        for indices in groups.values()
+        for start in range(0, len(indices), _BATCH_CHUNK_SIZE)]
+    try:
+        for pending_group in futures.as_completed(pending_groups):
+            for index_and_advices in pending_group.result():
+                yield index_and_advices
+    finally:
+        # Do not compute the remaining groups if the caller stops early.
+        for pending_group in pending_groups:
+            pending_group.cancel()
+
+
+def _compute_advices_for_group(users, indices, database):
+    scoring_projects = [
+        scoring.ScoringProject(
+            users[index].projects[0], users[index].profile, users[index].features_enabled,
+            database, now=now.get())
+        for index in indices]
+    # Prefetch for the modules in alpha as well if any user needs them.
+    prefetch_user = next(
+        (users[index] for index in indices if users[index].features_enabled.alpha),
+        users[indices[0]])
+    _prefetch(prefetch_user, scoring_projects, database)
+    return [
+        (index, compute_advices_for_project(
+            users[index], users[index].projects[0], database, scoring_project))
+        for index, scoring_project in zip(indices, scoring_projects)]
+
+
 def _compute_extra_data(piece_of_advice, module, scoring_project):
     if not module.extra_data_field_name:
         return
@@ -144,7 +344,7 @@ def _maybe_override_advice_data(piece_of_advice, module, scoring_project):
     piece_of_advice.MergeFrom(override_data)
 
 
-def _send_activation_email(user, project, database, base_url):
+def send_activation_email(user, project, database, base_url):
     """Send an email to the user just after we have defined their diagnosis."""
     advice_modules = {a.advice_id: a for a in _advice_modules(database)}
     advices = [a for a in project.advices if a.advice_id in advice_modules]
@@ -164,12 +364,10 @@ def _send_activation_email(user, project, database, base_url):
             for a in advices
         ],
     }
-    response = mail.send_template(
+    outbox.enqueue(
+        database, 'activation:{}:{}'.format(user.user_id, project.project_id),
         # https://app.mailjet.com/template/168827/build
         '168827', user.profile, data, dry_run=not _EMAIL_ACTIVATION_ENABLED)
-    if response.status_code != 200:
-        logging.warning(
-            'Error while sending diagnostic email: %s\n%s', response.status_code, response.text)
 
 
 def _get_job_name(job, gender):
@@ -195,7 +393,7 @@ def list_all_tips(user, project, piece_of_advice, database, cache=None, filter_t
     Returns:
         An iterable of tips for this module.
     """
-    if not cache:
+    if cache is None:
         cache = {}
 
     try:
@@ -208,11 +406,13 @@ def list_all_tips(user, project, piece_of_advice, database, cache=None, filter_t
 
     # Get tip templates.
     all_tip_templates = _tip_templates(database)
-    tip_templates = filter(None, (all_tip_templates.get(t) for t in module.tip_template_ids))
+    tip_template_ids = module.tip_template_ids
 
     # Additional filter from caller.
     if filter_tip:
-        tip_templates = filter(filter_tip, tip_templates)
+        tip_template_ids = [
+            t for t in tip_template_ids
+            if t in all_tip_templates and filter_tip(all_tip_templates[t])]
 
     # Filter tips.
     scoring_project = cache.get('scoring_project')
@@ -220,10 +420,7 @@ def list_all_tips(user, project, piece_of_advice, database, cache=None, filter_t
         scoring_project = scoring.ScoringProject(
             project, user.profile, user.features_enabled, database, now=now.get())
         cache['scoring_project'] = scoring_project
-    filtered_tips = scoring.filter_using_score(
-        tip_templates, lambda t: t.filters, scoring_project)
-
-    return filtered_tips
+    return all_tip_templates.index.filter(scoring_project, tip_template_ids)
 
 
 # Cache (from MongoDB) of known advice module.
@@ -253,7 +450,8 @@ def _easy_advice_modules(database):
 
 
 # Cache (from MongoDB) of known tip templates.
-_TIP_TEMPLATES = proto.MongoCachedCollection(action_pb2.ActionTemplate, 'tip_templates')
+_TIP_TEMPLATES = proto.MongoCachedCollection(
+    action_pb2.ActionTemplate, 'tip_templates', index_func=scoring.FilterIndex)
 
 
 def _tip_templates(database):
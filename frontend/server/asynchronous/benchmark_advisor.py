@@ -0,0 +1,338 @@
+"""Script to benchmark the advisor by replaying the use cases of some pools.
+
+For each use case, it replays what the client requests when it shows the
+advice to a user: the advice computation, then the tips and the expanded card
+data of each piece of advice. It reports the throughput, the latencies, and
+the time and number of DB calls spent in each scoring model, as measured by the
+advisor (see advisor.get_model_stats).
+
+Run it against a local MongoDB with the market data and some pools:
+    python bob_emploi/frontend/asynchronous/benchmark_advisor.py 2017-10-01 \
+        --output benchmark.json
+
+or against a JSON fixture with the documents of each collection, loaded in
+mongomock, which does not report its DB calls:
+    python bob_emploi/frontend/asynchronous/benchmark_advisor.py 2017-10-01 \
+        --fixture fixture.json --baseline benchmark.json
+
+When a baseline report is given, the script exits with an error if the
+performance regressed compared to it.
+"""
+import argparse
+import collections
+import contextlib
+import json
+import math
+import os
+import sys
+import time
+
+import pymongo
+from pymongo import monitoring
+try:
+    import mongomock
+except ImportError:
+    # mongomock is only needed to load fixtures.
+    mongomock = None
+
+from bob_emploi.frontend import action
+from bob_emploi.frontend import advisor
+from bob_emploi.frontend import now
+from bob_emploi.frontend import proto
+from bob_emploi.frontend import scoring
+from bob_emploi.frontend.api import action_pb2
+from bob_emploi.frontend.api import use_case_pb2
+
+# Steps replayed for each use case, in the order of the client's requests.
+_ADVICES = 'advices'
+_TIPS = 'tips'
+_EXPANDED_CARD = 'expandedCard'
+_TOTAL = 'total'
+
+# Variations of latencies below this number of seconds are considered noise.
+_MIN_SIGNIFICANT_SECONDS = .001
+
+
+class _CommandCounter(monitoring.CommandListener):
+    """Count the MongoDB commands run by each step of the replay."""
+
+    def __init__(self):
+        # Name of the step running.
+        self.current = None
+        self.db_calls = collections.defaultdict(int)
+
+    @contextlib.contextmanager
+    def count(self, name):
+        """Count the MongoDB commands run in a block of code."""
+        self.current = name
+        try:
+            yield
+        finally:
+            self.current = None
+
+    def started(self, event):
+        if self.current:
+            self.db_calls[self.current] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def _get_model_stats_since(previous_model_stats):
+    """Get the stats of each scoring model since some previous stats of the advisor."""
+    model_stats = {}
+    for name, stats in advisor.get_model_stats().items():
+        previous_stats = previous_model_stats.get(name, {})
+        if stats['calls'] == previous_stats.get('calls', 0):
+            continue
+        model_stats[name] = {
+            key: value - previous_stats.get(key, 0) for key, value in stats.items()}
+    return model_stats
+
+
+def _load_use_cases(database, pool_names):
+    use_case_dicts = database.use_case.find({'poolName': {'$in': pool_names}})\
+        .sort([('poolName', 1), ('indexInPool', 1)])
+    for use_case_dict in use_case_dicts:
+        use_case = use_case_pb2.UseCase()
+        use_case.use_case_id = use_case_dict.pop('_id')
+        proto.parse_from_mongo(use_case_dict, use_case)
+        if use_case.user_data.projects:
+            yield use_case
+
+
+def _replay(user, database, command_counter):
+    """Replay the requests for a user and return the latency of each step."""
+    project = user.projects[0]
+    latencies = {}
+
+    start = time.perf_counter()
+    with command_counter.count(_ADVICES):
+        advices = advisor.compute_advices_for_project(user, project, database)
+    latencies[_ADVICES] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with command_counter.count(_TIPS):
+        for piece_of_advice in advices.advices:
+            cache = {}
+            tip_templates = advisor.list_all_tips(
+                user, project, piece_of_advice, database, cache=cache)
+            for tip_template in tip_templates:
+                action.instantiate(
+                    action_pb2.Action(), user, project, tip_template, database,
+                    scoring_project=cache.get('scoring_project'))
+    latencies[_TIPS] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with command_counter.count(_EXPANDED_CARD):
+        for piece_of_advice in advices.advices:
+            module = advisor.get_advice_module(piece_of_advice.advice_id, database)
+            model = scoring.get_scoring_model(module.trigger_scoring_model)
+            if not hasattr(model, 'get_expanded_card_data'):
+                continue
+            model.get_expanded_card_data(scoring.ScoringProject(
+                project, user.profile, user.features_enabled, database, now=now.get()))
+    latencies[_EXPANDED_CARD] = time.perf_counter() - start
+
+    latencies[_TOTAL] = sum(latencies.values())
+    return latencies
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    rank = max(int(math.ceil(percent / 100 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def run(database, pool_names, warmup=1, command_counter=None):
+    """Replay the use cases of some pools and measure the advisor's performance.
+
+    Args:
+        database: a MongoDB database with the use cases and the market data.
+        pool_names: the names of the pools of use cases to replay.
+        warmup: the number of use cases to replay once before measuring, to
+            fill the caches that are loaded once per process.
+        command_counter: the _CommandCounter registered in the event listeners
+            of the MongoDB client, if any, to report the DB calls of each step.
+    Returns:
+        a JSON serializable report.
+    """
+    use_cases = list(_load_use_cases(database, pool_names))
+    counter = command_counter or _CommandCounter()
+    latencies = collections.defaultdict(list)
+    for use_case in use_cases[:warmup]:
+        _replay(use_case.user_data, database, counter)
+    counter.db_calls.clear()
+    previous_model_stats = advisor.get_model_stats()
+
+    start = time.perf_counter()
+    for use_case in use_cases:
+        use_case_latencies = _replay(use_case.user_data, database, counter)
+        for step, latency in use_case_latencies.items():
+            latencies[step].append(latency)
+    total_seconds = time.perf_counter() - start
+    model_stats = _get_model_stats_since(previous_model_stats)
+
+    num_use_cases = len(use_cases)
+    steps = (_ADVICES, _TIPS, _EXPANDED_CARD)
+    report = {
+        'useCases': num_use_cases,
+        'seconds': total_seconds,
+        'useCasesPerSecond': num_use_cases / total_seconds if total_seconds else 0,
+        'latencies': {
+            step: {
+                'p{:d}'.format(percent): _percentile(sorted(latencies[step]), percent)
+                for percent in (50, 95, 99)
+            }
+            for step in steps + (_TOTAL,)
+        },
+        # Time spent in the scoring models run by the advisor.
+        'models': {
+            name: {
+                'calls': stats['calls'],
+                'seconds': stats['seconds'],
+                'dbCalls': stats['db_calls'],
+            }
+            for name, stats in model_stats.items()
+        },
+    }
+    if command_counter:
+        # DB calls of each step, including the ones of the scoring models.
+        report['dbCalls'] = {step: counter.db_calls[step] for step in steps}
+    return report
+
+
+def compare_to_baseline(report, baseline, tolerance=.2):
+    """List the performance regressions of a report compared to a baseline.
+
+    Args:
+        report: a report returned by run.
+        baseline: a report of a previous run on the same use cases.
+        tolerance: the relative increase of time that is not considered as a
+            regression, to absorb the noise of measures.
+    Returns:
+        a list of human readable regressions, empty if there is none.
+    """
+    regressions = []
+
+    def _check_seconds(name, seconds, baseline_seconds):
+        if seconds > baseline_seconds * (1 + tolerance) and \
+                seconds - baseline_seconds > _MIN_SIGNIFICANT_SECONDS:
+            regressions.append('{}: {:.1f}ms instead of {:.1f}ms'.format(
+                name, seconds * 1000, baseline_seconds * 1000))
+
+    def _check_db_calls(name, db_calls, baseline_db_calls):
+        if db_calls > baseline_db_calls:
+            regressions.append('{}: {:.2f} DB calls per use case instead of {:.2f}'.format(
+                name, db_calls, baseline_db_calls))
+
+    num_use_cases = report['useCases'] or 1
+    baseline_num_use_cases = baseline['useCases'] or 1
+
+    for step, percentiles in sorted(report['latencies'].items()):
+        for percentile, seconds in sorted(percentiles.items()):
+            baseline_seconds = baseline['latencies'].get(step, {}).get(percentile)
+            if baseline_seconds is not None:
+                _check_seconds('{} {}'.format(step, percentile), seconds, baseline_seconds)
+
+    baseline_db_calls = baseline.get('dbCalls', {})
+    for step, db_calls in sorted(report.get('dbCalls', {}).items()):
+        if step in baseline_db_calls:
+            _check_db_calls(
+                step, db_calls / num_use_cases,
+                baseline_db_calls[step] / baseline_num_use_cases)
+
+    for name, model_stats in sorted(report['models'].items()):
+        baseline_stats = baseline['models'].get(name)
+        if not baseline_stats:
+            continue
+        _check_seconds(
+            name, model_stats['seconds'] / model_stats['calls'],
+            baseline_stats['seconds'] / baseline_stats['calls'])
+        _check_db_calls(
+            name, model_stats['dbCalls'] / num_use_cases,
+            baseline_stats['dbCalls'] / baseline_num_use_cases)
+
+    return regressions
+
+
+def _print_report(report, out):
+    out.write('{useCases:d} use cases in {seconds:.2f}s: {useCasesPerSecond:.1f}/s\n'.format(
+        **report))
+    for step, percentiles in sorted(report['latencies'].items()):
+        out.write('{:<14} p50 {p50:8.1f}ms  p95 {p95:8.1f}ms  p99 {p99:8.1f}ms\n'.format(
+            step, **{key: seconds * 1000 for key, seconds in percentiles.items()}))
+    models = sorted(report['models'].items(), key=lambda item: -item[1]['seconds'])
+    for name, model_stats in models:
+        out.write('{:<40} {calls:6d} calls {:8.1f}ms {dbCalls:6d} DB calls\n'.format(
+            name, model_stats['seconds'] * 1000, **model_stats))
+
+
+def _load_fixture(fixture_filename):
+    database = mongomock.MongoClient().get_database('benchmark')
+    with open(fixture_filename) as fixture_file:
+        for collection_name, documents in json.load(fixture_file).items():
+            if documents:
+                database.get_collection(collection_name).insert_many(documents)
+    return database
+
+
+def main(string_args=None, out=sys.stdout):
+    """Parse command line arguments and run the benchmark."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the advisor on use cases.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('pools', nargs='+', help='Names of the pools of use cases to replay.')
+    parser.add_argument(
+        '--mongo-url', default=os.getenv('MONGO_URL', 'mongodb://localhost/test'),
+        help='URL of the MongoDB with the use cases and the market data.')
+    parser.add_argument(
+        '--fixture', help='Path to a JSON file with the documents of each collection, to use '
+        'instead of MongoDB.')
+    parser.add_argument(
+        '--warmup', type=int, default=1,
+        help='Number of use cases to replay before measuring.')
+    parser.add_argument('--output', help='Path to a file to save the report as JSON.')
+    parser.add_argument('--baseline', help='Path to a report to compare against.')
+    parser.add_argument(
+        '--tolerance', type=float, default=.2,
+        help='Relative increase of time that is not considered as a regression.')
+    args = parser.parse_args(string_args)
+
+    if args.fixture:
+        if not mongomock:
+            parser.error('mongomock is needed to load a fixture.')
+        database = _load_fixture(args.fixture)
+        # mongomock does not run any command.
+        command_counter = None
+    else:
+        command_counter = _CommandCounter()
+        database = pymongo.MongoClient(
+            args.mongo_url,
+            event_listeners=[advisor.ModelCommandListener(), command_counter],
+        ).get_default_database()
+
+    report = run(database, args.pools, warmup=args.warmup, command_counter=command_counter)
+    _print_report(report, out)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_to_baseline(report, baseline, tolerance=args.tolerance)
+        if regressions:
+            out.write('Performance regressions:\n{}\n'.format('\n'.join(regressions)))
+            return 1
+        out.write('No performance regression.\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,8 +8,8 @@ from urllib import parse
 
 from google.protobuf import json_format
 import pymongo
-import requests
 
+from bob_emploi.frontend import http_client
 from bob_emploi.frontend import privacy
 
 _DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
@@ -46,7 +46,7 @@ def main(pool_name=_YESTERDAY, users_json_filters=None, limit=20):
             _DB.use_case.replace_one({'_id': use_case['_id']}, use_case)
 
     if _SLACK_CREATE_POOL_URL:
-        requests.post(_SLACK_CREATE_POOL_URL, json={
+        http_client.post(_SLACK_CREATE_POOL_URL, json={
             'text': 'A new use cases pool is ready for evaluation: <{}|{}>'.format(
                 '{}/eval?poolName={}'.format(_BASE_URL, parse.quote(pool_name)), pool_name)})
 
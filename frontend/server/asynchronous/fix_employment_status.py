@@ -4,6 +4,7 @@ import os
 from google.protobuf import json_format
 import pymongo
 
+from bob_emploi.frontend import migration
 from bob_emploi.frontend import proto
 from bob_emploi.frontend.api import user_pb2
 
@@ -38,9 +39,9 @@ def main(user_db, dry_run=True):
                 status.seeking = user_pb2.STOP_SEEKING
                 user_db.update_one(
                     {'_id': user_id},
-                    {'$set': {
+                    migration.mark_external_update({'$set': {
                         'employment_status.{}'.format(pos): json_format.MessageToDict(status)
-                    }},
+                    }}),
                 )
 
         if updated:
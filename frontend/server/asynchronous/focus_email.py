@@ -1,13 +1,17 @@
 """Script to send focused emails. See http://go/bob:focused-email-prd."""
 import argparse
 import collections
+from concurrent import futures
 import csv
 import datetime
+import itertools
 import logging
 import os
 import re
+import time
 from urllib import parse
 
+from bson import objectid
 import pymongo
 import requests
 from google.protobuf import json_format
@@ -16,6 +20,8 @@ import raven
 from bob_emploi.frontend import auth
 from bob_emploi.frontend import french
 from bob_emploi.frontend import mail
+from bob_emploi.frontend import migration
+from bob_emploi.frontend import outbox
 from bob_emploi.frontend import proto
 from bob_emploi.frontend.api import job_pb2
 from bob_emploi.frontend.api import project_pb2
@@ -26,6 +32,19 @@ from bob_emploi.frontend.asynchronous import report
 _DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
     .get_default_database()
 
+# Number of workers sending batches of emails concurrently.
+_SEND_WORKERS = 4
+
+# Maximum number of batches of emails prepared but not sent yet.
+_MAX_PENDING_BATCHES = 2 * _SEND_WORKERS
+
+# Number of users' updates to write at once in MongoDB.
+_BULK_WRITE_SIZE = 500
+
+# Rate limiter shared by all the workers and with the outbox dispatcher, so that
+# they do not exceed MailJet's rate all together.
+_RATE_LIMITER = outbox.MongoTokenBucket(_DB, outbox.RATE_PER_SECOND)
+
 # Cache (from MongoDB) of job group info.
 _JOB_GROUPS_INFO = proto.MongoCachedCollection(job_pb2.JobGroup, 'job_group_info')
 
@@ -322,7 +341,16 @@ def employment_vars(user):
 
 
 _Campaign = collections.namedtuple('Campaign', [
-    'mailjet_template', 'mongo_filters', 'get_vars', 'sender_name', 'sender_email'])
+    'mailjet_template', 'mongo_filters', 'mongo_fields', 'get_vars', 'sender_name',
+    'sender_email'])
+
+# Fields of the users needed to send them any email.
+_RECIPIENT_FIELDS = ('profile.email', 'profile.lastName', 'profile.name')
+
+# Fields of the users read by network_vars.
+_NETWORK_FIELDS = (
+    'profile.frustrations', 'profile.gender', 'projects.mobility.city', 'projects.targetJob',
+    'registeredAt')
 
 
 _CAMPAIGNS = {
@@ -331,6 +359,7 @@ _CAMPAIGNS = {
         mongo_filters={
             'projects.networkEstimate': 1,
         },
+        mongo_fields=_NETWORK_FIELDS,
         get_vars=network_vars,
         sender_name='Margaux de Bob Emploi',
         sender_email='margaux@bob-emploi.fr',
@@ -339,6 +368,9 @@ _CAMPAIGNS = {
         mailjet_template='212606',
         # TODO(pascal): Decide on trigger.
         mongo_filters={},
+        mongo_fields=_NETWORK_FIELDS + (
+            'emailsSent.campaignId', 'emailsSent.status', 'projects.seniority',
+            'projects.weeklyApplicationsEstimate'),
         get_vars=lambda user: spontaneous_vars(user, 'focus-network'),
         sender_name='Margaux de Bob Emploi',
         sender_email='margaux@bob-emploi.fr',
@@ -351,6 +383,7 @@ _CAMPAIGNS = {
                 'isIncomplete': {'$exists': False},
             }}
         },
+        mongo_fields=('registeredAt',),
         get_vars=employment_vars,
         sender_name='Benoit de Bob Emploi',
         sender_email='benoit@bob-emploi.fr',
@@ -358,6 +391,14 @@ _CAMPAIGNS = {
 }
 
 
+def _get_id_prefix_filter(id_prefix):
+    """MongoDB filter on the ObjectIds whose hex string starts with a given prefix."""
+    return {
+        '$gte': objectid.ObjectId(id_prefix.ljust(24, '0')),
+        '$lte': objectid.ObjectId(id_prefix.ljust(24, 'f')),
+    }
+
+
 def blast_campaign(
         campaign_id, action, registered_from, registered_to, dry_run_email='', user_hash=''):
     """Send a campaign of personalized emails."""
@@ -365,80 +406,172 @@ def blast_campaign(
         raise ValueError('Set the prod SECRET_SALT env var before continuing.')
     campaign = _CAMPAIGNS[campaign_id]
     template_id = campaign.mailjet_template
-    selected_users = _DB.user.find(dict(campaign.mongo_filters, **{
+    mongo_filters = dict(campaign.mongo_filters, **{
         'profile.email': {'$not': re.compile(r'@example.com$')},
         'registeredAt': {
             '$gt': registered_from,
             '$lt': registered_to,
-        }
-    }))
-    email_count = 0
-    email_errors = 0
+        },
+        # Skip users who already got this campaign.
+        'emailsSent.campaignId': {'$ne': campaign_id},
+    })
+    if user_hash:
+        mongo_filters['_id'] = _get_id_prefix_filter(user_hash)
+    selected_users = _DB.user.find(
+        mongo_filters, {field: 1 for field in _RECIPIENT_FIELDS + campaign.mongo_fields})
+    recipients = _list_recipients(campaign_id, selected_users)
+
+    if action == 'list':
+        for unused_user_id, user, unused_template_vars in recipients:
+            logging.info('%s %s', user.user_id, user.profile.email)
+        return 0
+
+    if action == 'dry-run':
+        for unused_user_id, user, template_vars in recipients:
+            user.profile.email = dry_run_email
+            res = mail.send_template(
+                template_id, user.profile, template_vars,
+                sender_email=campaign.sender_email, sender_name=campaign.sender_email)
+            logging.info('Email sent to %s', user.profile.email)
+            try:
+                res.raise_for_status()
+            except requests.exceptions.HTTPError:
+                raise ValueError('Could not send email for vars:\n{}'.format(template_vars))
+            sent_response = res.json()
+            message_id = next(iter(sent_response.get('Sent', [])), {}).get('MessageID', 0)
+            if not message_id:
+                logging.warning('Impossible to retrieve the sent email ID:\n%s', sent_response)
+            return 1
+        return 0
 
+    email_count, email_errors = _send_campaign(campaign_id, recipients)
+    report.notify_slack(
+        "Report for 3 month employment-status blast: I've sent {:d} emails (and got {:d} \
+        errors).".format(email_count, email_errors))
+    return email_count
+
+
+def _list_recipients(campaign_id, selected_users):
+    """List the users that should get an email of a campaign.
+
+    Yields:
+        a tuple for each user with their MongoDB ID, their User proto and the
+        vars for the email template.
+    """
+    campaign = _CAMPAIGNS[campaign_id]
     for user_dict in selected_users:
         user_id = user_dict.pop('_id')
         user = user_pb2.User()
         proto.parse_from_mongo(user_dict, user)
         user.user_id = str(user_id)
 
-        if user_hash and not user.user_id.startswith(user_hash):
-            continue
-
-        if any(email.campaign_id == campaign_id for email in user.emails_sent):
-            # We already sent the email to that person.
-            continue
-
         template_vars = campaign.get_vars(user)
         if not template_vars:
             continue
 
-        if action == 'list':
-            logging.info('%s %s', user.user_id, user.profile.email)
-            continue
+        yield user_id, user, template_vars
 
-        if action == 'dry-run':
-            user.profile.email = dry_run_email
-        if action in ('dry-run', 'send'):
-            res = mail.send_template(
-                template_id, user.profile, template_vars,
-                sender_email=campaign.sender_email, sender_name=campaign.sender_email)
-            logging.info('Email sent to %s', user.profile.email)
 
-        if action == 'dry-run':
-            try:
-                res.raise_for_status()
-            except requests.exceptions.HTTPError:
-                raise ValueError('Could not send email for vars:\n{}'.format(template_vars))
-        elif res.status_code != 200:
-            logging.warning('Error while sending an email: %d', res.status_code)
-            email_errors += 1
-            continue
+def _send_campaign(campaign_id, recipients):
+    """Send the emails of a campaign and record them in the users' data.
 
-        sent_response = res.json()
-        message_id = next(iter(sent_response.get('Sent', [])), {}).get('MessageID', 0)
+    Emails are sent in batches by a pool of workers, while the next batches
+    are prepared, and the users are updated in bulk.
+
+    Returns:
+        a tuple with the number of emails sent and the number of errors.
+    """
+    counts = collections.Counter()
+    updates = []
+    start = time.time()
+
+    def _collect(done_batches):
+        for done_batch in done_batches:
+            pending_batches.discard(done_batch)
+            for user_id, email_sent in done_batch.result():
+                if not email_sent:
+                    counts['errors'] += 1
+                    continue
+                updates.append(pymongo.UpdateOne(
+                    {'_id': user_id},
+                    migration.mark_external_update(
+                        {'$push': {'emailsSent': json_format.MessageToDict(email_sent)}})))
+                counts['sent'] += 1
+        if len(updates) >= _BULK_WRITE_SIZE:
+            _write_updates(updates)
+        print('{:d} emails sent, {:d} errors ({:.1f} emails per second) ...'.format(
+            counts['sent'], counts['errors'], counts['sent'] / (time.time() - start)))
+
+    pending_batches = set()
+    try:
+        with futures.ThreadPoolExecutor(max_workers=_SEND_WORKERS) as executor:
+            while True:
+                batch = list(itertools.islice(recipients, mail.MAX_MESSAGES_PER_CALL))
+                if not batch:
+                    break
+                if len(pending_batches) >= _MAX_PENDING_BATCHES:
+                    _collect(futures.wait(
+                        pending_batches, return_when=futures.FIRST_COMPLETED).done)
+                pending_batches.add(executor.submit(_send_batch, campaign_id, batch))
+            _collect(futures.wait(pending_batches).done)
+    finally:
+        # Record the emails that were sent even if the campaign stopped early,
+        # so that they are not sent again on the next run. The executor has
+        # waited for all the pending batches to finish.
+        unrecorded_batches = [batch for batch in pending_batches if not batch.exception()]
+        if unrecorded_batches:
+            _collect(unrecorded_batches)
+        _write_updates(updates)
+
+    return counts['sent'], counts['errors']
+
+
+def _send_batch(campaign_id, batch):
+    """Send the emails of a campaign to a batch of users.
+
+    Returns:
+        a list with a tuple for each user of the batch with their MongoDB ID
+        and the EmailSent proto, or None if the email could not be sent.
+    """
+    campaign = _CAMPAIGNS[campaign_id]
+    _RATE_LIMITER.acquire(len(batch))
+    try:
+        res = mail.send_templates(
+            campaign.mailjet_template,
+            [(user.profile, template_vars) for unused_user_id, user, template_vars in batch],
+            sender_email=campaign.sender_email, sender_name=campaign.sender_email)
+    except requests.exceptions.RequestException as error:
+        logging.warning('Error while sending %d emails: %s', len(batch), error)
+        return [(user_id, None) for user_id, unused_user, unused_vars in batch]
+    if res.status_code != 200:
+        logging.warning('Error while sending %d emails: %d', len(batch), res.status_code)
+        return [(user_id, None) for user_id, unused_user, unused_vars in batch]
+
+    sent_response = res.json()
+    # MailJet does not guarantee the order of the sent messages: match them by
+    # recipient.
+    message_ids = {
+        message.get('Email', '').lower(): message.get('MessageID', 0)
+        for message in sent_response.get('Sent', [])}
+    results = []
+    for user_id, user, unused_template_vars in batch:
+        logging.info('Email sent to %s', user.profile.email)
+        message_id = message_ids.get(user.profile.email.lower(), 0)
         if not message_id:
             logging.warning('Impossible to retrieve the sent email ID:\n%s', sent_response)
-        if action == 'dry-run':
-            return 1
-
-        email_sent = user.emails_sent.add()
+        email_sent = user_pb2.EmailSent(
+            mailjet_template=campaign.mailjet_template, campaign_id=campaign_id,
+            mailjet_message_id=message_id)
         email_sent.sent_at.GetCurrentTime()
         email_sent.sent_at.nanos = 0
-        email_sent.mailjet_template = template_id
-        email_sent.campaign_id = campaign_id
-        email_sent.mailjet_message_id = message_id
-        _DB.user.update_one({'_id': user_id}, {'$set': {
-            'emailsSent': json_format.MessageToDict(user).get('emailsSent', []),
-        }})
-        email_count += 1
-        if email_count % 100 == 0:
-            print('{} emails sent ...'.format(email_count))
-
-    if action == 'send':
-        report.notify_slack(
-            "Report for 3 month employment-status blast: I've sent {:d} emails (and got {:d} \
-            errors).".format(email_count, email_errors))
-    return email_count
+        results.append((user_id, email_sent))
+    return results
+
+
+def _write_updates(updates):
+    if updates:
+        _DB.user.bulk_write(updates, ordered=False)
+    del updates[:]
 
 
 def main():
@@ -21,7 +21,8 @@ import pymongo
 
 from google.protobuf import json_format
 
-from bob_emploi.frontend import mail
+from bob_emploi.frontend import migration
+from bob_emploi.frontend import outbox
 from bob_emploi.frontend.api import user_pb2
 from bob_emploi.frontend.asynchronous import report
 
@@ -49,11 +50,19 @@ _MAILJET_REPORT_TEMPLATE_ID = '74071'
 # only send NPS email on the next day.
 _DAY_CUT_UTC_HOUR = 1
 
+# Number of emails to enqueue before checking that the outbox is not too full.
+_OUTBOX_CHECK_INTERVAL = 100
 
-def send_email_to_user(user, base_url, now):
-    """Sends an email to the user to measure the Net Promoter Score."""
-    # Renew actions for the day if needed.
-    mail_result = mail.send_template(
+
+def send_email_to_user(user, user_id, base_url, now, database):
+    """Enqueue an email to the user to measure the Net Promoter Score.
+
+    Returns:
+        whether the email was enqueued, False if it already was in the outbox.
+    """
+    return outbox.enqueue(
+        database,
+        'nps:{}'.format(user_id),
         _MAILJET_TEMPLATE_ID,
         user.profile,
         {
@@ -62,10 +71,7 @@ def send_email_to_user(user, base_url, now):
             'emailInUrl': parse.quote(user.profile.email),
             'dateInUrl': parse.quote(now.strftime('%Y-%m-%d')),
         },
-        dry_run=DRY_RUN,
     )
-    mail_result.raise_for_status()
-    return True
 
 
 def _break_on_signal(signums, iterator):
@@ -93,10 +99,10 @@ def _break_on_signal(signums, iterator):
 
 
 def _send_reports(count, errors):
-    logging.warning('%d emails sent.', count)
+    logging.warning('%d emails enqueued.', count)
 
     report.notify_slack(
-        "Report for NPS blast: I've sent {:d} emails (with {:d} errors).".format(
+        "Report for NPS blast: I've enqueued {:d} emails (with {:d} errors).".format(
             count, len(errors)))
     report.send_to_admins('NPS', count, errors)
 
@@ -134,22 +140,31 @@ def main(user_db, base_url, now, days_before_sending):
             # Skip silently: will send another day.
             continue
 
+        if DRY_RUN:
+            logging.info('Would send the NPS email to %s.', user_id)
+            count += 1
+            continue
+
         try:
-            result = send_email_to_user(user, base_url, now)
+            is_enqueued = send_email_to_user(user, user_id, base_url, now, user_db.database)
         except (IOError, json_format.ParseError) as err:
-            errors.append('{} - {}'.foramt(err, user_id))
+            errors.append('{} - {}'.format(err, user_id))
             logging.error(err)
             continue
 
-        if not result:
-            continue
+        # The email may already be in the outbox if a previous run stopped
+        # before this update.
+        user_db.update_one(
+            {'_id': user_id},
+            migration.mark_external_update(
+                {'$set': {'featuresEnabled.netPromoterScoreEmail': 'NPS_EMAIL_SENT'}}))
 
-        if not DRY_RUN:
-            user_db.update_one(
-                {'_id': user_id},
-                {'$set': {'featuresEnabled.netPromoterScoreEmail': 'NPS_EMAIL_SENT'}})
+        if not is_enqueued:
+            continue
 
         count += 1
+        if not count % _OUTBOX_CHECK_INTERVAL:
+            outbox.wait_for_room(user_db.database)
 
     _send_reports(count, errors)
 
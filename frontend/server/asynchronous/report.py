@@ -2,8 +2,7 @@
 import logging
 import os
 
-import requests
-
+from bob_emploi.frontend import http_client
 from bob_emploi.frontend import mail
 
 # A Slack WebHook URL to send final reports to. Defined in the Incoming
@@ -18,7 +17,7 @@ _MAILJET_REPORT_TEMPLATE_ID = '74071'
 def notify_slack(message):
     """Send a message on slack channel #bob-bot as Bob the mailman."""
     if _SLACK_WEBHOOK_URL:
-        requests.post(_SLACK_WEBHOOK_URL, json={'text': message})
+        http_client.post(_SLACK_WEBHOOK_URL, json={'text': message})
 
 
 def send_to_admins(blast_name, count, errors):
@@ -0,0 +1,57 @@
+"""Script to send the emails enqueued in the outbox, see the outbox module.
+
+It runs forever, polling the outbox for due messages, and sends them at the
+rate allowed by MailJet:
+
+docker-compose run --rm \
+    -e MONGO_URL ... \
+    frontend-flask python bob_emploi/frontend/asynchronous/send_outbox.py --rate 10
+
+In prod, it is restarted on each deployment by frontend/release/send_outbox.sh.
+"""
+import argparse
+import logging
+import os
+import time
+
+import pymongo
+
+from bob_emploi.frontend import outbox
+
+
+def main(string_args=None, database=None, sleep=time.sleep):
+    """Parse command line arguments and send the emails of the outbox."""
+    parser = argparse.ArgumentParser(
+        description='Send the emails of the outbox.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--rate', type=float, default=outbox.RATE_PER_SECOND,
+        help='Maximum number of emails to send per second.')
+    parser.add_argument(
+        '--burst', type=int, help='Maximum number of emails to send at once, defaults to the '
+        'rate.')
+    parser.add_argument(
+        '--poll-seconds', type=float, default=1,
+        help='Number of seconds to wait when there is no email to send.')
+    parser.add_argument(
+        '--once', action='store_true', help='Stop when there is no email to send anymore.')
+    args = parser.parse_args(string_args)
+
+    logging.basicConfig(level='INFO')
+    if database is None:
+        database = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
+            .get_default_database()
+    outbox.ensure_indexes(database)
+    bucket = outbox.MongoTokenBucket(database, args.rate, args.burst)
+    while True:
+        count = outbox.dispatch(database, bucket)
+        if count:
+            logging.info('%d emails processed.', count)
+            continue
+        if args.once:
+            return
+        sleep(args.poll_seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,18 @@
 """Script to get back typeform employment survey answers to mongoDB."""
 import argparse
+from concurrent import futures
 import logging
 import os
 from urllib import parse
 import time
 
+from bson import objectid
 from google.protobuf import json_format
 import pymongo
-import requests
 
+from bob_emploi.frontend import auth
+from bob_emploi.frontend import http_client
+from bob_emploi.frontend import migration
 from bob_emploi.frontend.api import user_pb2
 
 _DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
@@ -60,7 +64,19 @@ _BOB_HAS_HELP_MAPPING = {
     'Non, pas du tout': 'NO',
 }
 
-_BASE_URL = os.getenv('BASE_URL', 'https://www.bob-emploi.fr')
+# MongoDB collection with, for each survey, the timestamp from which to get the
+# responses on the next sync, and the responses that could not be saved yet.
+_CURSORS_COLLECTION = 'typeform_sync_cursors'
+
+# Number of seconds during which the responses that could not be saved, e.g.
+# because the user has not landed on the survey yet, are tried again.
+_PENDING_MAX_SECONDS = 7 * 86400
+
+# Number of surveys to fetch from Typeform at the same time.
+_FETCH_WORKERS = 4
+
+# Number of user updates to send to MongoDB at once.
+_BULK_WRITE_SIZE = 500
 
 
 def call_typeform_api(survey_id, since_timestamp, offset, limit):
@@ -74,7 +90,7 @@ def call_typeform_api(survey_id, since_timestamp, offset, limit):
             'offset': offset,
             'limit': limit
         }))
-    response = requests.get(url)
+    response = http_client.get(url)
     if response.status_code != 200:
         logging.error('got http status %s when calling %s', response.status_code, url)
         return None
@@ -87,6 +103,8 @@ def iter_survey_responses(survey, since_timestamp, limit):
     while True:
         # Call Typeform API.
         json_response = call_typeform_api(survey['id'], since_timestamp, offset, limit)
+        if json_response is None:
+            raise IOError('Could not get the responses of survey "{}".'.format(survey['id']))
 
         # Check questions in case we have changed them.
         target_questions = set(survey['questions'].values())
@@ -96,7 +114,7 @@ def iter_survey_responses(survey, since_timestamp, limit):
             logging.error('cannot find some questions in results: %s', remaining_questions)
             logging.debug('survey questions are:')
             logging.debug(json_response['questions'])
-            return
+            raise ValueError('Some questions are missing in survey "{}".'.format(survey['id']))
 
         # Yield responses.
         for item in json_response['responses']:
@@ -142,38 +160,142 @@ def survey_response_to_bob_data(survey, response):
     }
 
 
-def sync_employment_status(surveys, since_timestamp, dry_run=True, nb_responses_per_call=200):
-    """Analyze employment_status survey campaign."""
-    nb_responses = 0
-    nb_users_to_update = 0
-    nb_users_updated = 0
-    nb_errors = 0
-    for survey in surveys:
-        # Iterate through responses.
-        for response in iter_survey_responses(survey, since_timestamp, limit=nb_responses_per_call):
-            nb_responses += 1
-            bob_params = survey_response_to_bob_data(survey, response)
-            logging.debug('got bob params: %s', bob_params)
-            if bob_params is None:
-                continue
-            nb_users_to_update += 1
-            bob_url = '{}/api/employment-status?{}'.format(_BASE_URL, parse.urlencode(bob_params))
-            logging.info('update user %s survey id %s', bob_params['user'], bob_params['id'])
-            logging.debug(bob_url)
-            if dry_run:
-                continue
-            bob_response = requests.get(bob_url)
-            if bob_response.status_code != 200:
-                logging.warning('got response %s when calling %s', bob_response.text, bob_url)
-                nb_errors += 1
-                continue
-            nb_users_updated += 1
-    return {
-        'nb_responses': nb_responses,
-        'nb_users_to_update': nb_users_to_update,
-        'nb_users_updated': nb_users_updated,
-        'nb_errors': nb_errors,
+def _make_user_update(bob_params):
+    """Make the update of a user for a survey response, or None if it is invalid."""
+    try:
+        auth.check_token(bob_params['user'], bob_params['token'], role='employment-status')
+        user_id = objectid.ObjectId(bob_params['user'])
+        status_index = int(bob_params['id'])
+    except (ValueError, objectid.InvalidId) as error:
+        logging.warning(
+            'Invalid survey response %s of user %s: %s',
+            bob_params['id'], bob_params['user'], error)
+        return None
+    field = 'employment_status.{:d}'.format(status_index)
+    values = {
+        field + '.seeking': user_pb2.SeekingStatus.Name(bob_params['seeking']),
+        field + '.situation': bob_params['situation'],
+        field + '.bobHasHelped': bob_params['bobHasHelped'],
+    }
+    return pymongo.UpdateOne(
+        {
+            '_id': user_id,
+            # The employment status is created when the user lands on the survey.
+            field: {'$exists': True},
+            # Do not update users that already have this response.
+            '$or': [{key: {'$ne': value}} for key, value in values.items()],
+        },
+        migration.mark_external_update({'$set': values}))
+
+
+def _find_unsaved_responses(database, responses):
+    """Find the responses for which the users have no employment status yet."""
+    if not responses:
+        return []
+    users = database.user.find(
+        {'_id': {'$in': list(set(objectid.ObjectId(bob_params['user'])
+                                 for bob_params in responses))}},
+        {'employment_status': 1})
+    nb_statuses = {user['_id']: len(user.get('employment_status', [])) for user in users}
+    return [
+        bob_params for bob_params in responses
+        if nb_statuses.get(objectid.ObjectId(bob_params['user']), 0) <= int(bob_params['id'])]
+
+
+def sync_employment_status(
+        surveys, since_timestamp, dry_run=True, nb_responses_per_call=200, database=None):
+    """Analyze employment_status survey campaign.
+
+    Args:
+        surveys: the surveys to get the responses of, fetched in parallel.
+        since_timestamp: the timestamp from which to get the responses of
+            surveys that were never synced before.
+        dry_run: if True, neither the users nor the cursors are updated.
+        nb_responses_per_call: the number of responses to get per call to
+            Typeform.
+        database: the MongoDB database of the users and of the cursors keeping
+            track of the last sync of each survey.
+    Returns:
+        a dict of counters.
+    """
+    cursors = {}
+    if database is not None:
+        cursors = {
+            cursor['_id']: cursor
+            for cursor in database.get_collection(_CURSORS_COLLECTION).find(
+                {'_id': {'$in': [survey['id'] for survey in surveys]}})
+        }
+    sync_started_at = int(time.time())
+
+    def _fetch_responses(survey):
+        return list(iter_survey_responses(
+            survey, cursors.get(survey['id'], {}).get('since', since_timestamp),
+            limit=nb_responses_per_call))
+
+    counters = {
+        'nb_responses': 0,
+        'nb_users_to_update': 0,
+        'nb_users_updated': 0,
+        'nb_errors': 0,
     }
+    updates = []
+    # The valid responses of each survey that was fetched.
+    valid_responses = {}
+    with futures.ThreadPoolExecutor(max_workers=_FETCH_WORKERS) as executor:
+        fetches = [(survey, executor.submit(_fetch_responses, survey)) for survey in surveys]
+        for survey, fetch in fetches:
+            try:
+                responses = fetch.result()
+            except (IOError, ValueError) as error:
+                logging.error('Could not sync the survey %s: %s', survey['id'], error)
+                counters['nb_errors'] += 1
+                continue
+            # Responses that could not be saved on the previous syncs.
+            survey_responses = list(cursors.get(survey['id'], {}).get('pending', []))
+            for response in responses:
+                counters['nb_responses'] += 1
+                bob_params = survey_response_to_bob_data(survey, response)
+                logging.debug('got bob params: %s', bob_params)
+                if bob_params is not None:
+                    bob_params['fetchedAt'] = sync_started_at
+                    survey_responses.append(bob_params)
+            valid_responses[survey['id']] = []
+            for bob_params in survey_responses:
+                counters['nb_users_to_update'] += 1
+                logging.info('update user %s survey id %s', bob_params['user'], bob_params['id'])
+                if dry_run:
+                    continue
+                update = _make_user_update(bob_params)
+                if update is None:
+                    counters['nb_errors'] += 1
+                    continue
+                updates.append(update)
+                valid_responses[survey['id']].append(bob_params)
+
+    if dry_run:
+        return counters
+
+    for start in range(0, len(updates), _BULK_WRITE_SIZE):
+        result = database.user.bulk_write(updates[start:start + _BULK_WRITE_SIZE], ordered=False)
+        counters['nb_users_updated'] += result.matched_count
+
+    for survey_id, responses in valid_responses.items():
+        # Users that do not exist or that never landed on the survey: try
+        # again on the next syncs.
+        pending = []
+        for bob_params in _find_unsaved_responses(database, responses):
+            counters['nb_errors'] += 1
+            if bob_params['fetchedAt'] > sync_started_at - _PENDING_MAX_SECONDS:
+                pending.append(bob_params)
+            else:
+                logging.warning(
+                    'Giving up on survey response %s of user %s.',
+                    bob_params['id'], bob_params['user'])
+        database.get_collection(_CURSORS_COLLECTION).update_one(
+            {'_id': survey_id},
+            {'$set': {'since': sync_started_at, 'pending': pending}}, upsert=True)
+
+    return counters
 
 
 def main():
@@ -181,7 +303,8 @@ def main():
     parser = argparse.ArgumentParser(
         description='Synchronize mongodb employement status fields retrieving typeform data.')
     parser.add_argument(
-        '--nb-days', type=int, default=3, help='Retrieve results from the last nb days.')
+        '--nb-days', type=int, default=3,
+        help='Retrieve results from the last nb days for surveys that were never synced.')
     parser.add_argument(
         '--no-dry-run', dest='dry_run', action='store_false', help='No dry run really store in db.')
     parser.add_argument('--verbose', '-v', action='store_true', help='More detailed output.')
@@ -190,7 +313,8 @@ def main():
     logging.basicConfig(level='DEBUG' if args.verbose else 'INFO')
 
     since_timestamp = int(time.time()) - args.nb_days * 86400
-    counters = sync_employment_status(_SURVEYS, since_timestamp, dry_run=args.dry_run)
+    counters = sync_employment_status(
+        _SURVEYS, since_timestamp, dry_run=args.dry_run, database=_DB)
     logging.info('%d survey responses processed.', counters['nb_responses'])
     logging.info('%d users to update.', counters['nb_users_to_update'])
     logging.info('%d users updated successfully.', counters['nb_users_updated'])
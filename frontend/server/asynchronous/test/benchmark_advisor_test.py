@@ -0,0 +1,142 @@
+"""Tests for the benchmark_advisor module."""
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import mongomock
+
+from bob_emploi.frontend import advisor
+from bob_emploi.frontend.asynchronous import benchmark_advisor
+
+
+class BenchmarkAdvisorTestCase(unittest.TestCase):
+    """Unit tests for the benchmark script."""
+
+    def setUp(self):
+        super(BenchmarkAdvisorTestCase, self).setUp()
+        advisor.clear_cache()
+        advisor.scoring.clear_cache()
+        self.addCleanup(advisor.clear_cache)
+        self._db = mongomock.MongoClient().test
+        self._db.advice_modules.insert_many([
+            {
+                '_id': 'one-ring',
+                'adviceId': 'one-ring',
+                'isReadyForProd': True,
+                'triggerScoringModel': 'constant(2)',
+            },
+            {
+                '_id': 'no-advice',
+                'adviceId': 'no-advice',
+                'isReadyForProd': True,
+                'triggerScoringModel': 'constant(0)',
+            },
+        ])
+        self._db.use_case.insert_many([
+            {
+                '_id': '2017-10-01_{:02d}'.format(index),
+                'poolName': '2017-10-01',
+                'indexInPool': index,
+                'userData': {'projects': [{'targetJob': {'jobGroup': {'romeId': 'A1234'}}}]},
+            }
+            for index in range(3)
+        ] + [{'_id': 'other_00', 'poolName': 'other', 'userData': {'projects': [{}]}}])
+
+    def test_run(self):
+        """Replay all the use cases of a pool."""
+        report = benchmark_advisor.run(self._db, ['2017-10-01'])
+
+        self.assertEqual(3, report['useCases'])
+        self.assertGreater(report['useCasesPerSecond'], 0)
+        self.assertEqual(
+            {'advices', 'tips', 'expandedCard', 'total'}, set(report['latencies']))
+        self.assertLessEqual(
+            report['latencies']['total']['p50'], report['latencies']['total']['p99'])
+        self.assertEqual({'constant(0)', 'constant(2)'}, set(report['models']))
+        # The advisor measures both the score and the extra data of each advice.
+        self.assertEqual(6, report['models']['constant(2)']['calls'])
+        self.assertEqual(0, report['models']['constant(2)']['dbCalls'])
+        # mongomock does not run any MongoDB command.
+        self.assertNotIn('dbCalls', report)
+
+    def test_run_counts_db_calls(self):
+        """Count the DB calls of each step with a command listener."""
+        command_counter = benchmark_advisor._CommandCounter()  # pylint: disable=protected-access
+        real_compute_advices = advisor.compute_advices_for_project
+
+        def _compute_advices(*args, **kwargs):
+            # The MongoDB client would notify the listener for each command.
+            command_counter.started(None)
+            return real_compute_advices(*args, **kwargs)
+
+        with mock.patch(advisor.__name__ + '.compute_advices_for_project', _compute_advices):
+            report = benchmark_advisor.run(
+                self._db, ['2017-10-01'], command_counter=command_counter)
+
+        self.assertEqual({'advices': 3, 'tips': 0, 'expandedCard': 0}, report['dbCalls'])
+
+    def test_compare_to_baseline(self):
+        """Find the regressions compared to a baseline."""
+        baseline = {
+            'useCases': 10,
+            'latencies': {'advices': {'p50': .010, 'p95': .020}},
+            'dbCalls': {'advices': 10},
+            'models': {
+                'advice-slow': {'calls': 10, 'seconds': .05, 'dbCalls': 0},
+                'advice-chatty': {'calls': 10, 'seconds': .05, 'dbCalls': 10},
+            },
+        }
+        report = {
+            'useCases': 20,
+            # A small variation of the median and a large one of the p95.
+            'latencies': {'advices': {'p50': .0105, 'p95': .030}},
+            'dbCalls': {'advices': 20},
+            'models': {
+                'advice-slow': {'calls': 20, 'seconds': .2, 'dbCalls': 0},
+                'advice-chatty': {'calls': 20, 'seconds': .1, 'dbCalls': 40},
+                'advice-new': {'calls': 20, 'seconds': 1, 'dbCalls': 20},
+            },
+        }
+
+        regressions = benchmark_advisor.compare_to_baseline(report, baseline)
+
+        self.assertEqual(
+            [
+                'advices p95: 30.0ms instead of 20.0ms',
+                'advice-chatty: 2.00 DB calls per use case instead of 1.00',
+                'advice-slow: 10.0ms instead of 5.0ms',
+            ],
+            regressions)
+
+    def test_main_with_fixture(self):
+        """Run the script on a fixture and compare to the baseline it saved."""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        fixture_filename = os.path.join(tmp_dir, 'fixture.json')
+        report_filename = os.path.join(tmp_dir, 'report.json')
+        with open(fixture_filename, 'w') as fixture_file:
+            json.dump({
+                name: list(self._db.get_collection(name).find())
+                for name in ('advice_modules', 'use_case')
+            }, fixture_file)
+
+        out = io.StringIO()
+        self.assertEqual(0, benchmark_advisor.main(
+            ['2017-10-01', '--fixture', fixture_filename, '--output', report_filename], out=out))
+        self.assertIn('3 use cases in', out.getvalue())
+        with open(report_filename) as report_file:
+            self.assertEqual(3, json.load(report_file)['useCases'])
+
+        out = io.StringIO()
+        benchmark_advisor.main(
+            ['2017-10-01', '--fixture', fixture_filename, '--baseline', report_filename],
+            out=out)
+        self.assertIn('regression', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
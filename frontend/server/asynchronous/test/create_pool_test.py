@@ -20,7 +20,7 @@ class CreatePoolTestCase(unittest.TestCase):
         self._db_patcher.stop()
         super(CreatePoolTestCase, self).tearDown()
 
-    @mock.patch(create_pool.__name__ + '.requests.post')
+    @mock.patch(create_pool.http_client.__name__ + '.post')
     @mock.patch(
         create_pool.__name__ + '._SLACK_CREATE_POOL_URL', 'https://slack.example.com/webhook')
     def test_basic_usage(self, mock_post):
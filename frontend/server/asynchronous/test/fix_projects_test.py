@@ -4,6 +4,7 @@ import unittest
 import mock
 import mongomock
 
+from bob_emploi.frontend import migration
 from bob_emploi.frontend.asynchronous import fix_projects
 
 
@@ -42,6 +43,36 @@ class FixProjectsTestCase(unittest.TestCase):
 
         fix_projects.main(self.user_db, dry_run=False)
 
+        updated_user = self.user_db.find_one({})
+        del updated_user['_id']
+        self.assertEqual(user_dict['projects'], updated_user['projects'])
+        self.assertEqual(
+            {'email': 'pascal@corpet.net', 'lastName': 'Corpet', 'name': 'Pascal'},
+            updated_user['profile'])
+        self.assertEqual(migration.CURRENT_VERSION, updated_user['schemaVersion'])
+
+    def test_user_up_to_date(self):
+        """User already has the latest schema."""
+        user_dict = {
+            'profile': {'situation': 'LOST_QUIT'},
+            'projects': [{'projectId': '0', 'kind': 'FIND_JOB'}],
+            'schemaVersion': migration.CURRENT_VERSION,
+        }
+        self.user_db.insert_one(dict(user_dict))
+
+        fix_projects.main(self.user_db, dry_run=False)
+
+        updated_user = self.user_db.find_one({})
+        del updated_user['_id']
+        self.assertEqual(user_dict, updated_user)
+
+    def test_dry_run(self):
+        """Do not modify users in dry run mode."""
+        user_dict = {'projects': [{'projectId': '0', 'kind': 'FIND_JOB'}]}
+        self.user_db.insert_one(dict(user_dict))
+
+        fix_projects.main(self.user_db, dry_run=True)
+
         updated_user = self.user_db.find_one({})
         del updated_user['_id']
         self.assertEqual(user_dict, updated_user)
@@ -79,6 +110,9 @@ class FixProjectsTestCase(unittest.TestCase):
 
         del updated_user['projects']
         del user_dict['projects']
+        del user_dict['profile']['situation']
+        user_dict['schemaVersion'] = migration.CURRENT_VERSION
+        user_dict['_externalRevision'] = 1
 
         self.assertEqual(user_dict, updated_user)
 
@@ -130,6 +164,9 @@ class FixProjectsTestCase(unittest.TestCase):
 
         del updated_user['projects']
         del user_dict['projects']
+        del user_dict['profile']['situation']
+        user_dict['schemaVersion'] = migration.CURRENT_VERSION
+        user_dict['_externalRevision'] = 1
 
         self.assertEqual(user_dict, updated_user)
 
@@ -183,6 +220,9 @@ class FixProjectsTestCase(unittest.TestCase):
 
         del updated_user['projects']
         del user_dict['projects']
+        del user_dict['profile']['situation']
+        user_dict['schemaVersion'] = migration.CURRENT_VERSION
+        user_dict['_externalRevision'] = 1
 
         self.assertEqual(user_dict, updated_user)
 
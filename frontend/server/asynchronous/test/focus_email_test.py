@@ -3,12 +3,14 @@ import datetime
 import re
 import unittest
 
+from bson import objectid
 import mock
 import mongomock
 
 from bob_emploi.frontend.api import project_pb2
 from bob_emploi.frontend.api import user_pb2
 from bob_emploi.frontend.asynchronous import focus_email
+from bob_emploi.frontend.test import mongomock_helpers
 
 
 class NetworkVarsTestCase(unittest.TestCase):
@@ -176,28 +178,40 @@ class EmploymentVarsTestCase(unittest.TestCase):
         )
 
 
+def _send_templates(unused_template_id, recipients_and_vars, **unused_kwargs):
+    response = mock.MagicMock(status_code=200)
+    response.json.return_value = {'Sent': [
+        {'Email': recipient.email, 'MessageID': 18014679230180635}
+        for recipient, unused_vars in recipients_and_vars]}
+    return response
+
+
 @mock.patch(focus_email.auth.__name__ + '.SECRET_SALT', new=b'prod-secret')
+@mock.patch(
+    focus_email.__name__ + '._ROME_INFO',
+    new=focus_email.RomePrefixInfo([{'rome_prefix': 'A', 'domain': 'dans la vie'}]))
 class FocusEmailTestCase(unittest.TestCase):
     """Tests for the blast_campaign function."""
 
-    @mock.patch(focus_email.mail.__name__ + '.send_template')
-    @mock.patch(
-        focus_email.__name__ + '._DB',
-        new_callable=lambda: mongomock.MongoClient().test)
-    @mock.patch(
-        focus_email.__name__ + '._ROME_INFO',
-        new=focus_email.RomePrefixInfo([{'rome_prefix': 'A', 'domain': 'dans la vie'}]))
-    def test_blast_campaign(self, mock_db, mock_mail):
-        """Basic test."""
-        mock_mail().status_code = 200
-        mock_mail().json.return_value = {'Sent': [{'MessageID': 18014679230180635}]}
-        mock_mail.reset_mock()
-        mock_db.user.insert_many([
+    def setUp(self):
+        super(FocusEmailTestCase, self).setUp()
+        self._db = mongomock.MongoClient().test
+        db_patcher = mock.patch(focus_email.__name__ + '._DB', self._db)
+        db_patcher.start()
+        self.addCleanup(db_patcher.stop)
+        bulk_write_patcher = mongomock_helpers.patch_bulk_write(self._db.user)
+        bulk_write_patcher.start()
+        self.addCleanup(bulk_write_patcher.stop)
+        rate_limiter_patcher = mock.patch(focus_email.__name__ + '._RATE_LIMITER')
+        self._mock_rate_limiter = rate_limiter_patcher.start()
+        self.addCleanup(rate_limiter_patcher.stop)
+        self._db.user.insert_many([
             {
                 '_id': '%d' % month,
                 'registeredAt': '2017-%02d-15T00:00:00Z' % month,
                 'profile': {
                     'name': '%d user' % month,
+                    'email': 'user%d@mail.fr' % month,
                 },
                 'projects': [
                     {'networkEstimate': 1, 'targetJob': {'jobGroup': {'romeId': 'A1234'}}},
@@ -205,7 +219,7 @@ class FocusEmailTestCase(unittest.TestCase):
             }
             for month in range(2, 9)
         ])
-        mock_db.user.insert_one({
+        self._db.user.insert_one({
             'registeredAt': '2017-05-15T00:00:00Z',
             'profile': {
                 'name': 'Already sent',
@@ -215,22 +229,155 @@ class FocusEmailTestCase(unittest.TestCase):
             ],
             'emailsSent': [{'campaignId': 'focus-network'}],
         })
-        focus_email.blast_campaign('focus-network', 'send', '2017-04-01', '2017-07-10')
+
+    @mock.patch(focus_email.mail.__name__ + '.send_templates')
+    def test_blast_campaign(self, mock_mail):
+        """Basic test."""
+        mock_mail.side_effect = _send_templates
+        self._db.user.update_one(
+            {'_id': '5'}, {'$set': {'emailsSent': [{'campaignId': 'other-campaign'}]}})
 
         self.assertEqual(
-            3, mock_mail.call_count,
+            3, focus_email.blast_campaign('focus-network', 'send', '2017-04-01', '2017-07-10'))
+
+        self.assertEqual(
+            ['4 user', '5 user', '6 user'],
+            sorted(
+                recipient.name
+                for call in mock_mail.call_args_list for recipient, unused_vars in call[0][1]),
             msg='3 emails expected: one per month from April to June\n%s' %
             mock_mail.call_args_list)
-        february_user = mock_db.user.find_one({'_id': '2'})
+        february_user = self._db.user.find_one({'_id': '2'})
         self.assertFalse(february_user.get('emailsSent'))
 
-        april_user = mock_db.user.find_one({'_id': '4'})
+        april_user = self._db.user.find_one({'_id': '4'})
         self.assertEqual(
             [{'sentAt', 'mailjetTemplate', 'campaignId', 'mailjetMessageId'}],
             [e.keys() for e in april_user.get('emailsSent', [])])
         self.assertEqual('focus-network', april_user['emailsSent'][0]['campaignId'])
         self.assertEqual(18014679230180635, int(april_user['emailsSent'][0]['mailjetMessageId']))
 
+        may_user = self._db.user.find_one({'_id': '5'})
+        self.assertEqual(
+            ['other-campaign', 'focus-network'],
+            [e.get('campaignId') for e in may_user['emailsSent']])
+
+    @mock.patch(focus_email.mail.__name__ + '.send_templates')
+    def test_user_hash(self, mock_mail):
+        """Only send to users whose ID starts with a given prefix."""
+        mock_mail.side_effect = _send_templates
+        self._db.user.insert_many([
+            {
+                '_id': objectid.ObjectId(user_id),
+                'registeredAt': '2017-05-15T00:00:00Z',
+                'profile': {'name': user_id[:3], 'yearOfBirth': 1982},
+                'projects': [
+                    {'networkEstimate': 1, 'targetJob': {'jobGroup': {'romeId': 'A1234'}}},
+                ],
+            }
+            for user_id in (
+                '5a0000000000000000000000', '5a11ffffffffffffffffffff', '5a1ec0b9c5efd8001a2b3c4d',
+                '5a2000000000000000000000')
+        ])
+
+        focus_email.blast_campaign(
+            'focus-network', 'send', '2017-04-01', '2017-07-10', user_hash='5a1')
+
+        recipients = [recipient for recipient, unused_vars in mock_mail.call_args[0][1]]
+        self.assertEqual(['5a1', '5a1'], [recipient.name for recipient in recipients])
+        # Only the needed fields are fetched.
+        self.assertFalse(recipients[0].year_of_birth)
+
+    @mock.patch(focus_email.mail.__name__ + '.MAX_MESSAGES_PER_CALL', 2)
+    @mock.patch(focus_email.mail.__name__ + '.send_templates')
+    def test_send_in_batches(self, mock_mail):
+        """Send emails to many users in each call."""
+        mock_mail.side_effect = _send_templates
+
+        focus_email.blast_campaign('focus-network', 'send', '2017-01-01', '2017-12-31')
+
+        self.assertEqual(
+            [2, 2, 2, 1],
+            sorted((len(call[0][1]) for call in mock_mail.call_args_list), reverse=True))
+        self.assertEqual(
+            7, self._db.user.count_documents({'emailsSent.mailjetMessageId': {'$exists': True}}))
+        self.assertEqual(
+            [2, 2, 2, 1],
+            sorted(
+                (call[0][0] for call in self._mock_rate_limiter.acquire.call_args_list),
+                reverse=True))
+
+    @mock.patch(focus_email.mail.__name__ + '.send_templates')
+    def test_message_ids_by_recipient(self, mock_mail):
+        """Match the sent messages with the users by their email address."""
+        def _send_templates_in_any_order(
+                unused_template_id, recipients_and_vars, **unused_kwargs):
+            response = mock.MagicMock(status_code=200)
+            response.json.return_value = {'Sent': [
+                {
+                    'Email': recipient.email.upper(),
+                    'MessageID': 1000 + int(recipient.email[len('user'):].split('@')[0]),
+                }
+                for recipient, unused_vars in reversed(recipients_and_vars)]}
+            return response
+        mock_mail.side_effect = _send_templates_in_any_order
+
+        focus_email.blast_campaign('focus-network', 'send', '2017-04-01', '2017-07-10')
+
+        self.assertEqual(
+            {'4': 1004, '5': 1005, '6': 1006},
+            {
+                user['_id']: int(user['emailsSent'][-1]['mailjetMessageId'])
+                for user in self._db.user.find({'emailsSent.mailjetMessageId': {'$exists': True}})
+            })
+
+    @mock.patch(focus_email.mail.__name__ + '.MAX_MESSAGES_PER_CALL', 1)
+    @mock.patch(focus_email.mail.__name__ + '.send_templates')
+    def test_record_sent_emails_on_error(self, mock_mail):
+        """Record the emails already sent when the campaign stops on an error."""
+        def _send_templates_or_fail(template_id, recipients_and_vars, **kwargs):
+            if recipients_and_vars[0][0].name == '2 user':
+                raise ValueError('Oops')
+            return _send_templates(template_id, recipients_and_vars, **kwargs)
+        mock_mail.side_effect = _send_templates_or_fail
+
+        with self.assertRaises(ValueError):
+            focus_email.blast_campaign('focus-network', 'send', '2017-01-01', '2017-12-31')
+
+        self.assertEqual(7, mock_mail.call_count)
+        self.assertEqual(
+            ['3', '4', '5', '6', '7', '8'],
+            sorted(
+                user['_id']
+                for user in self._db.user.find({'emailsSent.mailjetMessageId': {'$exists': True}})))
+
+    @mock.patch(focus_email.report.__name__ + '.notify_slack')
+    @mock.patch(focus_email.mail.__name__ + '.send_templates')
+    def test_send_errors(self, mock_mail, mock_notify_slack):
+        """Count the emails that could not be sent."""
+        mock_mail().status_code = 500
+        mock_mail.reset_mock()
+
+        self.assertEqual(
+            0, focus_email.blast_campaign('focus-network', 'send', '2017-04-01', '2017-07-10'))
+
+        self.assertIn('(and got 3', mock_notify_slack.call_args[0][0])
+        self.assertFalse(self._db.user.find_one({'_id': '4'}).get('emailsSent'))
+
+    @mock.patch(focus_email.mail.__name__ + '.send_template')
+    def test_dry_run(self, mock_mail):
+        """Send only one email to the tester on dry runs."""
+        mock_mail().json.return_value = {'Sent': [{'MessageID': 18014679230180635}]}
+        mock_mail.reset_mock()
+
+        self.assertEqual(1, focus_email.blast_campaign(
+            'focus-network', 'dry-run', '2017-04-01', '2017-07-10',
+            dry_run_email='tester@example.com'))
+
+        mock_mail.assert_called_once()
+        self.assertEqual('tester@example.com', mock_mail.call_args[0][1].email)
+        self.assertFalse(self._db.user.find_one({'_id': '4'}).get('emailsSent'))
+
 
 class StripDistrictTestCase(unittest.TestCase):
     """Unit tests for the strip_district method."""
@@ -26,7 +26,7 @@ _USER_PENDING_NPS_DICT = {
 
 
 @mock.patch(mail_nps.report.__name__ + '.mail')
-@mock.patch(mail_nps.__name__ + '.mail')
+@mock.patch(mail_nps.outbox.__name__ + '.enqueue')
 class MailingTestCase(unittest.TestCase):
     """Unit tests."""
 
@@ -36,7 +36,7 @@ class MailingTestCase(unittest.TestCase):
         self._db = mongomock.MongoClient().database
         self._now = datetime.datetime(2016, 11, 24, 10, 0, 0)
 
-    def test_main(self, mock_mail, mock_report_mail):
+    def test_main(self, mock_enqueue, mock_report_mail):
         """Overall test."""
         self._db.user.insert_one({
             'profile': {
@@ -52,12 +52,15 @@ class MailingTestCase(unittest.TestCase):
                 'title': 'Project Title',
             }],
         })
-        mock_mail.send_template.return_value.status_code = 200
+        mock_enqueue.return_value = True
         mock_report_mail.send_template_to_admins.return_value.status_code = 200
 
         mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '1')
-        self.assertTrue(mock_mail.send_template.called)
-        template_id, profile, template_vars = mock_mail.send_template.call_args[0]
+        self.assertTrue(mock_enqueue.called)
+        database, key, template_id, profile, template_vars = mock_enqueue.call_args[0]
+        self.assertEqual(self._db, database)
+        user_id = self._db.user.find_one()['_id']
+        self.assertEqual('nps:{}'.format(user_id), key)
         self.assertEqual('100819', template_id)
         self.assertEqual('pascal+test@bayes.org', profile.email)
         self.assertEqual(
@@ -70,9 +73,9 @@ class MailingTestCase(unittest.TestCase):
             template_vars)
         self.assertTrue(mock_report_mail.send_template_to_admins.called)
 
-    def test_too_soon(self, mock_mail, mock_report_mail):
+    def test_too_soon(self, mock_enqueue, mock_report_mail):
         """Test that we do not send the NPS email if the user registered recently."""
-        mock_mail.send_template.return_value.status_code = 200
+        mock_enqueue.return_value = True
         mock_report_mail.send_template_to_admins.return_value.status_code = 200
         self._db.user.insert_one(
             dict(
@@ -81,10 +84,10 @@ class MailingTestCase(unittest.TestCase):
 
         mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '0')
 
-        self.assertFalse(mock_mail.send_template.called)
+        self.assertFalse(mock_enqueue.called)
         self.assertTrue(mock_report_mail.send_template_to_admins.called)
 
-    def test_no_incomplete(self, mock_mail, mock_report_mail):
+    def test_no_incomplete(self, mock_enqueue, mock_report_mail):
         """Do not send if project is not complete."""
         self._db.user.insert_one({
             'profile': {
@@ -101,34 +104,62 @@ class MailingTestCase(unittest.TestCase):
                 'isIncomplete': True,
             }],
         })
-        mock_mail.send_template.return_value.status_code = 200
+        mock_enqueue.return_value = True
         mock_report_mail.send_template_to_admins.return_value.status_code = 200
 
         mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '1')
-        self.assertFalse(mock_mail.send_template.called)
+        self.assertFalse(mock_enqueue.called)
 
-    def test_no_dupes(self, mock_mail, mock_report_mail):
+    def test_no_dupes(self, mock_enqueue, mock_report_mail):
         """Test that we do not send duplicate emails if we run the script twice."""
-        mock_mail.send_template.return_value.status_code = 200
+        mock_enqueue.return_value = True
         mock_report_mail.send_template_to_admins.return_value.status_code = 200
         self._db.user.insert_one(_USER_PENDING_NPS_DICT)
 
         mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '1')
 
-        self.assertTrue(mock_mail.send_template.called)
+        self.assertTrue(mock_enqueue.called)
         self.assertTrue(mock_report_mail.send_template_to_admins.called)
-        mock_mail.send_template.reset_mock()
+        mock_enqueue.reset_mock()
         mock_report_mail.send_template_to_admins.reset_mock()
 
         # Running the script again 10 minutes later.
         mail_nps.main(
             self._db.user, 'http://localhost:3000', self._now + datetime.timedelta(minutes=10), '1')
-        self.assertFalse(mock_mail.send_template.called)
+        self.assertFalse(mock_enqueue.called)
         self.assertTrue(mock_report_mail.send_template_to_admins.called)
 
-    def test_signal(self, mock_mail, mock_report_mail):
+    def test_already_in_outbox(self, mock_enqueue, mock_report_mail):
+        """Do not count emails enqueued by a previous run, but mark them as sent."""
+        mock_enqueue.return_value = False
+        mock_report_mail.send_template_to_admins.return_value.status_code = 200
+        self._db.user.insert_one(dict(_USER_PENDING_NPS_DICT))
+
+        with mock.patch(mail_nps.report.__name__ + '.notify_slack') as mock_notify_slack:
+            mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '1')
+
+        self.assertTrue(mock_enqueue.called)
+        self.assertIn("I've enqueued 0 emails", mock_notify_slack.call_args[0][0])
+        self.assertEqual(
+            'NPS_EMAIL_SENT',
+            self._db.user.find_one()['featuresEnabled']['netPromoterScoreEmail'])
+
+    def test_dry_run(self, mock_enqueue, mock_report_mail):
+        """Do not enqueue anything nor update users in dry run mode."""
+        mail_nps.DRY_RUN = True
+        mock_report_mail.send_template_to_admins.return_value.status_code = 200
+        self._db.user.insert_one(dict(_USER_PENDING_NPS_DICT))
+
+        mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '1')
+
+        self.assertFalse(mock_enqueue.called)
+        self.assertEqual(
+            'NPS_EMAIL_PENDING',
+            self._db.user.find_one()['featuresEnabled']['netPromoterScoreEmail'])
+
+    def test_signal(self, mock_enqueue, mock_report_mail):
         """Test that the batch send fails gracefully on SIGTERM."""
-        mock_mail.send_template.return_value.status_code = 200
+        mock_enqueue.return_value = True
         mock_report_mail.send_template_to_admins.return_value.status_code = 200
         self._db.user.insert_many([
             dict(
@@ -144,7 +175,7 @@ class MailingTestCase(unittest.TestCase):
 
         mail_nps.main(db_user, 'http://localhost:3000', self._now, '1')
 
-        self.assertEqual(4, mock_mail.send_template.call_count)
+        self.assertEqual(4, mock_enqueue.call_count)
         self.assertEqual(4, db_user.update_one.call_count)
         self.assertTrue(mock_report_mail.send_template_to_admins.called)
 
@@ -0,0 +1,35 @@
+"""Tests for the bob_emploi.frontend.asynchronous.send_outbox module."""
+import unittest
+
+import mock
+import mongomock
+
+from bob_emploi.frontend import outbox
+from bob_emploi.frontend.api import user_pb2
+from bob_emploi.frontend.asynchronous import send_outbox
+
+
+class SendOutboxTestCase(unittest.TestCase):
+    """Unit tests for the send_outbox script."""
+
+    @mock.patch(outbox.mail.__name__ + '.send_template')
+    def test_once(self, mock_send_template):
+        """Send all the emails of the outbox and stop."""
+        mock_send_template().status_code = 200
+        mock_send_template.reset_mock()
+        database = mongomock.MongoClient().test
+        for index in range(3):
+            outbox.enqueue(
+                database, 'key-{:d}'.format(index), '1234',
+                user_pb2.UserProfile(email='{:d}@example.com'.format(index)), {})
+        mock_sleep = mock.MagicMock()
+
+        send_outbox.main(['--once', '--rate', '1000'], database=database, sleep=mock_sleep)
+
+        self.assertEqual(3, mock_send_template.call_count)
+        self.assertEqual(0, outbox.count_pending(database))
+        mock_sleep.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
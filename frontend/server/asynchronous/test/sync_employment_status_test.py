@@ -4,16 +4,21 @@ import os
 from urllib import parse
 import unittest
 
+import mock
+import mongomock
 import requests_mock
 
+from bob_emploi.frontend import auth
 from bob_emploi.frontend.asynchronous import sync_employment_status
 from bob_emploi.frontend.api import user_pb2
+from bob_emploi.frontend.test import mongomock_helpers
 
 
 class MainTestCase(unittest.TestCase):
     """Unit tests for the sync_employment_status module."""
 
     def setUp(self):
+        super(MainTestCase, self).setUp()
         self.since_timestamp = 13451345543
         self.limit = 200
         response_filename = os.path.join(os.path.dirname(__file__), 'typeform_api_response.json')
@@ -30,13 +35,13 @@ class MainTestCase(unittest.TestCase):
         }
 
     # TODO(benoit): Remove logic in tests.
-    def _build_typeform_url(self, offset=0):
+    def _build_typeform_url(self, offset=0, survey_id=None, since_timestamp=None):
         """Build typeform API url to call."""
         return sync_employment_status.TYPEFORM_API_URL.format(
-            self.survey['id'],
+            survey_id or self.survey['id'],
             parse.urlencode({
                 'key': sync_employment_status.TYPEFORM_API_KEY,
-                'since': self.since_timestamp,
+                'since': since_timestamp or self.since_timestamp,
                 'completed': 'true',
                 'offset': offset,
                 'limit': self.limit
@@ -118,5 +123,155 @@ class MainTestCase(unittest.TestCase):
                 [self.survey], self.since_timestamp, dry_run=True,
                 nb_responses_per_call=self.limit))
 
+    def _make_response(self, user_id, token, survey_index='0'):
+        return {
+            'hidden': {'user': user_id, 'token': token, 'id': survey_index},
+            'answers': {
+                'list_ZG8hSuiwD3YY_choice': "J'ai un travail",
+                'list_FInQVJzQr71J_choice': 'Oui, vraiment décisif',
+            },
+        }
+
+    @mock.patch(sync_employment_status.__name__ + '.time')
+    @requests_mock.mock()
+    def test_sync_in_database(self, mock_time, mock_requests):
+        """Update users in bulk and only fetch new responses on the next sync."""
+        mock_time.time.return_value = 1500000000
+        database = mongomock.MongoClient().test
+        bulk_write_patcher = mongomock_helpers.patch_bulk_write(database.user)
+        bulk_write_patcher.start()
+        self.addCleanup(bulk_write_patcher.stop)
+        user_ids = [str(mongomock.ObjectId()) for unused_index in range(3)]
+        database.user.insert_many([
+            {
+                '_id': mongomock.ObjectId(user_ids[0]),
+                'employment_status': [{'seeking': 'STILL_SEEKING', 'createdAt': 'yesterday'}],
+            },
+            # Never landed on the survey.
+            {'_id': mongomock.ObjectId(user_ids[1])},
+        ])
+        mock_requests.get(
+            self._build_typeform_url(),
+            status_code=200,
+            json={
+                'questions': self.typeform_response_json['questions'],
+                'responses': [
+                    self._make_response(
+                        user_id, auth.create_token(user_id, role='employment-status'))
+                    for user_id in user_ids[:2]
+                ] + [self._make_response(user_ids[2], 'wrong.token')],
+            },
+        )
+        other_survey = dict(self.survey, id='other')
+        mock_requests.get(self._build_typeform_url(survey_id='other'), status_code=500)
+
+        with mock.patch(sync_employment_status.logging.__name__ + '.error'):
+            counters = sync_employment_status.sync_employment_status(
+                [self.survey, other_survey], self.since_timestamp, dry_run=False,
+                nb_responses_per_call=self.limit, database=database)
+
+        self.assertEqual(
+            {
+                'nb_responses': 3,
+                'nb_users_to_update': 3,
+                'nb_users_updated': 1,
+                'nb_errors': 3,
+            },
+            counters)
+        self.assertEqual(
+            [{
+                'seeking': 'STOP_SEEKING',
+                'createdAt': 'yesterday',
+                'situation': 'WORKING',
+                'bobHasHelped': 'YES_A_LOT',
+            }],
+            database.user.find_one({'_id': mongomock.ObjectId(user_ids[0])})['employment_status'])
+        self.assertNotIn(
+            'employment_status', database.user.find_one({'_id': mongomock.ObjectId(user_ids[1])}))
+        # The cursor is only saved for the survey that was synced, with the
+        # response that could not be saved yet.
+        cursors = list(database.typeform_sync_cursors.find())
+        self.assertEqual(['jEnbMx'], [cursor['_id'] for cursor in cursors])
+        self.assertEqual(1500000000, cursors[0]['since'])
+        self.assertEqual([user_ids[1]], [response['user'] for response in cursors[0]['pending']])
+
+        # Next sync, once the second user has landed on the survey.
+        database.user.update_one(
+            {'_id': mongomock.ObjectId(user_ids[1])},
+            {'$set': {'employment_status': [{'seeking': 'STILL_SEEKING'}]}})
+        mock_time.time.return_value = 1500003600
+        mock_requests.get(
+            self._build_typeform_url(since_timestamp=1500000000),
+            status_code=200,
+            json={
+                'questions': self.typeform_response_json['questions'],
+                # Fetched again, but already saved.
+                'responses': [self._make_response(
+                    user_ids[0], auth.create_token(user_ids[0], role='employment-status'))],
+            },
+        )
+        counters = sync_employment_status.sync_employment_status(
+            [self.survey], self.since_timestamp, dry_run=False,
+            nb_responses_per_call=self.limit, database=database)
+        self.assertEqual(
+            {
+                'nb_responses': 1,
+                'nb_users_to_update': 2,
+                'nb_users_updated': 1,
+                'nb_errors': 0,
+            },
+            counters)
+        self.assertIn('since=1500000000', mock_requests.last_request.url)
+        self.assertEqual(
+            'STOP_SEEKING',
+            database.user.find_one(
+                {'_id': mongomock.ObjectId(user_ids[1])})['employment_status'][0]['seeking'])
+        # The first user was not updated again.
+        self.assertEqual(
+            1,
+            database.user.find_one({'_id': mongomock.ObjectId(user_ids[0])})['_externalRevision'])
+        self.assertEqual(
+            [{'_id': 'jEnbMx', 'since': 1500003600, 'pending': []}],
+            list(database.typeform_sync_cursors.find()))
+
+    @mock.patch(sync_employment_status.__name__ + '.time')
+    @requests_mock.mock()
+    def test_give_up_pending_responses(self, mock_time, mock_requests):
+        """Stop trying to save responses after a while."""
+        mock_time.time.return_value = 1500000000
+        database = mongomock.MongoClient().test
+        bulk_write_patcher = mongomock_helpers.patch_bulk_write(database.user)
+        bulk_write_patcher.start()
+        self.addCleanup(bulk_write_patcher.stop)
+        user_id = str(mongomock.ObjectId())
+        database.typeform_sync_cursors.insert_one({
+            '_id': 'jEnbMx',
+            'since': 1499990000,
+            'pending': [{
+                'user': user_id,
+                'token': auth.create_token(user_id, role='employment-status'),
+                'id': '0',
+                'seeking': user_pb2.STOP_SEEKING,
+                'situation': 'WORKING',
+                'bobHasHelped': 'YES_A_LOT',
+                'fetchedAt': 1490000000,
+            }],
+        })
+        mock_requests.get(
+            self._build_typeform_url(since_timestamp=1499990000),
+            status_code=200,
+            json={'questions': self.typeform_response_json['questions'], 'responses': []},
+        )
+
+        with mock.patch(sync_employment_status.logging.__name__ + '.warning') as mock_warning:
+            counters = sync_employment_status.sync_employment_status(
+                [self.survey], self.since_timestamp, dry_run=False,
+                nb_responses_per_call=self.limit, database=database)
+
+        self.assertEqual(1, counters['nb_errors'])
+        mock_warning.assert_called_once()
+        self.assertEqual([], database.typeform_sync_cursors.find_one()['pending'])
+
+
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
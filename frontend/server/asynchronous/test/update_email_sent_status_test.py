@@ -1,42 +1,59 @@
 """Tests for the update_email_sent_status module."""
+import datetime
 import unittest
 
 import mock
 import mongomock
 
 from bob_emploi.frontend.asynchronous import update_email_sent_status
+from bob_emploi.frontend.test import mongomock_helpers
 
 
+@mock.patch(update_email_sent_status.__name__ + '.mail')
 class MainTestCase(unittest.TestCase):
     """Unit tests for the update_email_sent_status module."""
 
-    @mock.patch(update_email_sent_status.__name__ + '.mail')
+    def setUp(self):
+        super(MainTestCase, self).setUp()
+        self.database = mongomock.MongoClient().test
+        bulk_write_patcher = mongomock_helpers.patch_bulk_write(self.database.user)
+        bulk_write_patcher.start()
+        self.addCleanup(bulk_write_patcher.stop)
+
     def test_no_message_id(self, mock_mail):
         """Test retrieving info when message ID is missing."""
-        mock_mail.list_messages.return_value = [
+        mock_mail.list_messages_sent_between.return_value = [
             {
-                'ArrivedAt': '2017-09-18T09:25:46Z',
+                'ArrivedAt': '2017-09-08T09:27:46Z',
+                'ContactAlt': 'pascal@example.com',
                 'ID': 12345,
-                'Comment': 'Other message, at a different date',
+                'Comment': 'Other message, 2 minutes later',
                 'Status': 'opened',
             },
             {
                 'ArrivedAt': '2017-09-08T09:25:48Z',
+                'ContactAlt': 'other@example.com',
+                'ID': 4567,
+                'Comment': 'Message to another user at the same time',
+                'Status': 'sent',
+            },
+            {
+                'ArrivedAt': '2017-09-08T09:25:48Z',
+                'ContactAlt': 'Pascal@Example.com',
                 'ID': 6789,
                 'Comment': 'Right message, arrived 2 seconds after being sent',
                 'Status': 'bounce',
             },
         ]
-        database = mongomock.MongoClient().test
-        database.user.insert_one({
+        self.database.user.insert_one({
             'other': 'field',
             'profile': {'email': 'pascal@example.com'},
             'emailsSent': [{
                 'sentAt': '2017-09-08T09:25:46.145001Z',
             }],
         })
-        update_email_sent_status.main(database)
-        updated_data = database.user.find_one()
+        update_email_sent_status.main(self.database)
+        updated_data = self.database.user.find_one()
         self.assertEqual('field', updated_data.get('other'))
         self.assertEqual(
             6789, int(updated_data.get('emailsSent')[0].get('mailjetMessageId')))
@@ -44,17 +61,16 @@ class MainTestCase(unittest.TestCase):
             'EMAIL_SENT_BOUNCE',
             updated_data.get('emailsSent')[0].get('status'))
 
-    @mock.patch(update_email_sent_status.__name__ + '.mail')
     def test_with_message_id(self, mock_mail):
         """Test retrieving info when message ID is present."""
-        mock_mail.get_message.return_value.json.return_value = {
+        mock_mail.list_messages_sent_between.return_value = [{
             'ArrivedAt': '2017-09-08T09:25:48Z',
+            'ContactAlt': 'pascal@example.com',
             'ID': 6789,
             'Comment': 'Right message, arrived 2 seconds after being sent',
             'Status': 'opened',
-        }
-        database = mongomock.MongoClient().test
-        database.user.insert_one({
+        }]
+        self.database.user.insert_one({
             'other': 'field',
             'profile': {'email': 'pascal@example.com'},
             'emailsSent': [{
@@ -62,8 +78,8 @@ class MainTestCase(unittest.TestCase):
                 'mailjetMessageId': 6789,
             }],
         })
-        update_email_sent_status.main(database)
-        updated_data = database.user.find_one()
+        update_email_sent_status.main(self.database)
+        updated_data = self.database.user.find_one()
         self.assertEqual('field', updated_data.get('other'))
         self.assertEqual(
             6789, int(updated_data.get('emailsSent')[0].get('mailjetMessageId')))
@@ -71,6 +87,105 @@ class MainTestCase(unittest.TestCase):
             'EMAIL_SENT_OPENED',
             updated_data.get('emailsSent')[0].get('status'))
 
+    def test_email_sent_meanwhile(self, mock_mail):
+        """Do not overwrite the emails sent while checking the status of the previous ones."""
+        def _list_messages_and_send_email(unused_start, unused_end):
+            self.database.user.update_one(
+                {}, {'$push': {'emailsSent': {'sentAt': '2017-09-09T09:00:00Z'}}})
+            return [{
+                'ArrivedAt': '2017-09-08T09:25:48Z',
+                'ContactAlt': 'pascal@example.com',
+                'ID': 6789,
+                'Status': 'opened',
+            }]
+        mock_mail.list_messages_sent_between.side_effect = _list_messages_and_send_email
+        self.database.user.insert_one({
+            'profile': {'email': 'pascal@example.com'},
+            'emailsSent': [{
+                'sentAt': '2017-09-08T09:25:46Z',
+                'mailjetMessageId': 6789,
+            }],
+        })
+
+        update_email_sent_status.main(self.database)
+
+        emails_sent = self.database.user.find_one()['emailsSent']
+        self.assertEqual(
+            ['2017-09-08T09:25:46Z', '2017-09-09T09:00:00Z'],
+            [email_sent['sentAt'] for email_sent in emails_sent])
+        self.assertEqual('EMAIL_SENT_OPENED', emails_sent[0].get('status'))
+
+    def test_time_slices(self, mock_mail):
+        """List messages from MailJet only around the time emails were sent."""
+        mock_mail.list_messages_sent_between.return_value = []
+        self.database.user.insert_many([
+            {
+                'profile': {'email': 'pascal@example.com'},
+                'emailsSent': [
+                    {'sentAt': '2017-09-08T09:25:46Z'},
+                    {'sentAt': '2017-09-08T10:25:46Z'},
+                    {'sentAt': '2017-09-08T10:30:00Z', 'status': 'EMAIL_SENT_OPENED'},
+                ],
+            },
+            {
+                'profile': {'email': 'cyrille@example.com'},
+                # Close to the end of a time slice.
+                'emailsSent': [{'sentAt': '2017-09-12T17:59:46Z'}],
+            },
+        ])
+
+        with mock.patch(update_email_sent_status.logging.__name__ + '.warning') as mock_warning:
+            update_email_sent_status.main(self.database)
+
+        self.assertEqual(
+            [
+                (datetime.datetime(2017, 9, 8, 6), datetime.datetime(2017, 9, 8, 12)),
+                (datetime.datetime(2017, 9, 12, 12), datetime.datetime(2017, 9, 12, 18)),
+                (datetime.datetime(2017, 9, 12, 18), datetime.datetime(2017, 9, 13)),
+            ],
+            sorted(call[0] for call in mock_mail.list_messages_sent_between.call_args_list))
+        mock_warning.assert_called_once_with('Could not find %d messages in MailJet.', 3)
+
+    @mock.patch(update_email_sent_status.__name__ + '._BULK_WRITE_SIZE', 2)
+    def test_bulk_writes(self, mock_mail):
+        """Update many users with a few calls to the database."""
+        mock_mail.list_messages_sent_between.return_value = [
+            {
+                'ArrivedAt': '2017-09-08T09:25:48Z',
+                'ContactAlt': 'user{:d}@example.com'.format(index),
+                'ID': index + 1,
+                'Status': 'opened',
+            }
+            for index in range(5)
+        ]
+        self.database.user.insert_many([
+            {
+                'profile': {'email': 'user{:d}@example.com'.format(index)},
+                'emailsSent': [{'sentAt': '2017-09-08T09:25:46Z'}],
+            }
+            for index in range(5)
+        ])
+        self.database.user.insert_one({
+            'profile': {'email': 'unknown@example.com'},
+            'emailsSent': [{'sentAt': '2017-09-08T09:25:46Z'}],
+        })
+
+        with mock.patch.object(
+                self.database.user, 'bulk_write',
+                wraps=self.database.user.bulk_write) as mock_bulk_write:
+            with mock.patch(update_email_sent_status.logging.__name__ + '.warning'):
+                update_email_sent_status.main(self.database)
+
+        self.assertEqual(3, mock_bulk_write.call_count)
+        self.assertEqual(
+            [1, 2, 3, 4, 5],
+            sorted(
+                int(user['emailsSent'][0]['mailjetMessageId'])
+                for user in self.database.user.find({'emailsSent.status': 'EMAIL_SENT_OPENED'})))
+        self.assertEqual(
+            {'sentAt': '2017-09-08T09:25:46Z'},
+            self.database.user.find_one({'profile.email': 'unknown@example.com'})['emailsSent'][0])
+
 
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
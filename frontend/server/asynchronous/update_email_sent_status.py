@@ -1,4 +1,11 @@
-"""Check the status of sent emails on MailJet and update our Database."""
+"""Check the status of sent emails on MailJet and update our Database.
+
+Instead of querying MailJet for each email, it lists all the messages sent
+around the time our emails were sent, and matches them with our emails by
+message ID, or by recipient and time when the message ID is missing.
+"""
+import collections
+from concurrent import futures
 import datetime
 import logging
 import os
@@ -7,6 +14,7 @@ import pymongo
 from google.protobuf import json_format
 
 from bob_emploi.frontend import mail
+from bob_emploi.frontend import migration
 from bob_emploi.frontend import proto
 from bob_emploi.frontend.api import user_pb2
 
@@ -14,40 +22,86 @@ from bob_emploi.frontend.api import user_pb2
 # and MailJet's clock (tick recorded in ArrivedAt).
 _CLOCK_MAX_SKEW = datetime.timedelta(minutes=2)
 
+# Duration of the time slices in which messages are listed from MailJet. Only
+# the slices in which we sent emails are listed, several of them at once.
+_FETCH_SLICE = datetime.timedelta(hours=6)
+
+# Number of time slices to list from MailJet at the same time.
+_FETCH_WORKERS = 4
+
+# Number of user updates to send to MongoDB at once.
+_BULK_WRITE_SIZE = 500
+
 _DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
     .get_default_database()
 
 
-def _find_message(email_sent, email_address):
-    if email_sent.mailjet_message_id:
-        return mail.get_message(email_sent.mailjet_message_id).json()
+def _get_slice_start(instant):
+    midnight = datetime.datetime.combine(instant.date(), datetime.time())
+    return midnight + (instant - midnight) // _FETCH_SLICE * _FETCH_SLICE
+
+
+def _parse_arrived_at(message):
+    return datetime.datetime.strptime(message.get('ArrivedAt'), '%Y-%m-%dT%H:%M:%SZ')
+
+
+def _fetch_messages(slice_starts):
+    """List the messages sent in some time slices, several slices at once."""
+    def _fetch_slice(start):
+        return list(mail.list_messages_sent_between(start, start + _FETCH_SLICE))
+
+    with futures.ThreadPoolExecutor(max_workers=_FETCH_WORKERS) as executor:
+        return [
+            message
+            for messages in executor.map(_fetch_slice, sorted(slice_starts))
+            for message in messages]
 
-    # We forgot to save the mailjet message ID when we sent it, so we are going
-    # to find it by its recipient and the time it was sent.
-    messages = mail.list_messages(email_address)
-    all_messages = []
-    for message in messages:
-        all_messages.append(message)
-        arrived_at = datetime.datetime.strptime(message.get('ArrivedAt'), '%Y-%m-%dT%H:%M:%SZ')
-        if abs(arrived_at - email_sent.sent_at.ToDatetime()) < _CLOCK_MAX_SKEW:
-            return message
 
-    # Could not find message.
-    return None
+class _MessageIndex(object):
+    """An in-memory index of MailJet messages to match them with our emails."""
 
+    def __init__(self, messages):
+        self._by_id = {}
+        self._by_recipient = collections.defaultdict(list)
+        for message in messages:
+            self._by_id[message.get('ID')] = message
+            recipient = message.get('ContactAlt')
+            if recipient:
+                self._by_recipient[recipient.lower()].append(message)
 
-def _update_email_sent_status(email_sent_dict, email_address):
-    email_sent = user_pb2.EmailSent()
-    proto.parse_from_mongo(email_sent_dict, email_sent)
-    if email_sent.status != user_pb2.EMAIL_SENT_UNKNOWN:
-        # TODO(pascal): Check the status again if too old.
-        return email_sent_dict
+    def __len__(self):
+        return len(self._by_id)
 
-    message = _find_message(email_sent, email_address)
-    if not message:
-        logging.warning('Could not find a message in MailJet.')
-        return email_sent_dict
+    def find_message(self, email_sent, email_address):
+        """Find the MailJet message of an email that we sent, or None."""
+        if email_sent.mailjet_message_id:
+            return self._by_id.get(email_sent.mailjet_message_id)
 
+        # We forgot to save the mailjet message ID when we sent it, so we are
+        # going to find it by its recipient and the time it was sent.
+        sent_at = email_sent.sent_at.ToDatetime()
+        best_message = None
+        best_skew = _CLOCK_MAX_SKEW
+        for message in self._by_recipient.get((email_address or '').lower(), []):
+            skew = abs(_parse_arrived_at(message) - sent_at)
+            if skew < best_skew:
+                best_message = message
+                best_skew = skew
+        return best_message
+
+
+def _iter_unknown_emails(user):
+    """Iterate over the emails sent to a user for which we do not know the status."""
+    for index, email_sent_dict in enumerate(user.get('emailsSent', [])):
+        email_sent = user_pb2.EmailSent()
+        proto.parse_from_mongo(email_sent_dict, email_sent)
+        if email_sent.status != user_pb2.EMAIL_SENT_UNKNOWN:
+            # TODO(pascal): Check the status again if too old.
+            continue
+        yield index, email_sent
+
+
+def _update_email_sent_status(email_sent, message):
     email_sent.mailjet_message_id = message.get('ID', email_sent.mailjet_message_id)
     email_sent.last_status_checked_at.GetCurrentTime()
     email_sent.last_status_checked_at.nanos = 0
@@ -56,20 +110,54 @@ def _update_email_sent_status(email_sent_dict, email_address):
     return json_format.MessageToDict(email_sent)
 
 
+def _write_updates(database, updates):
+    if updates:
+        database.user.bulk_write(updates, ordered=False)
+    del updates[:]
+
+
 def main(database):
     """Check the status of sent emails on MailJet and update our Database."""
-    selected_users = database.user.find({
-        'emailsSent': {'$exists': True},
-        'emailsSent.status': {'$exists': False},
-    }, {'profile.email': 1, 'emailsSent': 1})
+    selected_users = list(database.user.find(
+        {'emailsSent': {'$elemMatch': {'status': {'$exists': False}}}},
+        {'profile.email': 1, 'emailsSent': 1}))
+
+    slice_starts = set()
+    for user in selected_users:
+        for unused_index, email_sent in _iter_unknown_emails(user):
+            sent_at = email_sent.sent_at.ToDatetime()
+            slice_starts.add(_get_slice_start(sent_at - _CLOCK_MAX_SKEW))
+            slice_starts.add(_get_slice_start(sent_at + _CLOCK_MAX_SKEW))
+    messages = _MessageIndex(_fetch_messages(slice_starts))
+
+    updates = []
+    counts = collections.Counter()
     for user in selected_users:
-        emails_sent = user.get('emailsSent', [])
-        updated_emails_sent = [
-            _update_email_sent_status(email, user.get('profile', {}).get('email'))
-            for email in emails_sent]
-        database.user.update_one(
-            {'_id': user['_id']},
-            {'$set': {'emailsSent': updated_emails_sent}})
+        # Emails are only appended to emailsSent, so the ones at those indices
+        # are still the same even if others were sent since they were read.
+        updated_emails = {}
+        email_address = user.get('profile', {}).get('email')
+        for index, email_sent in _iter_unknown_emails(user):
+            message = messages.find_message(email_sent, email_address)
+            if not message:
+                counts['missing'] += 1
+                continue
+            updated_emails['emailsSent.{:d}'.format(index)] = \
+                _update_email_sent_status(email_sent, message)
+            counts['updated'] += 1
+        if not updated_emails:
+            continue
+        updates.append(pymongo.UpdateOne(
+            {'_id': user['_id']}, migration.mark_external_update({'$set': updated_emails})))
+        if len(updates) >= _BULK_WRITE_SIZE:
+            _write_updates(database, updates)
+    _write_updates(database, updates)
+
+    if counts['missing']:
+        logging.warning('Could not find %d messages in MailJet.', counts['missing'])
+    logging.info(
+        '%d email statuses updated from %d messages in %d time slices.',
+        counts['updated'], len(messages), len(slice_starts))
 
 
 if __name__ == '__main__':
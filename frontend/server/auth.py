@@ -6,7 +6,6 @@ import functools
 import hashlib
 import hmac
 import json
-import logging
 import os
 import random
 import time
@@ -17,7 +16,7 @@ import flask
 from oauth2client import client
 from oauth2client import crypt
 
-from bob_emploi.frontend import mail
+from bob_emploi.frontend import outbox
 from bob_emploi.frontend import proto
 from bob_emploi.frontend.api import user_pb2
 
@@ -300,11 +299,9 @@ class Authenticator(object):
             'resetLink': reset_link,
             'firstName': user_profile.name,
         }
-        result = mail.send_template(
-            '71254', user_profile, template_vars, monitoring_category='reset_password')
-        if result.status_code != 200:
-            logging.error('Failed to send an email with MailJet:\n %s', result.text)
-            flask.abort(result.status_code)
+        outbox.enqueue(
+            self._db, 'reset-password:{}'.format(auth_token), '71254', user_profile,
+            template_vars, monitoring_category='reset_password')
 
 
 def create_token(email, role=''):
@@ -1,42 +1,44 @@
 """Module to get information on companies."""
 import logging
-import requests
+
 import xmltodict
 
+from bob_emploi.frontend import http_client
 from bob_emploi.frontend.api import training_pb2
 
 _CARIF_URL = 'http://www.intercariforef.org/serviceweb2/offre-info/?versionLHEO=2.2&typeListe=max'
 
+# Number of seconds to wait for the intercarif API.
+_CARIF_TIMEOUT = 5
+
 
 def _make_key(title, city):
     """Create a unique key for a training."""
     return title + city
 
 
-def get_trainings(rome_id, departement_id):
-    """Helper function to get trainings from the CARIF API.
+def fetch_trainings(rome_id, departement_id):
+    """Fetch trainings from the CARIF API.
 
     Carif sends us multiple trainings that have the same city and title, this function only return
     one training per city/title.
+
+    Raises:
+        IOError: if the API failed.
     """
     no_trainings = []
 
-    try:
-        xml = requests.get(
-            _CARIF_URL, params={'idsMetiers': rome_id, 'code-departement': departement_id})
-    except requests.exceptions.ConnectionError as error:
-        logging.warning('XML request for intercarif failed:\n%s', error)
-        return no_trainings
+    xml = http_client.get(
+        _CARIF_URL, params={'idsMetiers': rome_id, 'code-departement': departement_id},
+        timeout=_CARIF_TIMEOUT)
 
     trainings = []
 
     if xml.status_code != 200:
-        logging.warning('XML request for intercarif failed with error code %d', xml.status_code)
-        return no_trainings
+        raise IOError('Error code {:d}'.format(xml.status_code))
 
     if not xml.text:
-        logging.warning('XML request for intercarif failed, there is no text in the response.')
-        return no_trainings
+        raise IOError('There is no text in the response.')
 
     # Intercarif does not provide an encoding in the response header which misleads the xmltodict
     # module.
@@ -1,35 +1,67 @@
 """Module to get inforomation on companies."""
+import functools
 import logging
 import os
 
 import emploi_store
 
+from bob_emploi.frontend import fetcher
 from bob_emploi.frontend.api import company_pb2
 
 _EMPLOI_STORE_DEV_CLIENT_ID = os.getenv('EMPLOI_STORE_CLIENT_ID')
 _EMPLOI_STORE_DEV_SECRET = os.getenv('EMPLOI_STORE_CLIENT_SECRET')
 
 
+# The client is shared so that its access tokens are reused across calls.
+@functools.lru_cache(maxsize=1)
+def _get_client():
+    return emploi_store.Client(
+        client_id=_EMPLOI_STORE_DEV_CLIENT_ID,
+        client_secret=_EMPLOI_STORE_DEV_SECRET)
+
+
+def _fetch_lbb_companies(city_id, rome_id):
+    return list(_get_client().get_lbb_companies(city_id=city_id, rome_codes=[rome_id]))
+
+
+_LBB_COMPANIES = fetcher.CachedFetcher(_fetch_lbb_companies, name='LBB companies')
+
+
+def _has_identifiers():
+    return bool(_EMPLOI_STORE_DEV_CLIENT_ID and _EMPLOI_STORE_DEV_SECRET)
+
+
+def prefetch_lbb_companies(project):
+    """Start retrieving the companies for a project from LaBonneBoite API."""
+    if _has_identifiers():
+        _LBB_COMPANIES.prefetch(
+            project.mobility.city.city_id, project.target_job.job_group.rome_id)
+
+
 def get_lbb_companies(project):
     """Retrieve a list of companies from LaBonneBoite API."""
-    if not _EMPLOI_STORE_DEV_CLIENT_ID or not _EMPLOI_STORE_DEV_SECRET:
+    if not _has_identifiers():
         logging.warning('Missing Emploi Store Dev identifiers.')
-        return
-
-    client = emploi_store.Client(
-        client_id=_EMPLOI_STORE_DEV_CLIENT_ID,
-        client_secret=_EMPLOI_STORE_DEV_SECRET)
+        return []
+    city_id = project.mobility.city.city_id
+    rome_id = project.target_job.job_group.rome_id
     try:
-        companies = client.get_lbb_companies(
-            city_id=project.mobility.city.city_id,
-            rome_codes=[project.target_job.job_group.rome_id])
-        for company in companies:
-            yield company
+        return _LBB_COMPANIES.get_value(city_id, rome_id) or []
     except (IOError, ValueError) as error:
+        # Errors are not cached so the next call will try again.
         logging.error(
-            'Error while calling LBB API: %s\nCity: %s\nJob group: %s',
-            error, project.mobility.city.city_id, project.target_job.job_group)
-        return
+            'Error while calling LBB API: %s\nCity: %s\nJob group: %s', error, city_id, rome_id)
+        return []
+
+
+def clear_cache():
+    """Clear all caches for this module."""
+    _LBB_COMPANIES.reset_cache()
+
+
+def get_cache_stats():
+    """Get the number of hits and misses of the caches of this module, by cache name."""
+    return {'lbb_companies': (_LBB_COMPANIES.hits, _LBB_COMPANIES.misses)}
 
 
 def to_proto(company_json):
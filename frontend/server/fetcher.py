@@ -0,0 +1,101 @@
+"""Module to fetch data from our partners' APIs."""
+import collections
+from concurrent import futures
+import datetime
+import logging
+import threading
+
+# Pool of threads to call partners' APIs while we do something else.
+_EXECUTOR = futures.ThreadPoolExecutor(max_workers=16)
+
+_CACHE_DURATION = datetime.timedelta(hours=1)
+
+
+class _Fetch(object):
+
+    def __init__(self, future, valid_until):
+        self.future = future
+        self.valid_until = valid_until
+        self.has_timed_out = False
+
+    def is_valid(self, now):
+        """Whether this fetch is still pending or has a fresh result."""
+        if not self.future.done():
+            return True
+        # Errors are not cached: the next call retries.
+        return self.valid_until > now and not self.future.exception()
+
+
+class CachedFetcher(object):
+    """A cache of data fetched from a slow partner API.
+
+    Each key is fetched in a pool of threads so that callers can start the
+    fetch early and get the result later. Concurrent requests for the same key
+    share the same fetch, results are kept for a while, and callers never wait
+    more than a given timeout: a slow API costs at most one timeout per key.
+    """
+
+    def __init__(
+            self, fetch, timeout=5, cache_duration=_CACHE_DURATION, max_size=1000, name=None):
+        """Creates a new fetcher.
+
+        Args:
+            fetch: the function to fetch a value. It is called with the key
+                parts as arguments.
+            timeout: the maximum number of seconds to wait for a value.
+            cache_duration: a timedelta for how long to keep a value.
+            max_size: the maximum number of values to keep.
+            name: a name for the data, used in logs.
+        """
+        self._fetch = fetch
+        self._timeout = timeout
+        self._cache_duration = cache_duration
+        self._max_size = max_size
+        self._name = name or fetch.__name__
+        self._fetches = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _start(self, key):
+        now = datetime.datetime.now()
+        with self._lock:
+            fetch = self._fetches.get(key)
+            if fetch and fetch.is_valid(now):
+                self._fetches.move_to_end(key)
+                self.hits += 1
+                return fetch
+            self.misses += 1
+            fetch = _Fetch(_EXECUTOR.submit(self._fetch, *key), now + self._cache_duration)
+            self._fetches[key] = fetch
+            while len(self._fetches) > self._max_size:
+                self._fetches.popitem(last=False)
+            return fetch
+
+    def prefetch(self, *key):
+        """Start fetching the value for a key in the background."""
+        self._start(key)
+
+    def get_value(self, *key):
+        """Get the value for a key.
+
+        Returns:
+            the fetched value, or None if it is not available in time.
+        Raises:
+            the error raised by the fetch function, if any. Errors are not
+            cached: callers should handle them, e.g. with a default value.
+        """
+        fetch = self._start(key)
+        if fetch.has_timed_out and not fetch.future.done():
+            return None
+        try:
+            return fetch.future.result(timeout=self._timeout)
+        except futures.TimeoutError:
+            fetch.has_timed_out = True
+            logging.warning('Timeout while fetching %s for %s', self._name, key)
+            return None
+
+    def reset_cache(self):
+        """Forget all fetched values."""
+        with self._lock:
+            self._fetches.clear()
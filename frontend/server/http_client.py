@@ -0,0 +1,162 @@
+"""Module to call external HTTP APIs.
+
+All calls share a pool of connections per host, have default timeouts, are
+retried a few times on network errors, and stop for a while when a host keeps
+failing.
+"""
+import collections
+import logging
+import random
+import threading
+import time
+from urllib import parse
+
+import requests
+from requests import adapters
+
+# Default timeouts in seconds, to connect and then to read the response.
+_DEFAULT_TIMEOUT = (3.05, 10)
+
+# Number of connections to keep alive per host.
+_POOL_SIZE = 16
+
+# Maximum number of retries for a call.
+_MAX_RETRIES = 2
+
+# Base delay in seconds before retrying a call, doubled for each retry.
+_RETRY_BACKOFF = .1
+
+# HTTP status of responses that are worth retrying.
+_RETRY_STATUS_CODES = frozenset([429, 502, 503, 504])
+
+# Methods that can safely be called again if the server got the first call.
+_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# Number of consecutive failures for a host before we stop calling it.
+_CIRCUIT_BREAKER_THRESHOLD = 5
+
+# Number of seconds during which we stop calling a failing host.
+_CIRCUIT_BREAKER_DURATION = 30
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Error raised when calling a host that has been failing too much."""
+
+
+class _Host(object):
+    """The connections and stats for a host."""
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = adapters.HTTPAdapter(pool_connections=1, pool_maxsize=_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.stats = collections.Counter()
+
+    def check_circuit(self, host_name):
+        """Raise an error if the host has been failing recently."""
+        if self.consecutive_failures >= _CIRCUIT_BREAKER_THRESHOLD and \
+                time.time() < self.open_until:
+            raise CircuitOpenError('Too many failures when calling {}'.format(host_name))
+
+    def record(self, latency, is_error):
+        """Record the outcome of a call."""
+        with self.lock:
+            self.stats['calls'] += 1
+            self.stats['latency_ms'] += int(latency * 1000)
+            if not is_error:
+                self.consecutive_failures = 0
+                return
+            self.stats['errors'] += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= _CIRCUIT_BREAKER_THRESHOLD:
+                self.open_until = time.time() + _CIRCUIT_BREAKER_DURATION
+
+
+_HOSTS = {}
+_HOSTS_LOCK = threading.Lock()
+
+
+def _get_host(host_name):
+    host = _HOSTS.get(host_name)
+    if host:
+        return host
+    with _HOSTS_LOCK:
+        return _HOSTS.setdefault(host_name, _Host())
+
+
+def _is_error(response):
+    return response.status_code >= 500 or response.status_code in _RETRY_STATUS_CODES
+
+
+def request(method, url, **kwargs):
+    """Call an external HTTP API.
+
+    Args:
+        method: the HTTP method, e.g. 'GET'.
+        url: the URL to call.
+        kwargs: any option of requests.request. The timeout defaults to a
+            few seconds.
+    Returns:
+        a requests.Response.
+    Raises:
+        requests.exceptions.RequestException if the call failed even after
+        retrying, or CircuitOpenError if the host has been failing too much.
+    """
+    method = method.upper()
+    host_name = parse.urlsplit(url).netloc
+    host = _get_host(host_name)
+    kwargs.setdefault('timeout', _DEFAULT_TIMEOUT)
+    retry = 0
+    while True:
+        host.check_circuit(host_name)
+        start = time.time()
+        try:
+            response = host.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException as error:
+            host.record(time.time() - start, is_error=True)
+            # A server that we could not connect to has not received the call.
+            can_retry = method in _IDEMPOTENT_METHODS or \
+                isinstance(error, requests.exceptions.ConnectTimeout)
+            if not can_retry or retry >= _MAX_RETRIES:
+                raise
+            logging.info('Retrying call to %s after error: %s', host_name, error)
+        else:
+            is_error = _is_error(response)
+            host.record(time.time() - start, is_error=is_error)
+            if not is_error or method not in _IDEMPOTENT_METHODS or retry >= _MAX_RETRIES:
+                return response
+            logging.info(
+                'Retrying call to %s after HTTP status %d', host_name, response.status_code)
+        retry += 1
+        # Full jitter, so that clients do not retry all at the same time.
+        time.sleep(random.uniform(0, _RETRY_BACKOFF * 2 ** retry))
+
+
+def get(url, **kwargs):
+    """Call an external HTTP API with a GET request, see request."""
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    """Call an external HTTP API with a POST request, see request."""
+    return request('POST', url, **kwargs)
+
+
+def get_stats():
+    """Get the stats of the calls to external HTTP APIs.
+
+    Returns:
+        a dict keyed by host names with a dict of stats for each: the number
+        of calls, of errors and the total latency in milliseconds.
+    """
+    with _HOSTS_LOCK:
+        hosts = list(_HOSTS.items())
+    stats = {}
+    for host_name, host in hosts:
+        with host.lock:
+            stats[host_name] = dict(host.stats)
+    return stats
@@ -14,6 +14,9 @@ _MAIL_SENDER_NAME = 'Bob Emploi'
 # List of email addresses of admins to send service emails.
 _ADMIN_EMAILS = os.getenv('ADMIN_EMAILS', 'Pascal Corpet <pascal@bayes.org>')
 
+# Maximum number of messages that MailJet accepts in a single call to send.
+MAX_MESSAGES_PER_CALL = 50
+
 _FakeResponse = collections.namedtuple('FakeResponse', [
     'status_code', 'raise_for_status', 'text'])
 
@@ -53,7 +56,41 @@ def send_template(
         monitoring_category: see http://hello.mailjet.com/monitoring-beta/
     """
     mail_client = _mailjet_client()
-    data = {
+    data = _make_template_message(
+        template_id, recipient, template_vars, sender_email, sender_name)
+    if monitoring_category:
+        data['MonitoringCategory'] = monitoring_category,
+    if dry_run:
+        logging.info(data)
+        return _FakeResponse(status_code=200, raise_for_status=lambda: None, text='OK')
+    return mail_client.send.create(data=data)
+
+
+def send_templates(
+        template_id, recipients_and_vars,
+        sender_email=_MAIL_SENDER_EMAIL, sender_name=_MAIL_SENDER_NAME):
+    """Send an email using a template to many recipients in a single call.
+
+    Args:
+        template_id: the ID of the template in MailJet, see
+            https://app.mailjet.com/templates/transactional.
+        recipients_and_vars: a list of tuples with a UserProfile proto
+            defining the email recipient, and the dict of keywords vars to use
+            in the template for them. There should not be more than
+            MAX_MESSAGES_PER_CALL of them.
+    Returns:
+        the response of MailJet. If successful, its JSON has a "Sent" list
+        with one item per recipient, in the same order.
+    """
+    mail_client = _mailjet_client()
+    return mail_client.send.create(data={'Messages': [
+        _make_template_message(template_id, recipient, template_vars, sender_email, sender_name)
+        for recipient, template_vars in recipients_and_vars
+    ]})
+
+
+def _make_template_message(template_id, recipient, template_vars, sender_email, sender_name):
+    return {
         'MJ-TemplateID': template_id,
         'MJ-TemplateLanguage': True,
         'MJ-TemplateErrorReporting': _ADMIN_EMAILS,
@@ -65,12 +102,6 @@ def send_template(
             'Name': '{} {}'.format(recipient.name, recipient.last_name),
         }],
     }
-    if monitoring_category:
-        data['MonitoringCategory'] = monitoring_category,
-    if dry_run:
-        logging.info(data)
-        return _FakeResponse(status_code=200, raise_for_status=lambda: None, text='OK')
-    return mail_client.send.create(data=data)
 
 
 def send_template_to_admins(template_id, template_vars):
@@ -130,3 +161,34 @@ def list_messages(recipient_id_or_email):
         for one_message in data:
             yield one_message
         offset += len(data)
+
+
+def list_messages_sent_between(from_time, to_time, page_size=1000):
+    """Get the messages sent during a time window, with their recipient's email.
+
+    Args:
+        from_time: the UTC datetime of the start of the window.
+        to_time: the UTC datetime of the end of the window.
+        page_size: the number of messages to get in each call to MailJet.
+    Yields:
+        messages as returned by MailJet, the recipient's email in ContactAlt.
+    """
+    mail_client = _mailjet_client()
+    offset = 0
+    while True:
+        res = mail_client.message.get(filters={
+            'FromTS': from_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'ToTS': to_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'ShowContactAlt': 'true',
+            'Limit': page_size,
+            'Offset': offset,
+        })
+        res.raise_for_status()
+        data = res.json().get('Data')
+        if not data:
+            break
+        for one_message in data:
+            yield one_message
+        if len(data) < page_size:
+            break
+        offset += len(data)
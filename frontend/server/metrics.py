@@ -0,0 +1,231 @@
+"""Module to collect metrics on the server and export them for Prometheus.
+
+Metrics are kept in memory in each process. When the server runs in several
+processes, e.g. uwsgi workers, set the METRICS_DIR environment variable to a
+directory shared by all of them: each process then regularly dumps its
+metrics in a file there, and the exported metrics are aggregated across all
+the files.
+"""
+import collections
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the buckets of the latency histograms.
+_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 1.5, 2.5, 5, 10)
+
+# Directory where each process dumps its metrics, to aggregate them.
+_METRICS_DIR = os.getenv('METRICS_DIR')
+
+# Minimum number of seconds between two dumps of the metrics of a process.
+_FLUSH_INTERVAL = 5
+
+# Gauges of processes that have not dumped their metrics for this number of
+# seconds are ignored: the process is probably gone.
+_STALE_GAUGE_DURATION = 60
+
+_COUNTER = 'counter'
+_GAUGE = 'gauge'
+_HISTOGRAM = 'histogram'
+
+
+def _make_histogram():
+    # Number of observations per bucket, then sum and count of all observations.
+    return [0] * len(_BUCKETS) + [0, 0]
+
+
+class _Registry(object):
+    """The metrics of the current process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.counters = collections.defaultdict(float)
+        self.gauges = collections.defaultdict(float)
+        self.histograms = collections.defaultdict(_make_histogram)
+        self.collectors = []
+        self.flushed_at = 0
+
+    def snapshot(self):
+        """Get a JSON serializable snapshot of the metrics."""
+        counters = collections.defaultdict(float)
+        gauges = collections.defaultdict(float)
+        types = {}
+        for collect in self.collectors:
+            for metric_type, name, labels, value in collect():
+                types[name] = metric_type
+                values = counters if metric_type == _COUNTER else gauges
+                values[name, _freeze_labels(labels)] += value
+        with self.lock:
+            types.update(self.types)
+            for key, value in self.counters.items():
+                counters[key] += value
+            for key, value in self.gauges.items():
+                gauges[key] += value
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        return {
+            'types': types,
+            'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in gauges.items()],
+            'histograms': [[name, labels, value] for (name, labels), value in histograms.items()],
+        }
+
+
+_REGISTRY = _Registry()
+
+
+def _freeze_labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """Increment a counter."""
+    key = (name, _freeze_labels(labels))
+    with _REGISTRY.lock:
+        _REGISTRY.types[name] = _COUNTER
+        _REGISTRY.counters[key] += value
+
+
+def add_to_gauge(name, value, **labels):
+    """Add a value, possibly negative, to a gauge."""
+    key = (name, _freeze_labels(labels))
+    with _REGISTRY.lock:
+        _REGISTRY.types[name] = _GAUGE
+        _REGISTRY.gauges[key] += value
+
+
+def observe(name, value, **labels):
+    """Add an observation, e.g. a duration in seconds, to a histogram."""
+    key = (name, _freeze_labels(labels))
+    with _REGISTRY.lock:
+        _REGISTRY.types[name] = _HISTOGRAM
+        histogram = _REGISTRY.histograms[key]
+        for index, upper_bound in enumerate(_BUCKETS):
+            if value <= upper_bound:
+                histogram[index] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+def register_collector(collect):
+    """Register a function collecting metrics that are computed elsewhere.
+
+    Args:
+        collect: a function called each time the metrics are exported or
+            dumped. It should return an iterable of tuples (type, name, labels,
+            value) where type is either 'counter' or 'gauge', labels is a dict,
+            and value is the total for the current process.
+    """
+    _REGISTRY.collectors.append(collect)
+
+
+def _get_process_file(directory):
+    return os.path.join(directory, '{:d}.json'.format(os.getpid()))
+
+
+def flush(force=False):
+    """Dump the metrics of the current process so that they can be aggregated.
+
+    This does nothing if METRICS_DIR is not set, or if the metrics were dumped
+    recently, unless force is set.
+    """
+    if not _METRICS_DIR:
+        return
+    now = time.time()
+    if not force and now < _REGISTRY.flushed_at + _FLUSH_INTERVAL:
+        return
+    _REGISTRY.flushed_at = now
+    try:
+        os.makedirs(_METRICS_DIR, exist_ok=True)
+        filename = _get_process_file(_METRICS_DIR)
+        with open(filename + '.tmp', 'w') as snapshot_file:
+            json.dump(_REGISTRY.snapshot(), snapshot_file)
+        # Replace the file at once so that readers never get a partial file.
+        os.replace(filename + '.tmp', filename)
+    except OSError:
+        logging.exception('Could not dump the metrics in %s', _METRICS_DIR)
+
+
+def _list_snapshots():
+    if not _METRICS_DIR:
+        yield _REGISTRY.snapshot(), True
+        return
+    flush(force=True)
+    now = time.time()
+    for filename in glob.glob(os.path.join(_METRICS_DIR, '*.json')):
+        try:
+            is_live = os.path.getmtime(filename) > now - _STALE_GAUGE_DURATION
+            with open(filename) as snapshot_file:
+                yield json.load(snapshot_file), is_live
+        except (OSError, ValueError):
+            logging.warning('Could not read the metrics in %s', filename)
+
+
+def _format_labels(labels, **extra_labels):
+    all_labels = list(labels) + sorted(extra_labels.items())
+    if not all_labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in all_labels))
+
+
+def _format_value(value):
+    if float(value).is_integer():
+        return '{:d}'.format(int(value))
+    return repr(float(value))
+
+
+def render():
+    """Export the metrics of all processes in the Prometheus text format."""
+    types = {}
+    values = collections.defaultdict(float)
+    histograms = collections.defaultdict(_make_histogram)
+    for snapshot, is_live in _list_snapshots():
+        types.update(snapshot['types'])
+        for name, labels, value in snapshot['counters']:
+            values[name, tuple(map(tuple, labels))] += value
+        if is_live:
+            for name, labels, value in snapshot['gauges']:
+                values[name, tuple(map(tuple, labels))] += value
+        for name, labels, histogram in snapshot['histograms']:
+            total = histograms[name, tuple(map(tuple, labels))]
+            for index, value in enumerate(histogram):
+                total[index] += value
+
+    metrics = collections.defaultdict(list)
+    for (name, labels), value in sorted(values.items()):
+        metrics[name].append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+    for (name, labels), histogram in sorted(histograms.items()):
+        cumulated = 0
+        for upper_bound, value in zip(_BUCKETS, histogram):
+            cumulated += value
+            metrics[name].append('{}_bucket{} {}'.format(
+                name, _format_labels(labels, le=_format_value(upper_bound)),
+                _format_value(cumulated)))
+        metrics[name].append('{}_bucket{} {}'.format(
+            name, _format_labels(labels, le='+Inf'), _format_value(histogram[-1])))
+        metrics[name].append('{}_sum{} {}'.format(
+            name, _format_labels(labels), _format_value(histogram[-2])))
+        metrics[name].append('{}_count{} {}'.format(
+            name, _format_labels(labels), _format_value(histogram[-1])))
+
+    lines = []
+    for name in sorted(metrics):
+        lines.append('# TYPE {} {}'.format(name, types.get(name, 'untyped')))
+        lines.extend(metrics[name])
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Forget all the metrics of the current process. Only useful in tests."""
+    with _REGISTRY.lock:
+        _REGISTRY.types.clear()
+        _REGISTRY.counters.clear()
+        _REGISTRY.gauges.clear()
+        _REGISTRY.histograms.clear()
@@ -0,0 +1,134 @@
+"""Module to migrate users' data to the latest version of their schema.
+
+Each migration upgrades a user from one version of the schema to the next one.
+Users are migrated lazily when they are read by the server, and the migrated
+data is saved back so that it only happens once per user. The same migrations
+can be run on all users with the asynchronous/fix_projects.py script.
+
+Data sent by clients goes through all the migrations before being saved, as
+outdated clients may still send old fields: migrations must therefore leave
+the data untouched when it is already migrated.
+
+To add a migration, add a function decorated with _register_migration after
+the others: it gets the next schema version.
+"""
+import datetime
+
+from google.protobuf import json_format
+
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import project_pb2
+from bob_emploi.frontend.api import user_pb2
+
+# Functions to upgrade a user to the next version of the schema, indexed by
+# the version they upgrade from.
+_MIGRATIONS = []
+
+
+def _register_migration(migrate):
+    _MIGRATIONS.append(migrate)
+    return migrate
+
+
+# Mapping of old diploma estimates to new training estimates.
+TRAINING_ESTIMATION = {
+    project_pb2.FULFILLED: project_pb2.ENOUGH_DIPLOMAS,
+    project_pb2.NOT_FULFILLED: project_pb2.TRAINING_FULFILLMENT_NOT_SURE,
+    project_pb2.FULFILLMENT_NOT_SURE: project_pb2.TRAINING_FULFILLMENT_NOT_SURE,
+    project_pb2.NOTHING_REQUIRED: project_pb2.NO_TRAINING_REQUIRED,
+}
+
+
+@_register_migration
+def _fix_old_project_fields(user):
+    for project in user.projects:
+        if not project.training_fulfillment_estimate and project.diploma_fulfillment_estimate:
+            project.training_fulfillment_estimate = TRAINING_ESTIMATION.get(
+                project.diploma_fulfillment_estimate, project_pb2.UNKNOWN_TRAINING_FULFILLMENT)
+
+        if project.kind == project_pb2.FIND_JOB:
+            if user.profile.situation == user_pb2.LOST_QUIT:
+                project.kind = project_pb2.FIND_A_NEW_JOB
+            elif user.profile.situation == user_pb2.FIRST_TIME:
+                project.kind = project_pb2.FIND_A_FIRST_JOB
+            else:
+                project.kind = project_pb2.FIND_ANOTHER_JOB
+
+        if not (project.job_search_started_at.seconds or project.job_search_has_not_started) \
+                and project.job_search_length_months:
+            if project.job_search_length_months < 0:
+                project.job_search_has_not_started = True
+            else:
+                job_search_length_days = 30.5 * project.job_search_length_months
+                job_search_length_duration = datetime.timedelta(days=job_search_length_days)
+                project.job_search_started_at.FromDatetime(
+                    project.created_at.ToDatetime() - job_search_length_duration)
+                project.job_search_started_at.nanos = 0
+
+        project.ClearField('diploma_fulfillment_estimate')
+        project.ClearField('actions_generated_at')
+
+
+@_register_migration
+def _clear_old_profile_fields(user):
+    # The city and job are now in the projects, and the situation in the kind
+    # of the projects.
+    user.profile.ClearField('city')
+    user.profile.ClearField('latest_job')
+    user.profile.ClearField('situation')
+
+
+CURRENT_VERSION = len(_MIGRATIONS)
+
+# Field of the stored users counting the updates made outside of the user's own
+# saves, e.g. by scripts. Unlike the revision that clients send back when
+# saving, it never makes their saves conflict: it only tells that the user
+# changed, e.g. for caching.
+EXTERNAL_REVISION_FIELD = '_externalRevision'
+
+
+def is_up_to_date(user):
+    """Checks whether a user already has the latest version of the schema."""
+    return user.schema_version >= CURRENT_VERSION
+
+
+def migrate_user(user, from_version=0):
+    """Run the migrations on a user to get the latest version of the schema.
+
+    Args:
+        user: a User proto, modified in place.
+        from_version: the version of the schema that the user follows.
+    """
+    for migrate in _MIGRATIONS[from_version:]:
+        migrate(user)
+    user.schema_version = CURRENT_VERSION
+
+
+def upgrade_user(user):
+    """Upgrade a user to the latest version of the schema.
+
+    Args:
+        user: a User proto, modified in place.
+    Returns:
+        the MongoDB update to apply the same changes on the stored user, or an
+        empty dict if the user was already up to date. It only touches the
+        fields modified by the migrations.
+    """
+    if is_up_to_date(user):
+        return {}
+    old_user_dict = json_format.MessageToDict(user)
+    migrate_user(user, user.schema_version)
+    return mark_external_update(
+        proto.get_mongo_update(old_user_dict, json_format.MessageToDict(user)))
+
+
+def mark_external_update(update):
+    """Mark a MongoDB update of a user made outside of the user's own saves.
+
+    Args:
+        update: a MongoDB update of a user, modified in place.
+    Returns:
+        the same update, also incrementing the external revision of the user.
+    """
+    update.setdefault('$inc', {})[EXTERNAL_REVISION_FIELD] = 1
+    return update
@@ -13,13 +13,13 @@ class _AdviceAssociationHelp(scoring.ModelBase):
 
     def __init__(self):
         super(_AdviceAssociationHelp, self).__init__()
-        self._db = proto.MongoCachedCollection(association_pb2.Association, 'associations')
+        self._db = proto.MongoCachedCollection(
+            association_pb2.Association, 'associations', index_func=scoring.FilterIndex)
 
     @scoring.ScoringProject.cached('associations')
     def list_associations(self, project):
         """List all associations for a project."""
-        all_associations = self._db.get_collection(project.database)
-        return list(scoring.filter_using_score(all_associations, lambda j: j.filters, project))
+        return self._db.get_collection(project.database).index.filter(project)
 
     def score(self, project):
         """Compute a score for the given ScoringProject."""
@@ -46,16 +46,14 @@ class _AdviceCommuteScoringModel(scoring.ModelBase):
         job_group = project.details.target_job.job_group.rome_id
 
         all_cities = commute_pb2.HiringCities()
-        proto.parse_from_mongo(
-            project.database.hiring_cities.find_one({'_id': job_group}), all_cities)
+        proto.parse_from_mongo(project.get_document('hiring_cities', job_group), all_cities)
         interesting_cities_for_rome = all_cities.hiring_cities
 
         if not interesting_cities_for_rome:
             return []
 
         target_city = geo_pb2.FrenchCity()
-        mongo_city = project.database.cities.find_one(
-            {'_id': project.details.mobility.city.city_id})
+        mongo_city = project.get_document('cities', project.details.mobility.city.city_id)
         if not mongo_city:
             return []
         proto.parse_from_mongo(mongo_city, target_city)
@@ -115,3 +113,6 @@ def _compute_square_distance(city_a, city_b):
 
 
 scoring.register_model('advice-commute', _AdviceCommuteScoringModel())
+scoring.register_prefetch(
+    'hiring_cities', lambda project: [project.details.target_job.job_group.rome_id])
+scoring.register_prefetch('cities', lambda project: [project.details.mobility.city.city_id])
@@ -13,7 +13,8 @@ class _AdviceEventScoringModel(scoring.ModelBase):
 
     def __init__(self):
         super(_AdviceEventScoringModel, self).__init__()
-        self._db = proto.MongoCachedCollection(event_pb2.Event, 'events')
+        self._db = proto.MongoCachedCollection(
+            event_pb2.Event, 'events', index_func=scoring.FilterIndex)
 
     def score(self, project):
         """Compute a score for the given ScoringProject."""
@@ -29,8 +30,10 @@ class _AdviceEventScoringModel(scoring.ModelBase):
     def list_events(self, project):
         """List all events close to the project's target."""
         today = project.now.strftime('%Y-%m-%d')
-        all_events = [e for e in self._db.get_collection(project.database) if e.start_date >= today]
-        return list(scoring.filter_using_score(all_events, lambda e: e.filters, project))
+        all_events = self._db.get_collection(project.database)
+        upcoming_event_ids = [
+            event_id for event_id, event in all_events.items() if event.start_date >= today]
+        return all_events.index.filter(project, upcoming_event_ids)
 
     def compute_extra_data(self, project):
         """Compute extra data for this module to render a card in the client."""
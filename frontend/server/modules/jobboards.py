@@ -13,13 +13,13 @@ class _AdviceJobBoards(scoring.LowPriorityAdvice):
 
     def __init__(self):
         super(_AdviceJobBoards, self).__init__(user_pb2.NO_OFFERS)
-        self._db = proto.MongoCachedCollection(jobboard_pb2.JobBoard, 'jobboards')
+        self._db = proto.MongoCachedCollection(
+            jobboard_pb2.JobBoard, 'jobboards', index_func=scoring.FilterIndex)
 
     @scoring.ScoringProject.cached('jobboards')
     def list_jobboards(self, project):
         """List all job boards for this project."""
-        all_job_boards = self._db.get_collection(project.database)
-        return list(scoring.filter_using_score(all_job_boards, lambda j: j.filters, project))
+        return self._db.get_collection(project.database).index.filter(project)
 
     def compute_extra_data(self, project):
         """Compute extra data for this module to render a card in the client."""
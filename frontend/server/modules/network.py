@@ -13,7 +13,8 @@ class _ImproveYourNetworkScoringModel(scoring.ModelBase):
 
     def __init__(self, network_level):
         super(_ImproveYourNetworkScoringModel, self).__init__()
-        self._db = proto.MongoCachedCollection(network_pb2.ContactLeadTemplate, 'contact_lead')
+        self._db = proto.MongoCachedCollection(
+            network_pb2.ContactLeadTemplate, 'contact_lead', index_func=scoring.FilterIndex)
         self._network_level = network_level
 
     def score(self, project):
@@ -53,8 +54,7 @@ class _ImproveYourNetworkScoringModel(scoring.ModelBase):
 
     @scoring.ScoringProject.cached('contact-leads')
     def _list_contact_leads(self, project):
-        return scoring.filter_using_score(
-            self._db.get_collection(project.database), lambda l: l.filters, project)
+        return self._db.get_collection(project.database).index.filter(project)
 
 
 scoring.register_model('advice-better-network', _ImproveYourNetworkScoringModel(2))
@@ -49,8 +49,7 @@ class _AdviceSeasonalRelocate(scoring.ModelBase):
 
         # TODO(guillaume): Cache this to increase speed.
         proto.parse_from_mongo(
-            project.database.seasonal_jobbing.find_one({'_id': project.now.month}),
-            top_departements)
+            project.get_document('seasonal_jobbing', project.now.month), top_departements)
 
         for departement in top_departements.departement_stats:
             # TODO(guillaume): If we don't use deeper jobgroups by october 1st 2017, trim the db.
@@ -72,3 +71,4 @@ class _AdviceSeasonalRelocate(scoring.ModelBase):
 
 
 scoring.register_model('advice-seasonal-relocate', _AdviceSeasonalRelocate())
+scoring.register_prefetch('seasonal_jobbing', lambda project: [project.now.month])
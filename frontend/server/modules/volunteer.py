@@ -1,6 +1,4 @@
 """Module to advise the user to volunteer with non-profits."""
-import collections
-
 from bob_emploi.frontend import proto
 from bob_emploi.frontend import scoring
 from bob_emploi.frontend.api import association_pb2
@@ -15,19 +13,15 @@ class _AdviceVolunteer(scoring.ModelBase):
         """Return a list of volunteering mission close to the project."""
         departement_id = project.details.mobility.city.departement_id
 
-        # Get data from MongoDB.
-        volunteering_missions_dict = collections.defaultdict(association_pb2.VolunteeringMissions)
-        collection = project.database.volunteering_missions
-        for record in collection.find({'_id': {'$in': [departement_id, '']}}):
-            record_id = record.pop('_id')
-            proto.parse_from_mongo(record, volunteering_missions_dict[record_id])
-
         # TODO(pascal): First get missions from target city if any.
 
-        # Merge data.
+        # Get data from MongoDB and merge it.
         project_missions = association_pb2.VolunteeringMissions()
         for scope in [departement_id, '']:
-            for mission in volunteering_missions_dict[scope].missions:
+            scope_missions = association_pb2.VolunteeringMissions()
+            proto.parse_from_mongo(
+                project.get_document('volunteering_missions', scope), scope_missions)
+            for mission in scope_missions.missions:
                 mission.is_available_everywhere = not scope
                 project_missions.missions.add().CopyFrom(mission)
 
@@ -59,3 +53,6 @@ class _AdviceVolunteer(scoring.ModelBase):
 
 
 scoring.register_model('advice-volunteer', _AdviceVolunteer())
+scoring.register_prefetch(
+    'volunteering_missions',
+    lambda project: [project.details.mobility.city.departement_id, ''])
@@ -0,0 +1,331 @@
+"""Module to send emails through a durable outbox in MongoDB.
+
+Instead of calling MailJet while a user waits, or in the middle of a blast,
+messages are enqueued in the email_outbox collection, and a dispatcher (see
+asynchronous/send_outbox.py) sends them at the rate allowed by MailJet:
+    - each message has an idempotency key, so enqueuing it again, e.g. when
+      resuming a blast that crashed, does not send it twice,
+    - messages that could not be sent are retried later, with an exponential
+      backoff,
+    - messages claimed by a dispatcher that crashed are claimed again once
+      their lock expires, so a message may be sent twice in this case only.
+
+Blasts can also wait for the outbox to drain before enqueuing more messages.
+"""
+import datetime
+import logging
+import os
+import threading
+import time
+
+import mailjet_rest
+import pymongo
+import requests
+
+from bob_emploi.frontend import mail
+from bob_emploi.frontend import now
+from bob_emploi.frontend.api import user_pb2
+
+_OUTBOX_COLLECTION = 'email_outbox'
+
+_RATE_LIMIT_COLLECTION = 'email_rate_limit'
+
+# Maximum number of emails per second allowed by MailJet, shared by all the
+# scripts sending emails, see MongoTokenBucket.
+RATE_PER_SECOND = float(os.getenv('MAILJET_RATE_PER_SECOND', '10'))
+
+# Status of messages in the outbox.
+_PENDING = 'pending'
+_SENDING = 'sending'
+_SENT = 'sent'
+_FAILED = 'failed'
+
+# Number of times a message is tried before giving up.
+_MAX_ATTEMPTS = 5
+
+# Delay before retrying to send a message the first time, doubled for each
+# following attempt.
+_RETRY_DELAY = datetime.timedelta(minutes=1)
+
+# Duration after which a message claimed by a dispatcher can be claimed again:
+# the dispatcher probably crashed.
+_LOCK_DURATION = datetime.timedelta(minutes=5)
+
+# Maximum number of pending messages before blasts wait for the dispatcher.
+_MAX_PENDING_MESSAGES = 10000
+
+
+class TokenBucket(object):
+    """A rate limiter allowing bursts.
+
+    Tokens are added to the bucket at a constant rate, up to its capacity, and
+    each call consumes some of them, waiting for them if needed.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        """Create a token bucket.
+
+        Args:
+            rate: the number of tokens added per second.
+            capacity: the maximum number of tokens in the bucket, i.e. the
+                maximum size of a burst. Defaults to the rate.
+            clock: a function returning a time in seconds.
+            sleep: a function to wait for a number of seconds.
+        """
+        self._rate = rate
+        self._capacity = capacity or rate
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self._capacity
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Consume tokens, waiting until they are available."""
+        missing_tokens = self._take(tokens)
+        if missing_tokens > 0:
+            self._sleep(missing_tokens / self._rate)
+
+    def _refill(self, available_tokens, updated_at, current_time):
+        return min(
+            self._capacity,
+            available_tokens + max(0, current_time - updated_at) * self._rate)
+
+    def _take(self, tokens):
+        """Consume tokens and return the number of tokens missing to do so."""
+        with self._lock:
+            current_time = self._clock()
+            self._tokens = self._refill(self._tokens, self._updated_at, current_time)
+            self._updated_at = current_time
+            self._tokens -= tokens
+            return -self._tokens
+
+
+class MongoTokenBucket(TokenBucket):
+    """A token bucket stored in MongoDB, shared by all the processes using it.
+
+    All the scripts sending emails with MailJet should use the same bucket, so
+    that they do not exceed its rate all together.
+    """
+
+    def __init__(
+            self, database, rate, capacity=None, name='mailjet', clock=time.time,
+            sleep=time.sleep):
+        """Create a token bucket stored in MongoDB.
+
+        Args:
+            database: the MongoDB database in which to store the bucket.
+            name: the name of the bucket: the processes using the same name
+                share the same bucket.
+            rate, capacity, sleep: see TokenBucket.
+            clock: a function returning the time in seconds, the same for
+                all the processes.
+        """
+        super(MongoTokenBucket, self).__init__(rate, capacity, clock=clock, sleep=sleep)
+        self._collection = database.get_collection(_RATE_LIMIT_COLLECTION)
+        self._name = name
+
+    def _take(self, tokens):
+        while True:
+            current_time = self._clock()
+            stored = self._collection.find_one({'_id': self._name})
+            if not stored:
+                remaining_tokens = self._capacity - tokens
+                try:
+                    self._collection.insert_one({
+                        '_id': self._name,
+                        'tokens': remaining_tokens,
+                        'updatedAt': current_time,
+                    })
+                except pymongo.errors.DuplicateKeyError:
+                    # Created concurrently by another process: try again.
+                    continue
+                return -remaining_tokens
+            remaining_tokens = self._refill(
+                stored['tokens'], stored['updatedAt'], current_time) - tokens
+            # Only update the bucket if no other process did in between.
+            result = self._collection.update_one(
+                {'_id': self._name, 'updatedAt': stored['updatedAt']},
+                {'$set': {'tokens': remaining_tokens, 'updatedAt': current_time}})
+            if result.matched_count:
+                return -remaining_tokens
+
+
+def enqueue(
+        database, idempotency_key, template_id, recipient, template_vars,
+        monitoring_category=None, dry_run=False, sender_email=None, sender_name=None):
+    """Enqueue an email to send with a template.
+
+    Args:
+        database: the MongoDB database with the outbox.
+        idempotency_key: a unique key for this message, e.g. the campaign and
+            the user ID: the message is only enqueued once for a given key.
+        template_id: the ID of the template in MailJet.
+        recipient: a UserProfile proto defining the email recipient.
+        template_vars: a dict of keywords vars to use in the template.
+        monitoring_category, dry_run, sender_email, sender_name: see
+            mail.send_template.
+    Returns:
+        whether the message was enqueued, False if a message with the same key
+        was already in the outbox.
+    """
+    message = {
+        '_id': idempotency_key,
+        'templateId': template_id,
+        'recipient': {
+            'email': recipient.email,
+            'name': recipient.name,
+            'lastName': recipient.last_name,
+        },
+        'vars': template_vars,
+        'status': _PENDING,
+        'attempts': 0,
+        'createdAt': now.get(),
+        'nextAttemptAt': now.get(),
+    }
+    if monitoring_category:
+        message['monitoringCategory'] = monitoring_category
+    if dry_run:
+        message['dryRun'] = True
+    if sender_email:
+        message['senderEmail'] = sender_email
+    if sender_name:
+        message['senderName'] = sender_name
+    try:
+        database.get_collection(_OUTBOX_COLLECTION).insert_one(message)
+    except pymongo.errors.DuplicateKeyError:
+        return False
+    return True
+
+
+def ensure_indexes(database):
+    """Create the indexes needed to claim the messages of the outbox."""
+    outbox = database.get_collection(_OUTBOX_COLLECTION)
+    outbox.create_index([('status', pymongo.ASCENDING), ('nextAttemptAt', pymongo.ASCENDING)])
+    outbox.create_index([('status', pymongo.ASCENDING), ('lockedUntil', pymongo.ASCENDING)])
+
+
+def count_pending(database):
+    """Count the messages that are waiting to be sent."""
+    return database.get_collection(_OUTBOX_COLLECTION).find(
+        {'status': {'$in': [_PENDING, _SENDING]}}).count()
+
+
+def wait_for_room(
+        database, max_pending=_MAX_PENDING_MESSAGES, poll_seconds=5, sleep=time.sleep):
+    """Wait until the outbox has room for more messages.
+
+    Blasts should call it regularly, so that they do not enqueue messages much
+    faster than they can be sent.
+    """
+    while count_pending(database) >= max_pending:
+        sleep(poll_seconds)
+
+
+def _claim_message(database):
+    instant = now.get()
+    return database.get_collection(_OUTBOX_COLLECTION).find_one_and_update(
+        {'$or': [
+            {'status': _PENDING, 'nextAttemptAt': {'$lte': instant}},
+            {'status': _SENDING, 'lockedUntil': {'$lte': instant}},
+        ]},
+        {
+            '$set': {'status': _SENDING, 'lockedUntil': instant + _LOCK_DURATION},
+            '$inc': {'attempts': 1},
+        },
+        sort=[('nextAttemptAt', pymongo.ASCENDING)],
+        return_document=pymongo.ReturnDocument.AFTER)
+
+
+def _send_message(message):
+    """Send a message and return the response, or None if it did not get one."""
+    recipient = user_pb2.UserProfile(
+        email=message['recipient'].get('email', ''),
+        name=message['recipient'].get('name', ''),
+        last_name=message['recipient'].get('lastName', ''))
+    kwargs = {}
+    if 'senderEmail' in message:
+        kwargs['sender_email'] = message['senderEmail']
+    if 'senderName' in message:
+        kwargs['sender_name'] = message['senderName']
+    try:
+        return mail.send_template(
+            message['templateId'], recipient, message['vars'],
+            dry_run=message.get('dryRun', False),
+            monitoring_category=message.get('monitoringCategory'), **kwargs)
+    except (requests.exceptions.RequestException, mailjet_rest.client.ApiError) as error:
+        logging.warning('Error while sending the email "%s": %s', message['_id'], error)
+        return None
+    except Exception:  # pylint: disable=broad-except
+        # Do not let a single message stop the dispatcher.
+        logging.exception('Unexpected error while sending the email "%s"', message['_id'])
+        return None
+
+
+def dispatch(database, bucket=None, max_messages=None):
+    """Send the messages of the outbox that are due.
+
+    Args:
+        database: the MongoDB database with the outbox.
+        bucket: an optional TokenBucket to limit the rate of messages.
+        max_messages: the maximum number of messages to send, by default send
+            all of them.
+    Returns:
+        the number of messages that were processed, sent or not.
+    """
+    outbox = database.get_collection(_OUTBOX_COLLECTION)
+    count = 0
+    while max_messages is None or count < max_messages:
+        message = _claim_message(database)
+        if not message:
+            break
+        count += 1
+        if message['attempts'] > _MAX_ATTEMPTS:
+            # The dispatchers that claimed it before probably crashed while
+            # sending it.
+            logging.error('Giving up on the email "%s" after too many attempts.', message['_id'])
+            outbox.update_one(
+                {'_id': message['_id']},
+                {'$set': {'status': _FAILED}, '$unset': {'lockedUntil': ''}})
+            continue
+        if bucket:
+            bucket.acquire()
+        response = _send_message(message)
+
+        if response is not None and response.status_code == 200:
+            try:
+                sent = response.json().get('Sent', [])
+            except ValueError:
+                sent = []
+            update = {'status': _SENT, 'sentAt': now.get()}
+            message_id = next(iter(sent), {}).get('MessageID')
+            if message_id:
+                update['messageId'] = message_id
+            outbox.update_one(
+                {'_id': message['_id']}, {'$set': update, '$unset': {'lockedUntil': ''}})
+            continue
+
+        status_code = None if response is None else response.status_code
+        # Client errors, except rate limiting, will not get better on retry.
+        is_permanent = status_code and 400 <= status_code < 500 and status_code != 429
+        if is_permanent or message['attempts'] >= _MAX_ATTEMPTS:
+            logging.error(
+                'Could not send the email "%s" (%s): %s', message['_id'], status_code,
+                '' if response is None else response.text)
+            outbox.update_one(
+                {'_id': message['_id']},
+                {'$set': {'status': _FAILED, 'lastError': status_code},
+                 '$unset': {'lockedUntil': ''}})
+            continue
+        outbox.update_one(
+            {'_id': message['_id']},
+            {
+                '$set': {
+                    'status': _PENDING,
+                    'lastError': status_code,
+                    'nextAttemptAt':
+                        now.get() + _RETRY_DELAY * 2 ** (message['attempts'] - 1),
+                },
+                '$unset': {'lockedUntil': ''},
+            })
+    return count
@@ -2,9 +2,20 @@
 import collections
 import datetime
 import functools
+import gzip
+import hashlib
+import itertools
+import json
 import logging
+import math
 import os
+import threading
 
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional: without it, responses are compressed with gzip only.
+    brotli = None
 try:
     import flask
 except ImportError:
@@ -13,12 +24,24 @@ except ImportError:
     # but the rest will.
     pass
 
+from google.protobuf import descriptor
 from google.protobuf import json_format
 from google.protobuf import message
 
 _CACHE_DURATION = datetime.timedelta(hours=1)
+# How long an expired cache can still be served while it is refreshed in the background.
+_MAX_STALE_DURATION = datetime.timedelta(hours=1)
+# Whether expired caches are refreshed in a background thread, or on the request thread.
+_REFRESH_CACHE_IN_BACKGROUND = os.getenv('REFRESH_CACHE_IN_BACKGROUND', '1') == '1'
+# How often to check whether a cached collection has been imported again.
+_META_CHECK_INTERVAL = datetime.timedelta(seconds=10)
 _IS_TEST_ENV = bool(os.getenv('TEST_ENV'))
 
+_JSON_MIMETYPE = 'application/json'
+_PROTOBUF_MIMETYPE = 'application/x-protobuf'
+# Minimum size in bytes of a response to compress it.
+_COMPRESSION_MIN_SIZE = 1024
+
 
 def parse_from_mongo(mongo_dict, proto):
     """Parse a Protobuf from a dict coming from MongoDB.
@@ -26,7 +49,7 @@ def parse_from_mongo(mongo_dict, proto):
     Args:
         mongo_dict: a dict coming from MongoDB, or None. This dict will be
             modified by the function: it removes all the keys prefixed by "_"
-            and convert datetime objects to iso strings.
+            and may convert datetime objects to iso strings.
         proto: a protobuffer to merge data into.
     Returns: a boolean indicating whether the input had actual data.
     """
@@ -35,6 +58,25 @@ def parse_from_mongo(mongo_dict, proto):
     to_delete = [k for k in mongo_dict if k.startswith('_')]
     for key in to_delete:
         del mongo_dict[key]
+    # Parse in a copy of the proto, unless it is empty, so that we can drop it in case of errors.
+    if proto.ListFields():
+        parsed = proto.__class__()
+        parsed.CopyFrom(proto)
+    else:
+        parsed = proto
+    try:
+        _merge_dict(mongo_dict, parsed)
+    except (_NotConvertible, TypeError, ValueError, json_format.ParseError):
+        # Let json_format handle the corner cases, or report the errors.
+        if parsed is proto:
+            proto.Clear()
+        return _parse_with_json_format(mongo_dict, proto)
+    if parsed is not proto:
+        proto.CopyFrom(parsed)
+    return True
+
+
+def _parse_with_json_format(mongo_dict, proto):
     _convert_datetimes_to_string(mongo_dict)
     try:
         json_format.ParseDict(mongo_dict, proto, ignore_unknown_fields=not _IS_TEST_ENV)
@@ -64,10 +106,256 @@ def _convert_datetimes_to_string(values):
             _convert_datetimes_to_string(value)
 
 
+class _NotConvertible(Exception):
+    """A value that only json_format knows how to parse, or how to reject."""
+
+
+# Converters for each message type, keyed by their full name.
+_MESSAGE_CONVERTERS = {}
+
+
+def _merge_dict(values, proto):
+    """Merge a dict from MongoDB into a proto, as json_format.ParseDict would."""
+    _get_message_converter(proto.DESCRIPTOR)(values, proto)
+
+
+def _get_message_converter(message_descriptor):
+    try:
+        return _MESSAGE_CONVERTERS[message_descriptor.full_name]
+    except KeyError:
+        pass
+    if message_descriptor.full_name == 'google.protobuf.Timestamp':
+        converter = _merge_timestamp
+    elif message_descriptor.full_name.startswith('google.protobuf.'):
+        converter = _merge_with_json_format
+    else:
+        converter = _MessageConverter(message_descriptor).merge
+    _MESSAGE_CONVERTERS[message_descriptor.full_name] = converter
+    return converter
+
+
+def _merge_timestamp(value, proto):
+    if isinstance(value, datetime.datetime) and not value.tzinfo:
+        proto.FromDatetime(value)
+    elif isinstance(value, str):
+        proto.FromJsonString(value)
+    else:
+        raise _NotConvertible()
+
+
+def _merge_with_json_format(value, proto):
+    _convert_datetimes_to_string(value)
+    json_format.ParseDict(value, proto, ignore_unknown_fields=not _IS_TEST_ENV)
+
+
+class _MessageConverter(object):
+    """A converter from MongoDB dicts to a given type of message.
+
+    It prepares once, from the message descriptor, a function to set each of
+    its fields, keyed by both their JSON and proto names.
+    """
+
+    def __init__(self, message_descriptor):
+        self._setters = {}
+        # Names of the fields to clear when their value is null, keyed by both
+        # their JSON and proto names. None for the fields that json_format
+        # sets to a null value instead.
+        self._nullable_fields = {}
+        for field in message_descriptor.fields:
+            setter = _make_field_setter(field)
+            self._setters[field.json_name] = setter
+            self._setters[field.name] = setter
+            nullable_field = None if _has_null_value(field) else field.name
+            self._nullable_fields[field.json_name] = nullable_field
+            self._nullable_fields[field.name] = nullable_field
+
+    def merge(self, values, proto):
+        """Merge a dict of values into a proto."""
+        if not isinstance(values, dict):
+            raise _NotConvertible()
+        setters = self._setters
+        for key, value in values.items():
+            try:
+                setter = setters[key]
+            except KeyError:
+                if _IS_TEST_ENV:
+                    raise _NotConvertible()
+                continue
+            if value is None:
+                nullable_field = self._nullable_fields[key]
+                if not nullable_field:
+                    raise _NotConvertible()
+                proto.ClearField(nullable_field)
+                continue
+            setter(proto, value)
+
+
+def _has_null_value(field):
+    if field.message_type:
+        return field.message_type.full_name == 'google.protobuf.Value'
+    if field.enum_type:
+        return field.enum_type.full_name == 'google.protobuf.NullValue'
+    return False
+
+
+def _make_field_setter(field):
+    name = field.name
+
+    if field.message_type and field.message_type.GetOptions().map_entry:
+        convert_key = _get_scalar_converter(field.message_type.fields_by_name['key'])
+        value_field = field.message_type.fields_by_name['value']
+        if value_field.message_type:
+            def _set_message_map(proto, values):
+                # Like json_format, replace the whole map.
+                proto.ClearField(name)
+                container = getattr(proto, name)
+                merge_value = _get_message_converter(value_field.message_type)
+                for key, value in values.items():
+                    if value is None:
+                        raise _NotConvertible()
+                    merge_value(value, container[convert_key(key)])
+            return _set_message_map
+
+        convert_value = _get_scalar_converter(value_field)
+
+        def _set_scalar_map(proto, values):
+            proto.ClearField(name)
+            container = getattr(proto, name)
+            for key, value in values.items():
+                if value is None:
+                    raise _NotConvertible()
+                container[convert_key(key)] = convert_value(value)
+        return _set_scalar_map
+
+    if field.label == descriptor.FieldDescriptor.LABEL_REPEATED:
+        if field.message_type:
+            def _set_repeated_messages(proto, values):
+                if not isinstance(values, list):
+                    raise _NotConvertible()
+                # Like json_format, replace the whole list.
+                proto.ClearField(name)
+                container = getattr(proto, name)
+                merge_value = _get_message_converter(field.message_type)
+                for value in values:
+                    merge_value(value, container.add())
+            return _set_repeated_messages
+
+        convert_value = _get_scalar_converter(field)
+
+        def _set_repeated_scalars(proto, values):
+            if not isinstance(values, list):
+                raise _NotConvertible()
+            proto.ClearField(name)
+            getattr(proto, name).extend([convert_value(value) for value in values])
+        return _set_repeated_scalars
+
+    oneof_name = field.containing_oneof.name if field.containing_oneof else None
+
+    def _check_oneof(proto):
+        if oneof_name and proto.WhichOneof(oneof_name) not in (None, name):
+            raise _NotConvertible()
+
+    if field.message_type:
+        def _set_message(proto, value):
+            _check_oneof(proto)
+            sub_proto = getattr(proto, name)
+            sub_proto.SetInParent()
+            _get_message_converter(field.message_type)(value, sub_proto)
+        return _set_message
+
+    convert_value = _get_scalar_converter(field)
+
+    def _set_scalar(proto, value):
+        _check_oneof(proto)
+        setattr(proto, name, convert_value(value))
+    return _set_scalar
+
+
+def _get_scalar_converter(field):
+    cpp_type = field.cpp_type
+    if cpp_type in _INTEGER_CPP_TYPES:
+        return _convert_integer
+    if cpp_type in _FLOAT_CPP_TYPES:
+        return _convert_float
+    if cpp_type == descriptor.FieldDescriptor.CPPTYPE_BOOL:
+        return _convert_bool
+    if cpp_type == descriptor.FieldDescriptor.CPPTYPE_ENUM:
+        return functools.partial(_convert_enum, field.enum_type)
+    if field.type == descriptor.FieldDescriptor.TYPE_STRING:
+        return _convert_string
+    return _convert_unknown
+
+
+_INTEGER_CPP_TYPES = frozenset([
+    descriptor.FieldDescriptor.CPPTYPE_INT32,
+    descriptor.FieldDescriptor.CPPTYPE_INT64,
+    descriptor.FieldDescriptor.CPPTYPE_UINT32,
+    descriptor.FieldDescriptor.CPPTYPE_UINT64,
+])
+_FLOAT_CPP_TYPES = frozenset([
+    descriptor.FieldDescriptor.CPPTYPE_DOUBLE,
+    descriptor.FieldDescriptor.CPPTYPE_FLOAT,
+])
+
+
+def _convert_integer(value):
+    if isinstance(value, bool):
+        raise _NotConvertible()
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and ' ' not in value:
+        return int(value)
+    raise _NotConvertible()
+
+
+def _convert_float(value):
+    if isinstance(value, float):
+        return value
+    if isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    raise _NotConvertible()
+
+
+def _convert_bool(value):
+    if isinstance(value, bool):
+        return value
+    raise _NotConvertible()
+
+
+def _convert_enum(enum_type, value):
+    if isinstance(value, str):
+        try:
+            return enum_type.values_by_name[value].number
+        except KeyError:
+            raise _NotConvertible()
+    if isinstance(value, int) and not isinstance(value, bool) and \
+            value in enum_type.values_by_number:
+        return value
+    # Let json_format decide whether to accept unknown values.
+    raise _NotConvertible()
+
+
+def _convert_string(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.isoformat() + 'Z'
+    raise _NotConvertible()
+
+
+def _convert_unknown(unused_value):
+    raise _NotConvertible()
+
+
 def flask_api(out_type=None, in_type=None):
     """Decorator for flask endpoints that handles input and outputs as protos.
 
-    The decorator converts the POST body from JSON to proto.
+    The decorator converts the POST body from JSON to proto, or from binary
+    proto if its Content-Type is application/x-protobuf. The output is sent as
+    JSON, or as binary proto if the client accepts application/x-protobuf,
+    and compressed if it is large enough and the client accepts it.
     """
     if not flask:
         raise ImportError("No module named 'flask'")
@@ -82,10 +370,13 @@ def flask_api(out_type=None, in_type=None):
                 proto = in_type()
                 try:
                     data = flask.request.get_data()
-                    if not data:
-                        data = flask.request.args.get('data', '')
-                    json_format.Parse(data, proto)
-                except json_format.ParseError as error:
+                    if flask.request.mimetype == _PROTOBUF_MIMETYPE:
+                        proto.ParseFromString(data)
+                    else:
+                        if not data:
+                            data = flask.request.args.get('data', '')
+                        json_format.Parse(data, proto)
+                except (json_format.ParseError, message.DecodeError) as error:
                     flask.abort(422, error)
                 args = args + (proto,)
             ret = func(*args, **kwargs)
@@ -97,11 +388,106 @@ def flask_api(out_type=None, in_type=None):
                         func.__name__,
                         out_type.__name__,
                         type(ret).__name__))
-            return json_format.MessageToJson(ret)
+            if not flask.has_request_context():
+                return _to_json(ret)
+            return _make_response(ret)
         return functools.wraps(func)(_decorated_fun)
     return _proto_api_decorator
 
 
+def _to_json(proto):
+    return json.dumps(
+        json_format.MessageToDict(proto), ensure_ascii=False, separators=(',', ':'))
+
+
+def _make_response(proto):
+    accept_mimetypes = flask.request.accept_mimetypes
+    if accept_mimetypes.best_match([_JSON_MIMETYPE, _PROTOBUF_MIMETYPE]) == _PROTOBUF_MIMETYPE:
+        mimetype = _PROTOBUF_MIMETYPE
+        data = proto.SerializeToString()
+    else:
+        mimetype = _JSON_MIMETYPE
+        data = _to_json(proto).encode('utf-8')
+
+    response = flask.Response(data, mimetype=mimetype)
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    if len(data) < _COMPRESSION_MIN_SIZE:
+        return response
+    accept_encodings = flask.request.accept_encodings
+    if brotli and 'br' in accept_encodings:
+        response.set_data(brotli.compress(data, quality=5))
+        response.content_encoding = 'br'
+    elif 'gzip' in accept_encodings:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.content_encoding = 'gzip'
+    return response
+
+
+def get_mongo_update(stored_dict, new_dict):
+    """Compute the MongoDB update that turns a stored document into a new one.
+
+    The update only sets or unsets the fields that differ, and pushes the
+    items appended at the end of lists, so that large documents are not
+    rewritten entirely when only a few fields change.
+
+    Args:
+        stored_dict: the document as stored in MongoDB.
+        new_dict: the document as it should be stored, without its "_id".
+            Stored fields prefixed by "_" that it does not have are kept as is.
+    Returns:
+        an update for update_one, with $set, $unset and $push operators, or
+        an empty dict if the documents are the same.
+    """
+    update = collections.defaultdict(dict)
+    stored_dict = {
+        k: v for k, v in stored_dict.items()
+        if k != '_id' and (k in new_dict or not k.startswith('_'))}
+    _diff_mongo_dicts(stored_dict, new_dict, '', update)
+    return dict(update)
+
+
+def _is_safe_mongo_key(key):
+    return key and '.' not in key and not key.startswith('$')
+
+
+def _diff_mongo_dicts(old, new, path, update):
+    if path and not all(_is_safe_mongo_key(key) for key in itertools.chain(old, new)):
+        # Keys that cannot be used in a field path: set the whole dict.
+        update['$set'][path] = new
+        return
+    prefix = path + '.' if path else ''
+    for key, new_value in new.items():
+        if key in old:
+            _diff_mongo_values(old[key], new_value, prefix + key, update)
+        else:
+            update['$set'][prefix + key] = new_value
+    for key in old:
+        if key not in new:
+            update['$unset'][prefix + key] = ''
+
+
+def _diff_mongo_values(old, new, path, update):
+    if isinstance(old, dict) and isinstance(new, dict):
+        _diff_mongo_dicts(old, new, path, update)
+        return
+    if isinstance(old, list) and isinstance(new, list):
+        _diff_mongo_lists(old, new, path, update)
+        return
+    if type(old) is not type(new) or old != new:  # pylint: disable=unidiomatic-typecheck
+        update['$set'][path] = new
+
+
+def _diff_mongo_lists(old, new, path, update):
+    if len(old) == len(new):
+        for index, (old_value, new_value) in enumerate(zip(old, new)):
+            _diff_mongo_values(old_value, new_value, '{}.{:d}'.format(path, index), update)
+        return
+    if len(old) < len(new) and new[:len(old)] == old:
+        update['$push'][path] = {'$each': new[len(old):]}
+        return
+    update['$set'][path] = new
+
+
 def _cache_mongo_collection(mongo_iterator, cache, proto_type, update_func=None):
     """Cache in memory the content of a Mongo request returning protos.
 
@@ -130,20 +516,30 @@ def _cache_mongo_collection(mongo_iterator, cache, proto_type, update_func=None)
     return cache
 
 
+def _get_import_time(database, collection_name):
+    """Get the last time a collection was imported, as recorded by the importers."""
+    meta = database.meta.find_one({'_id': collection_name}, {'updated_at': 1})
+    return meta.get('updated_at') if meta else None
+
+
 class MongoCachedCollection(object):
     """Handler for a collection of protobuffers in MongoDB."""
 
-    def __init__(self, proto_type, collection_name, update_func=None):
+    def __init__(self, proto_type, collection_name, update_func=None, index_func=None):
         """Creates a new collection.
 
         Args:
             proto_type: the python proto class for the expected proto type.
             collection_name: a MongoDB collection_name that holds he original protobuffers.
             update_func: an optional function to call on each proto once imported.
+            index_func: an optional function to call on the whole cache each
+                time it is loaded. Its result is available as the index
+                property of the collection.
         """
         self._collection_name = collection_name
         self._proto_type = proto_type
         self._update_func = update_func
+        self._index_func = index_func
 
         self._cache = None
         self._database = None
@@ -153,7 +549,8 @@ class MongoCachedCollection(object):
         if self._cache and database == self._database:
             return self._cache
         self._database = database
-        self._cache = _MongoCachedCollection(self._populate)
+        self._cache = _MongoCachedCollection(
+            self._populate, get_import_time=self._get_import_time, index_func=self._index_func)
         return self._cache
 
     def reset_cache(self):
@@ -166,31 +563,349 @@ class MongoCachedCollection(object):
             self._database.get_collection(self._collection_name).find, cache,
             self._proto_type, self._update_func)
 
+    def _get_import_time(self):
+        return _get_import_time(self._database, self._collection_name)
+
+
+class _BloomFilter(object):
+    """A compact set of strings that can answer "maybe" for strings it does not hold.
+
+    It never answers False for a string it holds, and answers True for a
+    string it does not hold with a probability of about false_positive_rate.
+    """
+
+    def __init__(self, values, false_positive_rate):
+        values = list(values)
+        num_bits = max(8, int(-len(values) * math.log(false_positive_rate) / math.log(2) ** 2))
+        self._num_bits = num_bits
+        self._num_hashes = max(1, round(num_bits / max(1, len(values)) * math.log(2)))
+        self._bits = bytearray((num_bits + 7) // 8)
+        self._is_empty = not values
+        for value in values:
+            for bit in self._list_bits(value):
+                self._bits[bit >> 3] |= 1 << (bit & 7)
+
+    def _list_bits(self, value):
+        # Double hashing: two hashes are enough to simulate the k hash functions.
+        digest = hashlib.md5(value.encode('utf-8')).digest()
+        hash1 = int.from_bytes(digest[:8], 'little')
+        hash2 = int.from_bytes(digest[8:], 'little')
+        return ((hash1 + i * hash2) % self._num_bits for i in range(self._num_hashes))
+
+    def __contains__(self, value):
+        if self._is_empty:
+            return False
+        return all(self._bits[bit >> 3] & (1 << (bit & 7)) for bit in self._list_bits(value))
+
+
+class MongoCachedIds(object):
+    """Handler for the set of IDs of a MongoDB collection.
+
+    The IDs are kept in memory in a Bloom filter that only takes a few bits per
+    ID, so that checking an ID missing from the collection, the most frequent
+    case, does not need any request to MongoDB. The rare positive answers are
+    confirmed in MongoDB. The filter is reloaded when the collection gets
+    imported again.
+    """
+
+    def __init__(self, collection_name, false_positive_rate=.01):
+        """Creates a new set of IDs.
+
+        Args:
+            collection_name: a MongoDB collection_name whose IDs to check.
+            false_positive_rate: the rate of checks of missing IDs that still
+                need a request to MongoDB.
+        """
+        self._collection_name = collection_name
+        self._false_positive_rate = false_positive_rate
+
+        self._cache = None
+        self._database = None
+
+    def contains(self, database, document_id):
+        """Checks whether a document with the given ID exists in the collection."""
+        if not self._cache or database != self._database:
+            self._database = database
+            self._cache = _MongoCachedCollection(
+                self._populate, get_import_time=self._get_import_time,
+                index_func=self._make_filter)
+        if document_id not in self._cache.index:
+            return False
+        return bool(self._database.get_collection(self._collection_name).find(
+            {'_id': document_id}, {'_id': 1}).limit(1).count())
+
+    def reset_cache(self):
+        """Reset any cache that this function could hold."""
+        self._cache = None
+        self._database = None
+
+    def _populate(self, cache):
+        for document in self._database.get_collection(self._collection_name).find({}, {'_id': 1}):
+            cache[str(document['_id'])] = True
+
+    def _make_filter(self, cache):
+        bloom_filter = _BloomFilter(cache, self._false_positive_rate)
+        # Only the filter is kept: the full list of IDs would take much more memory.
+        cache.clear()
+        return bloom_filter
+
+    def _get_import_time(self):
+        return _get_import_time(self._database, self._collection_name)
+
 
 class _MongoCachedCollection(object):
+    """A snapshot of a collection, reloaded when it gets outdated.
+
+    If the importers recorded when the collection was imported, the snapshot is
+    only reloaded when it gets imported again. Otherwise it expires after
+    cache_duration.
+
+    When refreshing in background, an outdated snapshot keeps being served
+    while a single background thread reloads it, unless it expired more than
+    max_stale_duration ago. In any case only one thread at a time reloads it.
+    """
 
-    def __init__(self, populate, cache_duration=_CACHE_DURATION):
+    def __init__(
+            self, populate, cache_duration=_CACHE_DURATION, get_import_time=None,
+            max_stale_duration=_MAX_STALE_DURATION, refresh_in_background=None,
+            index_func=None):
         self._populate = populate
+        self._get_import_time = get_import_time
+        self._index_func = index_func
         self._cache = None
+        self._index = None
         self._cached_valid_until = None
         self._cache_duration = cache_duration
+        self._max_stale_duration = max_stale_duration
+        self._refresh_in_background = _REFRESH_CACHE_IN_BACKGROUND \
+            if refresh_in_background is None else refresh_in_background
+        self._imported_at = None
+        self._next_import_check = None
+        self._refreshed_at = None
+        # Lock held while reloading the snapshot.
+        self._refresh_lock = threading.Lock()
+        # Lock to start at most one background thread at a time.
+        self._background_lock = threading.Lock()
+        self._is_refreshing_in_background = False
 
     @property
     def is_cached(self):
         """Returns whether this object holds some cached data."""
         return bool(self._cache)
 
+    @property
+    def index(self):
+        """The index computed by index_func on the cached data."""
+        self._ensure_cache()
+        return self._index
+
+    def _is_outdated(self, now):
+        if self._cache is None:
+            return True
+        if self._get_import_time and self._next_import_check <= now:
+            self._next_import_check = now + _META_CHECK_INTERVAL
+            if self._get_import_time() != self._imported_at:
+                return True
+        if self._imported_at:
+            # The collection is only reloaded when imported again.
+            return False
+        return self._cached_valid_until < now
+
+    def _can_serve_stale(self, now):
+        if self._cache is None:
+            return False
+        return self._imported_at or now < self._cached_valid_until + self._max_stale_duration
+
     def _ensure_cache(self):
         now = datetime.datetime.utcnow()
-        if self._cached_valid_until and self._cached_valid_until >= now:
+        if not self._is_outdated(now):
             return self._cache
-        self._cached_valid_until = now + self._cache_duration
-        self._cache = collections.OrderedDict()
-        self._populate(self._cache)
+        if self._refresh_in_background and self._can_serve_stale(now):
+            self._start_background_refresh()
+            return self._cache
+        with self._refresh_lock:
+            if self._refreshed_at and self._refreshed_at >= now:
+                # Another thread refreshed it while we were waiting.
+                return self._cache
+            self._refresh()
         return self._cache
 
+    def _refresh(self):
+        now = datetime.datetime.utcnow()
+        imported_at = self._get_import_time() if self._get_import_time else None
+        cache = collections.OrderedDict()
+        self._populate(cache)
+        index = self._index_func(cache) if self._index_func else None
+        # Swap the new snapshot at once, so that concurrent readers never see a partial one.
+        self._index = index
+        self._cache = cache
+        self._imported_at = imported_at
+        self._cached_valid_until = now + self._cache_duration
+        self._next_import_check = now + _META_CHECK_INTERVAL
+        self._refreshed_at = datetime.datetime.utcnow()
+
+    def _start_background_refresh(self):
+        with self._background_lock:
+            if self._is_refreshing_in_background:
+                return
+            self._is_refreshing_in_background = True
+        threading.Thread(target=self._refresh_in_background_thread, daemon=True).start()
+
+    def _refresh_in_background_thread(self):
+        try:
+            with self._refresh_lock:
+                self._refresh()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Could not refresh a cached collection in the background.')
+        finally:
+            self._is_refreshing_in_background = False
+
     def __getattr__(self, prop):
         return getattr(self._ensure_cache(), prop)
 
     def __iter__(self):
         return iter(self.values())
+
+
+_CachedDocument = collections.namedtuple('CachedDocument', ['proto', 'valid_until'])
+
+
+class MongoCachedDocuments(object):
+    """Read-through cache of protobuffers from a MongoDB collection, accessed by ID.
+
+    Unlike MongoCachedCollection, it does not load the whole collection but
+    only the documents that are requested, and keeps at most max_size of them,
+    evicting the least recently used ones. Concurrent misses on the same ID are
+    deduplicated so that only one request to MongoDB is made. All documents are
+    dropped when the collection gets imported again.
+
+    The protos returned are shared across callers and should not be modified.
+    """
+
+    def __init__(self, proto_type, collection_name, max_size=1000, cache_duration=_CACHE_DURATION):
+        """Creates a new cache.
+
+        Args:
+            proto_type: the python proto class for the expected proto type.
+            collection_name: a MongoDB collection_name that holds the original protobuffers.
+            max_size: the maximum number of documents to keep in memory.
+            cache_duration: how long a document stays in the cache.
+        """
+        self._collection_name = collection_name
+        self._proto_type = proto_type
+        self._max_size = max_size
+        self._cache_duration = cache_duration
+
+        self._lock = threading.Lock()
+        # Cached documents keyed by ID, from least to most recently used.
+        self._cache = collections.OrderedDict()
+        # Events for IDs that are being fetched, keyed by ID.
+        self._pending = {}
+        self._database = None
+        self._imported_at = None
+        self._next_import_check = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_proto(self, database, document_id):
+        """Gets a proto by its ID, or None if it does not exist."""
+        return self.get_many(database, [document_id]).get(document_id)
+
+    def get_many(self, database, document_ids):
+        """Gets protos by their IDs, with all the misses fetched in one request.
+
+        Returns:
+            a dict of protos keyed by ID, with no entries for the documents
+            that do not exist.
+        """
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            if database != self._database:
+                self._reset_cache()
+                self._database = database
+        self._check_import(database, now)
+
+        result = {}
+        to_fetch = []
+        to_wait = {}
+        with self._lock:
+            for document_id in set(document_ids):
+                cached = self._cache.get(document_id)
+                if cached and cached.valid_until > now:
+                    self._cache.move_to_end(document_id)
+                    self.hits += 1
+                    if cached.proto is not None:
+                        result[document_id] = cached.proto
+                    continue
+                self.misses += 1
+                if document_id in self._pending:
+                    to_wait[document_id] = self._pending[document_id]
+                else:
+                    self._pending[document_id] = threading.Event()
+                    to_fetch.append(document_id)
+
+        if to_fetch:
+            result.update(self._fetch(database, to_fetch))
+
+        retry_ids = []
+        for document_id, pending in to_wait.items():
+            pending.wait()
+            with self._lock:
+                cached = self._cache.get(document_id)
+            if not cached:
+                # The other fetch failed, let's try again ourselves.
+                retry_ids.append(document_id)
+            elif cached.proto is not None:
+                result[document_id] = cached.proto
+        if retry_ids:
+            result.update(self.get_many(database, retry_ids))
+
+        return result
+
+    def _check_import(self, database, now):
+        with self._lock:
+            if self._next_import_check and self._next_import_check > now:
+                return
+            self._next_import_check = now + _META_CHECK_INTERVAL
+        imported_at = _get_import_time(database, self._collection_name)
+        with self._lock:
+            if imported_at != self._imported_at:
+                self._cache.clear()
+                self._imported_at = imported_at
+
+    def _fetch(self, database, document_ids):
+        fetched = {}
+        try:
+            for document in database.get_collection(self._collection_name).find(
+                    {'_id': {'$in': document_ids}}):
+                document_id = document['_id']
+                proto = self._proto_type()
+                if parse_from_mongo(document, proto):
+                    fetched[document_id] = proto
+        except Exception:
+            with self._lock:
+                for document_id in document_ids:
+                    self._pending.pop(document_id).set()
+            raise
+
+        with self._lock:
+            valid_until = datetime.datetime.utcnow() + self._cache_duration
+            for document_id in document_ids:
+                # Missing documents are cached as well, as None.
+                self._cache[document_id] = _CachedDocument(fetched.get(document_id), valid_until)
+                self._cache.move_to_end(document_id)
+                self._pending.pop(document_id).set()
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+        return fetched
+
+    def reset_cache(self):
+        """Reset any cache that this object could hold."""
+        with self._lock:
+            self._reset_cache()
+
+    def _reset_cache(self):
+        self._cache.clear()
+        self._database = None
+        self._imported_at = None
+        self._next_import_check = None
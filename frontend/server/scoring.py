@@ -4,6 +4,7 @@
 See design doc at http://go/bob:scoring-advices.
 """
 import collections
+from concurrent import futures
 import datetime
 import functools
 from importlib import util as importlib_util
@@ -17,6 +18,7 @@ from urllib import parse
 import unidecode
 
 from bob_emploi.frontend import companies
+from bob_emploi.frontend import fetcher
 from bob_emploi.frontend import french
 from bob_emploi.frontend import proto
 from bob_emploi.frontend import carif
@@ -28,6 +30,9 @@ from bob_emploi.frontend.api import project_pb2
 from bob_emploi.frontend.api import training_pb2
 from bob_emploi.frontend.api import user_pb2
 
+# TODO(pascal): Split this module, e.g. move the scoring models to their own modules.
+# pylint: disable=too-many-lines
+
 
 # Score for each percent of additional job offers that an advice enables. We
 # want to have a score of 3 for 30% increase.
@@ -49,10 +54,19 @@ _WEEKS_PER_MONTH = 52 / 12
 # Maximum of the estimation scale for English skills, or office tools.
 _ESTIMATION_SCALE_MAX = 3
 
-_APPLICATION_TIPS = proto.MongoCachedCollection(application_pb2.ApplicationTip, 'application_tips')
+# Caches (from MongoDB) of market data accessed by ID. All job groups fit in
+# the cache, but only the most used local diagnosis are kept.
+_JOB_GROUP_INFO = proto.MongoCachedDocuments(job_pb2.JobGroup, 'job_group_info', max_size=1000)
+_LOCAL_DIAGNOSIS = proto.MongoCachedDocuments(
+    job_pb2.LocalJobStats, 'local_diagnosis', max_size=10000)
+
+
+def _fetch_trainings(rome_id, departement_id):
+    return carif.fetch_trainings(rome_id, departement_id)
 
-_SPECIFIC_TO_JOB_ADVICE = proto.MongoCachedCollection(
-    advisor_pb2.DynamicAdvice, 'specific_to_job_advice')
+
+# Cache of trainings from our partner's API.
+_TRAININGS = fetcher.CachedFetcher(_fetch_trainings, name='CARIF trainings')
 
 _EXPERIENCE_DURATION = {
     project_pb2.INTERNSHIP: 'peu',
@@ -64,6 +78,13 @@ _EXPERIENCE_DURATION = {
 # Matches variables that need to be replaced by populate_template.
 _TEMPLATE_VAR = re.compile('.*%[a-z]+')
 
+# Collections of market data that scoring models read by ID, keyed by
+# collection name. See register_prefetch.
+_PREFETCHED_COLLECTIONS = {}
+
+# Pool of threads to run the prefetch queries concurrently.
+_PREFETCH_EXECUTOR = futures.ThreadPoolExecutor(max_workers=8)
+
 
 class ScoringProject(object):
     """The project and its environment for the scoring.
@@ -89,6 +110,10 @@ class ScoringProject(object):
         self._best_departements = None
         self._seasonal_departements = None
         self._module_cache = {}
+        # Values of the template variables, see populate_template.
+        self._template_vars = {}
+        # Market data documents keyed by (collection name, ID), see get_document.
+        self._documents = {}
 
     # When scoring models need it, add methods to access data from DB:
     # project requirements from job offers, IMT, median unemployment duration
@@ -99,13 +124,9 @@ class ScoringProject(object):
         if self._local_diagnosis is not None:
             return self._local_diagnosis
 
-        self._local_diagnosis = job_pb2.LocalJobStats()
-        local_id = '{}:{}'.format(
-            self.details.mobility.city.departement_id,
-            self.details.target_job.job_group.rome_id)
-        # TODO(pascal): Handle when return is False (no data).
-        proto.parse_from_mongo(
-            self._db.local_diagnosis.find_one({'_id': local_id}), self._local_diagnosis)
+        # TODO(pascal): Handle when there is no data.
+        self._local_diagnosis = _LOCAL_DIAGNOSIS.get_proto(
+            self._db, _get_local_diagnosis_id(self.details)) or job_pb2.LocalJobStats()
 
         return self._local_diagnosis
 
@@ -150,15 +171,31 @@ class ScoringProject(object):
         """Access to the MongoDB behind this project."""
         return self._db
 
+    def get_document(self, collection_name, document_id):
+        """Get a document of market data from MongoDB by its ID.
+
+        The document comes from the prefetched data if any (see prefetch),
+        otherwise it is fetched and kept for later calls. It may be shared with
+        other projects, so it should only be read or parsed with
+        proto.parse_from_mongo.
+
+        Returns:
+            the document as a dict, or None if it does not exist.
+        """
+        key = (collection_name, document_id)
+        if key in self._documents:
+            return self._documents[key]
+        document = self._db.get_collection(collection_name).find_one({'_id': document_id})
+        self._documents[key] = document
+        return document
+
     def job_group_info(self):
         """Get the info for job group info."""
         if self._job_group_info is not None:
             return self._job_group_info
 
-        self._job_group_info = job_pb2.JobGroup()
-        proto.parse_from_mongo(
-            self._db.job_group_info.find_one({'_id': self._rome_id()}),
-            self._job_group_info)
+        self._job_group_info = _JOB_GROUP_INFO.get_proto(self._db, self._rome_id()) or \
+            job_pb2.JobGroup()
         return self._job_group_info
 
     def requirements(self):
@@ -180,24 +217,34 @@ class ScoringProject(object):
         """Get the training opportunities from our partner's API."""
         if self._trainings is not None:
             return self._trainings
-        self._trainings = carif.get_trainings(
-            self.details.target_job.job_group.rome_id, self.details.mobility.city.departement_id)
+        try:
+            self._trainings = _TRAININGS.get_value(*self._trainings_key()) or []
+        except IOError as error:
+            # Errors are not cached so the next project will try again.
+            logging.warning('XML request for intercarif failed:\n%s', error)
+            self._trainings = []
         return self._trainings
 
+    def prefetch_trainings(self):
+        """Start getting the training opportunities in the background."""
+        _TRAININGS.prefetch(*self._trainings_key())
+
+    def _trainings_key(self):
+        return self.details.target_job.job_group.rome_id, self.details.mobility.city.departement_id
+
     def list_application_tips(self):
         """List all application tips available for this project."""
         if self._application_tips:
             return self._application_tips
 
         all_application_tips = _APPLICATION_TIPS.get_collection(self._db)
-        self._application_tips = list(filter_using_score(
-            all_application_tips, lambda j: j.filters, self))
+        self._application_tips = all_application_tips.index.filter(self)
         return self._application_tips
 
     def specific_to_job_advice_config(self):
         """Find the first specific to job advice config that matches this project."""
         _configs = _SPECIFIC_TO_JOB_ADVICE.get_collection(self._db)
-        return next(filter_using_score(_configs, lambda c: c.filters, self), None)
+        return next(iter(_configs.index.filter(self)), None)
 
     def populate_template(self, template):
         """Populate a template with project variables.
@@ -210,42 +257,184 @@ class ScoringProject(object):
         """
         if '%' not in template:
             return template
-        city = self.details.mobility.city
-        job = self.details.target_job
-        is_feminine = self.user_profile.gender == user_pb2.FEMININE
-        genderized_determiner = 'une' if is_feminine else 'un'
-        genderized_job_name = french.lower_first_letter(
-            (job.feminine_name if is_feminine else job.masculine_name) or job.name)
-        project_vars = {
-            '%aJobName': '{} {}'.format(genderized_determiner, genderized_job_name),
-            '%cityId': city.city_id,
-            '%cityName': parse.quote(city.name),
-            '%inCity': french.in_city(city.name),
-            '%inDomain': self.job_group_info().in_domain,
-            '%ofCity': french.of_city(city.name),
-            '%experienceDuration': _EXPERIENCE_DURATION.get(self.details.seniority),
-            '%latin1CityName': parse.quote(city.name.encode('latin-1', 'replace')),
-            '%departementId': city.departement_id,
-            '%postcode': city.postcodes.split('-')[0] or (
-                city.departement_id + '0' * (5 - len(city.departement_id))),
-            '%regionId': city.region_id,
-            '%romeId': job.job_group.rome_id,
-            '%jobId': job.code_ogr,
-            '%jobName': genderized_job_name,
-            '%ofJobName': french.maybe_contract_prefix('de ', "d'", genderized_job_name),
-            '%jobGroupNameUrl': parse.quote(unidecode.unidecode(
-                job.job_group.name.lower().replace(' ', '-').replace("'", '-'))),
-            '%masculineJobName': parse.quote(job.masculine_name),
-            '%latin1MasculineJobName': parse.quote(job.masculine_name.encode('latin-1', 'replace')),
-        }
-        pattern = re.compile('|'.join(project_vars.keys()))
-        new_template = pattern.sub(lambda v: project_vars[v.group(0)], template)
-        if _TEMPLATE_VAR.match(new_template):
+        parts, has_unknown_vars = _compile_template(template)
+        # Parts at odd indices are the names of the variables.
+        new_template = ''.join(
+            self._get_template_var(part) if index % 2 else part
+            for index, part in enumerate(parts))
+        if has_unknown_vars:
             logging.warning(
                 'One or more template variables have not been replaced in:\n%s',
                 new_template)
         return new_template
 
+    def _get_template_var(self, name):
+        try:
+            return self._template_vars[name]
+        except KeyError:
+            value = _TEMPLATE_VARIABLES[name](self)
+            self._template_vars[name] = value
+            return value
+
+
+def _get_job_name(project):
+    job = project.details.target_job
+    is_feminine = project.user_profile.gender == user_pb2.FEMININE
+    return french.lower_first_letter(
+        (job.feminine_name if is_feminine else job.masculine_name) or job.name)
+
+
+def _get_a_job_name(project):
+    is_feminine = project.user_profile.gender == user_pb2.FEMININE
+    return '{} {}'.format('une' if is_feminine else 'un', _get_job_name(project))
+
+
+def _get_postcode(project):
+    city = project.details.mobility.city
+    return city.postcodes.split('-')[0] or (
+        city.departement_id + '0' * (5 - len(city.departement_id)))
+
+
+def _get_job_group_name_url(project):
+    return parse.quote(unidecode.unidecode(
+        project.details.target_job.job_group.name.lower().replace(' ', '-').replace("'", '-')))
+
+
+# Functions to compute the value of each template variable for a ScoringProject.
+_TEMPLATE_VARIABLES = {
+    '%aJobName': _get_a_job_name,
+    '%cityId': lambda project: project.details.mobility.city.city_id,
+    '%cityName': lambda project: parse.quote(project.details.mobility.city.name),
+    '%inCity': lambda project: french.in_city(project.details.mobility.city.name),
+    '%inDomain': lambda project: project.job_group_info().in_domain,
+    '%ofCity': lambda project: french.of_city(project.details.mobility.city.name),
+    '%experienceDuration': lambda project: _EXPERIENCE_DURATION.get(project.details.seniority, ''),
+    '%latin1CityName': lambda project: parse.quote(
+        project.details.mobility.city.name.encode('latin-1', 'replace')),
+    '%departementId': lambda project: project.details.mobility.city.departement_id,
+    '%postcode': _get_postcode,
+    '%regionId': lambda project: project.details.mobility.city.region_id,
+    '%romeId': lambda project: project.details.target_job.job_group.rome_id,
+    '%jobId': lambda project: project.details.target_job.code_ogr,
+    '%jobName': _get_job_name,
+    '%ofJobName': lambda project: french.maybe_contract_prefix(
+        'de ', "d'", _get_job_name(project)),
+    '%jobGroupNameUrl': _get_job_group_name_url,
+    '%masculineJobName': lambda project: parse.quote(project.details.target_job.masculine_name),
+    '%latin1MasculineJobName': lambda project: parse.quote(
+        project.details.target_job.masculine_name.encode('latin-1', 'replace')),
+}
+
+# Matches the template variables, and captures them.
+_TEMPLATE_VARIABLES_REGEXP = re.compile('({})'.format('|'.join(_TEMPLATE_VARIABLES)))
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile_template(template):
+    """Split a template in literal parts and names of variables.
+
+    Returns:
+        a tuple with the list of parts, literal parts at even indices and
+        names of variables at odd indices, and whether the template has
+        variables that cannot be replaced.
+    """
+    parts = tuple(_TEMPLATE_VARIABLES_REGEXP.split(template))
+    has_unknown_vars = any(_TEMPLATE_VAR.match(part) for part in parts[::2])
+    return parts, has_unknown_vars
+
+
+def _get_local_diagnosis_id(project):
+    return '{}:{}'.format(
+        project.mobility.city.departement_id, project.target_job.job_group.rome_id)
+
+
+def register_prefetch(collection_name, get_ids):
+    """Register a collection of market data that scoring models read by ID.
+
+    Args:
+        collection_name: the name of the MongoDB collection, the documents are
+            then accessed with ScoringProject.get_document.
+        get_ids: a function that takes a ScoringProject and returns the list
+            of IDs of the documents it would need in this collection.
+    """
+    if collection_name in _PREFETCHED_COLLECTIONS:
+        raise ValueError('The collection "{}" is already prefetched.'.format(collection_name))
+    _PREFETCHED_COLLECTIONS[collection_name] = get_ids
+
+
+def prefetch(scoring_projects):
+    """Fetch in advance the market data that the scoring models read by ID.
+
+    Instead of the chain of round trips that the scoring models would do
+    lazily, this runs one `$in` query per registered collection (and for the
+    missing IDs of the local diagnosis and job group info caches), all of them
+    concurrently, and populates the projects' caches with the results.
+
+    Args:
+        scoring_projects: a list of ScoringProject sharing the same database.
+    """
+    if not scoring_projects:
+        return
+    database = scoring_projects[0].database
+
+    def _fetch(collection_name, document_ids):
+        collection = database.get_collection(collection_name)
+        return {d['_id']: d for d in collection.find({'_id': {'$in': list(document_ids)}})}
+
+    local_diagnosis_ids = [_get_local_diagnosis_id(p.details) for p in scoring_projects]
+    pending_local_diagnosis = _PREFETCH_EXECUTOR.submit(
+        _LOCAL_DIAGNOSIS.get_many, database, local_diagnosis_ids)
+    rome_ids = [p.details.target_job.job_group.rome_id for p in scoring_projects]
+    pending_job_group_info = _PREFETCH_EXECUTOR.submit(
+        _JOB_GROUP_INFO.get_many, database, rome_ids)
+
+    project_ids = {}
+    pending_fetches = {}
+    for collection_name, get_ids in _PREFETCHED_COLLECTIONS.items():
+        project_ids[collection_name] = [get_ids(project) for project in scoring_projects]
+        document_ids = set(itertools.chain.from_iterable(project_ids[collection_name]))
+        pending_fetches[collection_name] = _PREFETCH_EXECUTOR.submit(
+            _fetch, collection_name, document_ids)
+
+    for collection_name, pending_fetch in pending_fetches.items():
+        documents = pending_fetch.result()
+        for project, document_ids in zip(scoring_projects, project_ids[collection_name]):
+            for document_id in document_ids:
+                # pylint: disable=protected-access
+                project._documents[(collection_name, document_id)] = documents.get(document_id)
+
+    local_diagnosis = pending_local_diagnosis.result()
+    job_group_info = pending_job_group_info.result()
+    for project, local_diagnosis_id, rome_id in zip(
+            scoring_projects, local_diagnosis_ids, rome_ids):
+        # pylint: disable=protected-access
+        project._local_diagnosis = \
+            local_diagnosis.get(local_diagnosis_id) or job_pb2.LocalJobStats()
+        project._job_group_info = job_group_info.get(rome_id) or job_pb2.JobGroup()
+
+
+def clear_cache():
+    """Clear all caches for this module."""
+    _APPLICATION_TIPS.reset_cache()
+    _SPECIFIC_TO_JOB_ADVICE.reset_cache()
+    _JOB_GROUP_INFO.reset_cache()
+    _LOCAL_DIAGNOSIS.reset_cache()
+    _TRAININGS.reset_cache()
+    companies.clear_cache()
+
+
+def get_cache_stats():
+    """Get the number of hits and misses of the caches of this module, by cache name."""
+    stats = {
+        name: (cache.hits, cache.misses)
+        for name, cache in (
+            ('job_group_info', _JOB_GROUP_INFO),
+            ('local_diagnosis', _LOCAL_DIAGNOSIS),
+            ('trainings', _TRAININGS))
+    }
+    stats.update(companies.get_cache_stats())
+    return stats
+
 
 class ModelBase(object):
     """A base/default scoring model.
@@ -285,6 +474,10 @@ class _AdviceTrainingScoringModel(ModelBase):
         """Compute extra data for this module to render a card in the client."""
         return training_pb2.Trainings(trainings=project.get_trainings())
 
+    def prefetch(self, project):
+        """Start fetching the trainings for the given ScoringProject."""
+        project.prefetch_trainings()
+
     def score(self, project):
         """Compute a score for the given ScoringProject."""
         # TODO(guillaume): Get the score for each project from lbf.
@@ -339,6 +532,10 @@ class _AdviceSpecificToJob(ModelBase):
 class _SpontaneousApplicationScoringModel(ModelBase):
     """A scoring model for the "Send spontaneous applications" advice module."""
 
+    def prefetch(self, project):
+        """Start fetching the companies for the given ScoringProject."""
+        companies.prefetch_lbb_companies(project.details)
+
     def score(self, project):
         """Compute a score for the given ScoringProject."""
         application_modes = project.job_group_info().application_modes.values()
@@ -811,6 +1008,78 @@ def filter_using_score(iterable, get_scoring_func, project):
             yield item
 
 
+class FilterIndex(object):
+    """An inverted index of the filters of a collection of items.
+
+    For each scoring model used as a filter, it keeps the set of items using it
+    as a bitset. Filtering the items for a project then costs one score per
+    distinct filter and a few bitset operations, instead of going through the
+    filters of each item.
+    """
+
+    def __init__(self, items):
+        """Index a collection of items.
+
+        Args:
+            items: a dict of items keyed by ID, each of them having a filters
+                field with a list of scoring model names.
+        """
+        self._items = list(items.values())
+        self._positions = {key: position for position, key in enumerate(items)}
+        self._all_items = (1 << len(self._items)) - 1
+        items_per_filter = collections.defaultdict(int)
+        for position, item in enumerate(self._items):
+            for filter_name in item.filters:
+                items_per_filter[filter_name] |= 1 << position
+        # Check the most used filters first as they can exclude more items at once.
+        self._items_per_filter = sorted(
+            items_per_filter.items(), key=lambda f: bin(f[1]).count('1'), reverse=True)
+
+    def filter(self, project, keys=None):
+        """List the items that pass all their filters for a project.
+
+        Args:
+            project: the ScoringProject to filter for.
+            keys: an optional list of IDs to restrict the items to. The result
+                then follows the order of this list. Unknown IDs are ignored.
+        Returns:
+            a list of items.
+        """
+        if keys is None:
+            positions = None
+            candidates = self._all_items
+        else:
+            positions = [self._positions[key] for key in keys if key in self._positions]
+            candidates = 0
+            for position in positions:
+                candidates |= 1 << position
+
+        helper = _FilterHelper(project)
+        for filter_name, filtered_items in self._items_per_filter:
+            if candidates & filtered_items and not helper.apply([filter_name]):
+                candidates &= ~filtered_items
+
+        if positions is None:
+            positions = _list_bit_positions(candidates)
+        return [self._items[position] for position in positions if candidates >> position & 1]
+
+
+def _list_bit_positions(bitset):
+    positions = []
+    while bitset:
+        lowest_bit = bitset & -bitset
+        positions.append(lowest_bit.bit_length() - 1)
+        bitset ^= lowest_bit
+    return positions
+
+
+_APPLICATION_TIPS = proto.MongoCachedCollection(
+    application_pb2.ApplicationTip, 'application_tips', index_func=FilterIndex)
+
+_SPECIFIC_TO_JOB_ADVICE = proto.MongoCachedCollection(
+    advisor_pb2.DynamicAdvice, 'specific_to_job_advice', index_func=FilterIndex)
+
+
 def _load_module(name):
     """Loads an advice module."""
     spec = importlib_util.spec_from_file_location(
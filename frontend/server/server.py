@@ -9,6 +9,7 @@ import collections
 import datetime
 import hashlib
 import itertools
+import json
 import logging
 import os
 import re
@@ -23,13 +24,15 @@ from google.protobuf import message
 from google.protobuf import timestamp_pb2
 import pymongo
 from raven.contrib import flask as raven_flask
-import requests
 from werkzeug.contrib import fixers
 
 from bob_emploi.frontend import action
 from bob_emploi.frontend import advisor
 from bob_emploi.frontend import auth
 from bob_emploi.frontend import evaluation
+from bob_emploi.frontend import http_client
+from bob_emploi.frontend import metrics
+from bob_emploi.frontend import migration
 from bob_emploi.frontend import now
 from bob_emploi.frontend import proto
 from bob_emploi.frontend import scoring
@@ -44,13 +47,17 @@ from bob_emploi.frontend.api import stats_pb2
 from bob_emploi.frontend.api import user_pb2
 from bob_emploi.frontend.api import export_pb2
 
+# TODO(pascal): Split this module, e.g. move the usage stats and the batch endpoints.
+# pylint: disable=too-many-lines
+
 app = flask.Flask(__name__)  # pylint: disable=invalid-name
 # Get original host and scheme used before proxies (load balancer, nginx, etc).
 app.wsgi_app = fixers.ProxyFix(app.wsgi_app)
 
 
-_DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
-    .get_default_database()
+_DB = pymongo.MongoClient(
+    os.getenv('MONGO_URL', 'mongodb://localhost/test'),
+    event_listeners=[advisor.ModelCommandListener()]).get_default_database()
 
 _SERVER_TAG = {'_server': os.getenv('SERVER_VERSION', 'dev')}
 
@@ -110,13 +117,46 @@ def delete_user(user_data):
 def get_user(user_id):
     """Return the user identified by user_id.
 
+    If the client already has the latest version of the user, as identified by
+    the ETag that it sends in If-None-Match, the response is a 304 without
+    any content.
+
     Returns: The data for a user identified by user_id.
     """
-    user_proto = _get_user_data(user_id)
+    if flask.request.if_none_match:
+        stored_revisions = _DB.user.find_one(
+            {'_id': _safe_object_id(user_id)},
+            {'revision': 1, migration.EXTERNAL_REVISION_FIELD: 1})
+        if stored_revisions:
+            etag = _get_user_etag(user_id, stored_revisions)
+            if flask.request.if_none_match.contains_weak(etag):
+                not_modified = flask.Response(status=304)
+                not_modified.set_etag(etag, weak=True)
+                flask.abort(not_modified)
+
+    user_proto, stored_user_dict = _load_user_data(user_id)
     user_proto.user_id = user_id
+    etag = _get_user_etag(user_id, stored_user_dict)
+
+    @flask.after_this_request
+    def _set_etag(response):
+        if response.status_code == 200:
+            response.set_etag(etag, weak=True)
+        return response
+
     return user_proto
 
 
+def _get_user_etag(user_id, stored_user_dict):
+    # The data sent for the same revisions only changes when the server
+    # changes, e.g. with new migrations or feature flags. The ETag is weak as
+    # the data is compressed or not depending on the request.
+    return hashlib.sha1('{}:{:d}:{:d}:{}'.format(
+        user_id, stored_user_dict.get('revision', 0),
+        stored_user_dict.get(migration.EXTERNAL_REVISION_FIELD, 0),
+        _SERVER_TAG['_server']).encode('utf-8')).hexdigest()
+
+
 @app.route('/api/user', methods=['POST'])
 @proto.flask_api(in_type=user_pb2.User, out_type=user_pb2.User)
 @auth.require_user(lambda user_data: user_data.user_id)
@@ -145,8 +185,9 @@ def user_likes(user_data):
         if '.' in key or '$' in key:
             flask.abort(422, 'Liked feature IDs cannot contain . or $, got "{}"'.format(key))
     result = _DB.user.update_one(
-        {'_id': _safe_object_id(user_data.user_id)}, {'$set': {
-            'likes.{}'.format(key): value for key, value in user_data.likes.items()}},
+        {'_id': _safe_object_id(user_data.user_id)},
+        migration.mark_external_update({'$set': {
+            'likes.{}'.format(key): value for key, value in user_data.likes.items()}}),
         upsert=False)
     if not result.matched_count:
         flask.abort(404, 'Utilisateur "{}" inconnu.'.format(user_data.user_id))
@@ -183,19 +224,43 @@ def compute_advices_for_project(user_proto):
     return advisor.compute_advices_for_project(user_proto, user_proto.projects[0], _DB)
 
 
+@app.route('/api/project/compute-advices/batch', methods=['POST'])
+@auth.require_admin
+@proto.flask_api(in_type=user_pb2.Users)
+def compute_advices_for_users(users):
+    """Advise on the first project of many users.
+
+    The response is streamed as one UserAdvices JSON object per line, in the
+    order in which they are computed.
+    """
+    if not users.users:
+        flask.abort(422, 'There is no input user to advise on.')
+    if not all(user.projects for user in users.users):
+        flask.abort(422, 'There is no input project to advise on for some users.')
+
+    def _generate_lines():
+        for index, advices in advisor.compute_advices_for_users(users.users, _DB):
+            user_advices = user_pb2.UserAdvices(user_index=index, advices=advices.advices)
+            yield json.dumps(
+                json_format.MessageToDict(user_advices),
+                ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    return flask.Response(_generate_lines(), mimetype='application/x-ndjson')
+
+
 @app.route('/api/app/use/<user_id>', methods=['POST'])
 @proto.flask_api(out_type=user_pb2.User)
 @auth.require_user(lambda user_id: user_id)
 def use_app(user_id):
     """Update the user's data to mark that they have just used the app."""
-    user_proto = _get_user_data(user_id)
+    user_proto, stored_user_dict = _load_user_data(user_id)
     start_of_day = now.get().replace(hour=0, minute=0, second=0, microsecond=0)
     if user_proto.requested_by_user_at_date.ToDatetime() >= start_of_day:
         return user_proto
     user_proto.requested_by_user_at_date.FromDatetime(now.get())
     # No need to pollute our DB with super precise timestamps.
     user_proto.requested_by_user_at_date.nanos = 0
-    return _save_user(user_proto, is_new_user=False)
+    return _save_user(user_proto, is_new_user=False, stored_user_dict=stored_user_dict)
 
 
 def _get_feedback_context(feedback):
@@ -216,17 +281,23 @@ def _get_feedback_context(feedback):
     return '{}{}{}'.format(name, title, experience)
 
 
-def _save_user(user_data, is_new_user):
+def _save_user(user_data, is_new_user, stored_user_dict=None):
     _tick('Save user start')
 
     if is_new_user:
         previous_user_data = user_data
     else:
-        _tick('Load old user data')
-        previous_user_data = _get_user_data(user_data.user_id)
+        if stored_user_dict is None:
+            _tick('Load old user data')
+            previous_user_data, stored_user_dict = _load_user_data(
+                user_data.user_id, save_migration=False)
+        else:
+            previous_user_data = _parse_stored_user(user_data.user_id, stored_user_dict)
         if user_data.revision and previous_user_data.revision > user_data.revision:
             # Do not overwrite newer data that was saved already: just return it.
             return previous_user_data
+        if not user_data.revision:
+            user_data.revision = previous_user_data.revision
 
     if not previous_user_data.registered_at.seconds:
         user_data.registered_at.FromDatetime(now.get())
@@ -241,11 +312,7 @@ def _save_user(user_data, is_new_user):
         # Send an NPS email the next day.
         user_data.features_enabled.net_promoter_score_email = user_pb2.NPS_EMAIL_PENDING
     else:
-        user_data.registered_at.CopyFrom(previous_user_data.registered_at)
-        if not _is_test_user(previous_user_data):
-            user_data.features_enabled.advisor = previous_user_data.features_enabled.advisor
-            user_data.features_enabled.net_promoter_score_email = \
-                previous_user_data.features_enabled.net_promoter_score_email
+        _copy_registration_fields(previous_user_data, user_data)
 
     _tick('Unverified data zone check start')
     # TODO(guillaume): Check out how we could not recompute that every time gracefully.
@@ -255,7 +322,12 @@ def _save_user(user_data, is_new_user):
 
     _populate_feature_flags(user_data)
 
-    for project in user_data.projects:
+    _tick('Prefetch market data')
+    scoring_projects = advisor.prefetch_scoring_projects(user_data, _DB)
+
+    base_url = parse.urljoin(flask.request.base_url, '/')[:-1]
+    advised_projects = []
+    for project, scoring_project in zip(user_data.projects, scoring_projects):
         if project.is_incomplete:
             continue
         _tick('Process project start')
@@ -272,35 +344,21 @@ def _save_user(user_data, is_new_user):
                 {rome_id: project.local_stats}, project.mobility.city)
 
         _tick('Advisor')
-        advisor.maybe_advise(
-            user_data, project, _DB, parse.urljoin(flask.request.base_url, '/')[:-1])
-
-        _tick('New feedback')
-        if not is_new_user and (project.feedback.text or project.feedback.score):
-            previous_project = next(
-                (p for p in previous_user_data.projects if p.project_id == project.project_id),
-                project_pb2.Project())
-            if project.feedback.score > 2 and not previous_project.feedback.score:
-                score_text = ':sparkles: General feedback score: {}'.format(
-                    ':star:' * project.feedback.score)
-            else:
-                score_text = ''
-            if project.feedback.text and not previous_project.feedback.text:
-                _give_feedback(feedback_pb2.Feedback(
-                    user_id=str(user_data.user_id),
-                    project_id=str(project.project_id),
-                    feedback=project.feedback.text,
-                    source=feedback_pb2.PROJECT_FEEDBACK), extra_text=score_text)
-            else:
-                _tell_slack(score_text)
+        if advisor.maybe_advise(
+                user_data, project, _DB, base_url, scoring_project=scoring_project,
+                send_email=False):
+            advised_projects.append(project)
 
         _tick('Process project end')
 
     if not is_new_user:
         _assert_no_credentials_change(previous_user_data, user_data)
         _copy_unmodifiable_fields(previous_user_data, user_data)
+        _copy_externally_updated_fields(previous_user_data, user_data)
         _populate_feature_flags(user_data)
 
+    # Outdated clients may still send old fields.
+    migration.migrate_user(user_data)
     user_data.revision += 1
 
     # Modifications on user_data after this point will not be saved.
@@ -311,12 +369,86 @@ def _save_user(user_data, is_new_user):
         user_dict['_id'] = _get_unguessable_object_id()
         result = _DB.user.insert_one(user_dict)
         user_data.user_id = str(result.inserted_id)
-    else:
-        _DB.user.replace_one({'_id': _safe_object_id(user_data.user_id)}, user_dict)
+    elif not _update_user_from_stored(user_data.user_id, stored_user_dict, user_dict):
+        return _load_user_data(user_data.user_id, save_migration=False)[0]
+
+    # Only notify once the user is saved.
+    _tick('Side effects')
+    for project in advised_projects:
+        advisor.send_activation_email(user_data, project, _DB, base_url)
+    if not is_new_user:
+        _notify_new_feedback(previous_user_data, user_data)
+
     _tick('Return user proto')
     return user_data
 
 
+# Fields of a user that are updated in place by other endpoints and by batch
+# jobs, e.g. with $push, without changing its revision. Saving a user never
+# writes them, so that a client with an outdated copy cannot overwrite them.
+_EXTERNALLY_UPDATED_FIELDS = ('emails_sent', 'employment_status')
+
+# The names of those fields in MongoDB: some of them are stored without their
+# JSON name.
+_EXTERNALLY_UPDATED_KEYS = frozenset(
+    name for field in _EXTERNALLY_UPDATED_FIELDS
+    for name in (field, user_pb2.User.DESCRIPTOR.fields_by_name[field].json_name))
+
+
+def _update_user_from_stored(user_id, stored_user_dict, user_dict):
+    """Update a user with only the fields that changed since it was loaded.
+
+    Returns:
+        False if the user was saved concurrently since it was loaded.
+    """
+    update = proto.get_mongo_update(
+        _drop_externally_updated_keys(stored_user_dict), _drop_externally_updated_keys(user_dict))
+    if not update:
+        return True
+    result = _DB.user.update_one(
+        {'_id': _safe_object_id(user_id), 'revision': stored_user_dict.get('revision')},
+        update)
+    if result.matched_count:
+        return True
+    logging.warning('User %s was saved concurrently', user_id)
+    return False
+
+
+def _drop_externally_updated_keys(user_dict):
+    return {
+        key: value for key, value in user_dict.items() if key not in _EXTERNALLY_UPDATED_KEYS}
+
+
+def _copy_registration_fields(previous_user_data, user_data):
+    user_data.registered_at.CopyFrom(previous_user_data.registered_at)
+    if not _is_test_user(previous_user_data):
+        user_data.features_enabled.advisor = previous_user_data.features_enabled.advisor
+        user_data.features_enabled.net_promoter_score_email = \
+            previous_user_data.features_enabled.net_promoter_score_email
+
+
+def _notify_new_feedback(previous_user_data, user_data):
+    for project in user_data.projects:
+        if project.is_incomplete or not (project.feedback.text or project.feedback.score):
+            continue
+        previous_project = next(
+            (p for p in previous_user_data.projects if p.project_id == project.project_id),
+            project_pb2.Project())
+        if project.feedback.score > 2 and not previous_project.feedback.score:
+            score_text = ':sparkles: General feedback score: {}'.format(
+                ':star:' * project.feedback.score)
+        else:
+            score_text = ''
+        if project.feedback.text and not previous_project.feedback.text:
+            _give_feedback(feedback_pb2.Feedback(
+                user_id=str(user_data.user_id),
+                project_id=str(project.project_id),
+                feedback=project.feedback.text,
+                source=feedback_pb2.PROJECT_FEEDBACK), extra_text=score_text)
+        else:
+            _tell_slack(score_text)
+
+
 def _create_new_project_id(user_data):
     existing_ids = set(p.project_id for p in user_data.projects) |\
         set(p.project_id for p in user_data.deleted_projects)
@@ -338,20 +470,15 @@ def _get_unguessable_object_id():
     return objectid.ObjectId(salter.hexdigest()[:24])
 
 
-_SHOW_UNVERIFIED_DATA_USERS = set()
-
+_SHOW_UNVERIFIED_DATA_USERS = proto.MongoCachedIds('show_unverified_data_users')
 
-def _show_unverified_data_users():
-    if not _SHOW_UNVERIFIED_DATA_USERS:
-        for document in _DB.show_unverified_data_users.find():
-            _SHOW_UNVERIFIED_DATA_USERS.add(document['_id'])
-    return _SHOW_UNVERIFIED_DATA_USERS
+_UNVERIFIED_DATA_ZONES = proto.MongoCachedIds('unverified_data_zones')
 
 
 def _is_in_unverified_data_zone(user_profile, user_projects):
     if _SHOW_UNVERIFIED_DATA_USER_REGEXP.search(user_profile.email):
         return False
-    if user_profile.email in _show_unverified_data_users():
+    if _SHOW_UNVERIFIED_DATA_USERS.contains(_DB, user_profile.email):
         return False
 
     has_valid_project_job = user_projects and user_projects[0].target_job.job_group.rome_id
@@ -378,8 +505,7 @@ def _is_in_unverified_data_zone(user_profile, user_projects):
 
     data_zone_key = '{}:{}'.format(city.postcodes, job.job_group.rome_id)
     hashed_data_zone_key = hashlib.md5(data_zone_key.encode('utf-8')).hexdigest()
-    return bool(_DB.unverified_data_zones.find(
-        {'_id': hashed_data_zone_key}, {'_id': 1}).limit(1).count())
+    return _UNVERIFIED_DATA_ZONES.contains(_DB, hashed_data_zone_key)
 
 
 def _copy_unmodifiable_fields(previous_user_data, user_data):
@@ -398,6 +524,13 @@ def _copy_unmodifiable_fields(previous_user_data, user_data):
             user_data.ClearField(field)
 
 
+def _copy_externally_updated_fields(previous_user_data, user_data):
+    """Copy the fields that are only updated outside of user saves."""
+    for field in _EXTERNALLY_UPDATED_FIELDS:
+        user_data.ClearField(field)
+        getattr(user_data, field).extend(getattr(previous_user_data, field))
+
+
 def _assert_no_credentials_change(previous, new):
     if previous.facebook_id != new.facebook_id:
         flask.abort(403, "Impossible de modifier l'identifiant Facebook.")
@@ -426,59 +559,44 @@ def _safe_object_id(_id):
             400, 'L\'identifiant "{}" n\'est pas un identifiant MongoDB valide.'.format(_id))
 
 
-# Mapping of old diploma estimates to new training estimates.
-TRAINING_ESTIMATION = {
-    project_pb2.FULFILLED: project_pb2.ENOUGH_DIPLOMAS,
-    project_pb2.NOT_FULFILLED: project_pb2.TRAINING_FULFILLMENT_NOT_SURE,
-    project_pb2.FULFILLMENT_NOT_SURE: project_pb2.TRAINING_FULFILLMENT_NOT_SURE,
-    project_pb2.NOTHING_REQUIRED: project_pb2.NO_TRAINING_REQUIRED,
-}
-
-
 def _get_user_data(user_id):
     """Load user data from DB."""
+    return _load_user_data(user_id)[0]
+
+
+def _load_user_data(user_id, save_migration=True):
+    """Load user data from DB, along with the document as it is stored.
+
+    Args:
+        user_id: the ID of the user to load.
+        save_migration: whether to save the user if it needs to be migrated.
+            Callers about to save the user anyway should skip it.
+    """
     user_dict = _DB.user.find_one({'_id': _safe_object_id(user_id)})
+    user_proto = _parse_stored_user(user_id, user_dict, save_migration=save_migration)
+    return user_proto, dict(user_dict)
+
+
+def _parse_stored_user(user_id, user_dict, save_migration=False):
     user_proto = user_pb2.User()
-    if not proto.parse_from_mongo(user_dict, user_proto):
+    if not proto.parse_from_mongo(dict(user_dict) if user_dict else None, user_proto):
         # Switch to raising an error if you move this function in a lib.
         flask.abort(404, 'Utilisateur "{}" inconnu.'.format(user_id))
 
-    _populate_feature_flags(user_proto)
+    if not migration.is_up_to_date(user_proto):
+        update = migration.upgrade_user(user_proto)
+        if save_migration:
+            # Save the migrated user so that it is only done once, unless it
+            # was saved concurrently: then it will be migrated on next read.
+            result = _DB.user.update_one(
+                {'_id': user_dict['_id'], 'revision': user_dict.get('revision')},
+                update)
+            if result.modified_count:
+                # Keep the ETag of the user in sync with the stored one.
+                user_dict[migration.EXTERNAL_REVISION_FIELD] = \
+                    user_dict.get(migration.EXTERNAL_REVISION_FIELD, 0) + 1
 
-    for project in user_proto.projects:
-        # TODO(pascal): Update existing users and get rid of diploma_fulfillment_estimate.
-        if not project.training_fulfillment_estimate and project.diploma_fulfillment_estimate:
-            project.training_fulfillment_estimate = TRAINING_ESTIMATION.get(
-                project.diploma_fulfillment_estimate, project_pb2.UNKNOWN_TRAINING_FULFILLMENT)
-        # TODO(pascal): Update existing users and get rid of FIND_JOB.
-        if project.kind == project_pb2.FIND_JOB:
-            if user_proto.profile.situation == user_pb2.LOST_QUIT:
-                project.kind = project_pb2.FIND_A_NEW_JOB
-            elif user_proto.profile.situation == user_pb2.FIRST_TIME:
-                project.kind = project_pb2.FIND_A_FIRST_JOB
-            else:
-                project.kind = project_pb2.FIND_ANOTHER_JOB
-
-        # TODO(pascal): Update existing users and get rid of job_search_length_months.
-        if not (project.job_search_started_at.seconds or project.job_search_has_not_started) \
-                and project.job_search_length_months:
-            if project.job_search_length_months < 0:
-                project.job_search_has_not_started = True
-            else:
-                job_search_length_days = 30.5 * project.job_search_length_months
-                job_search_length_duration = datetime.timedelta(days=job_search_length_days)
-                project.job_search_started_at.FromDatetime(
-                    project.created_at.ToDatetime() - job_search_length_duration)
-                project.job_search_started_at.nanos = 0
-
-        project.ClearField('diploma_fulfillment_estimate')
-        project.ClearField('actions_generated_at')
-
-    # TODO(pascal): Remove the fields completely after this has been live for a
-    # week.
-    user_proto.profile.ClearField('city')
-    user_proto.profile.ClearField('latest_job')
-    user_proto.profile.ClearField('situation')
+    _populate_feature_flags(user_proto)
 
     return user_proto
 
@@ -620,11 +738,17 @@ def advice_tips(user_id, project_id, advice_id):
     project = _get_project_data(user_proto, project_id)
     piece_of_advice = _get_advice_data(project, advice_id)
 
-    all_tips = advisor.list_all_tips(user_proto, project, piece_of_advice, _DB)
+    cache = {}
+    all_tips = advisor.list_all_tips(user_proto, project, piece_of_advice, _DB, cache=cache)
 
     response = action_pb2.AdviceTips()
+    # Reuse the scoring project of the tips' filters, so that all the tips
+    # share its data and template variables.
+    scoring_project = cache.get('scoring_project')
     for tip_template in all_tips:
-        action.instantiate(response.tips.add(), user_proto, project, tip_template, _DB)
+        action.instantiate(
+            response.tips.add(), user_proto, project, tip_template, _DB,
+            scoring_project=scoring_project)
     return response
 
 
@@ -656,8 +780,11 @@ def clear_cache():
     """
     _JOB_GROUPS_INFO.reset_cache()
     _CHANTIERS.reset_cache()
-    _SHOW_UNVERIFIED_DATA_USERS.clear()
+    _SHOW_UNVERIFIED_DATA_USERS.reset_cache()
+    _UNVERIFIED_DATA_ZONES.reset_cache()
+    _USAGE_STATS[0] = None
     advisor.clear_cache()
+    scoring.clear_cache()
     return 'Server cache cleared.'
 
 
@@ -761,7 +888,7 @@ def _give_feedback(feedback, extra_text=None):
 def _tell_slack(text):
     if not _SLACK_FEEDBACK_URL:
         return
-    requests.post(_SLACK_FEEDBACK_URL, json={'text': text})
+    http_client.post(_SLACK_FEEDBACK_URL, json={'text': text})
 
 
 @app.route('/', methods=['GET'])
@@ -816,9 +943,10 @@ def set_nps_survey_response(nps_survey_response):
     user_proto.net_promoter_score_survey_response.ClearField('email')
     _DB.user.update_one(
         {'_id': _safe_object_id(user_id)},
-        {'$set': {'netPromoterScoreSurveyResponse': json_format.MessageToDict(
-            user_proto.net_promoter_score_survey_response
-        )}},
+        migration.mark_external_update(
+            {'$set': {'netPromoterScoreSurveyResponse': json_format.MessageToDict(
+                user_proto.net_promoter_score_survey_response
+            )}}),
         upsert=False
     )
     return ''
@@ -844,8 +972,8 @@ def get_employment_status():
         json_format.ParseDict(flask.request.args, employment_status, ignore_unknown_fields=True)
         _DB.user.update_one(
             {'_id': _safe_object_id(user_id)},
-            {'$set': {
-                'employment_status.%s' % survey_id: json_format.MessageToDict(employment_status)}},
+            migration.mark_external_update({'$set': {
+                'employment_status.%s' % survey_id: json_format.MessageToDict(employment_status)}}),
             upsert=False)
     else:
         survey_id = len(user_proto.employment_status)
@@ -854,7 +982,8 @@ def get_employment_status():
         json_format.ParseDict(flask.request.args, employment_status, ignore_unknown_fields=True)
         _DB.user.update_one(
             {'_id': _safe_object_id(user_id)},
-            {'$push': {'employment_status': json_format.MessageToDict(employment_status)}},
+            migration.mark_external_update(
+                {'$push': {'employment_status': json_format.MessageToDict(employment_status)}}),
             upsert=False)
     if 'redirect' in flask.request.args:
         return flask.redirect('{}?{}'.format(
@@ -867,38 +996,78 @@ def get_employment_status():
     return ''
 
 
+# How long the usage stats are kept in memory.
+_USAGE_STATS_CACHE_DURATION = datetime.timedelta(minutes=1)
+# How often the usage stats stored in MongoDB are computed again.
+_USAGE_STATS_REFRESH_INTERVAL = datetime.timedelta(minutes=10)
+
+_CachedUsageStats = collections.namedtuple('CachedUsageStats', ['proto', 'valid_until'])
+# The usage stats kept in memory, in a list to replace them at once.
+_USAGE_STATS = [None]
+
+
 @app.route('/api/usage/stats', methods=['GET'])
 @proto.flask_api(out_type=stats_pb2.UsersCount)
 def get_usage_stats():
     """Get stats of the app usage."""
-    now_utc = now.get().astimezone(datetime.timezone.utc)
+    instant = now.get().astimezone(datetime.timezone.utc)
+    cached_stats = _USAGE_STATS[0]
+    if cached_stats and cached_stats.valid_until > instant:
+        return cached_stats.proto
+
+    # The stats are stored in MongoDB so that they are computed only once for
+    # all the servers.
+    stored_stats = _DB.usage_stats.find_one({'_id': 'latest'})
+    if not stored_stats:
+        usage_stats = _compute_usage_stats(instant)
+        _DB.usage_stats.replace_one(
+            {'_id': 'latest'},
+            {'computedAt': instant, 'stats': json_format.MessageToDict(usage_stats)},
+            upsert=True)
+    else:
+        usage_stats = stats_pb2.UsersCount()
+        proto.parse_from_mongo(stored_stats.get('stats'), usage_stats)
+        is_outdated = _get_utc_datetime(stored_stats.get('computedAt')) <= \
+            instant - _USAGE_STATS_REFRESH_INTERVAL
+        # Only the server that manages to mark the stored stats as computed now
+        # refreshes them: meanwhile the other ones keep using the stored stats.
+        if is_outdated and _DB.usage_stats.update_one(
+                {'_id': 'latest', 'computedAt': stored_stats.get('computedAt')},
+                {'$set': {'computedAt': instant}}).modified_count:
+            usage_stats = _compute_usage_stats(instant)
+            _DB.usage_stats.update_one(
+                {'_id': 'latest'}, {'$set': {'stats': json_format.MessageToDict(usage_stats)}})
+
+    _USAGE_STATS[0] = _CachedUsageStats(usage_stats, instant + _USAGE_STATS_CACHE_DURATION)
+    return usage_stats
+
+
+def _get_utc_datetime(instant):
+    if not instant:
+        return datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+    # MongoDB returns naive datetimes in UTC.
+    return instant.replace(tzinfo=datetime.timezone.utc) if not instant.tzinfo else instant
+
+
+def _compute_usage_stats(now_utc):
     start_of_second = now_utc.replace(microsecond=0, tzinfo=None)
     last_week = start_of_second - datetime.timedelta(days=7)
     yesterday = start_of_second - datetime.timedelta(days=1)
 
     # Compute daily scores count.
-    daily_scores_count = collections.defaultdict(int)
-    last_day_users = _DB.user.find(
-        {
+    daily_scores = _DB.user.aggregate([
+        {'$match': {
             'registeredAt': {
                 '$gt': _datetime_to_json_string(yesterday),
                 '$lte': _datetime_to_json_string(start_of_second),
             },
-        },
-        {
-            'profile.email': 1,
-            'projects': 1,
-            'registeredAt': 1,
-        },
-    )
-    for user_dict in last_day_users:
-        user_proto = user_pb2.User()
-        proto.parse_from_mongo(user_dict, user_proto)
-        if _is_test_user(user_proto):
-            continue
-        for project in user_proto.projects:
-            if project.feedback.score:
-                daily_scores_count[project.feedback.score] += 1
+            'profile.email': {'$not': _TEST_USER_REGEXP},
+            'projects.feedback.score': {'$gt': 0},
+        }},
+        {'$unwind': '$projects'},
+        {'$match': {'projects.feedback.score': {'$gt': 0}}},
+        {'$group': {'_id': '$projects.feedback.score', 'count': {'$sum': 1}}},
+    ])
 
     # Compute weekly user count.
     weekly_new_user_count = _DB.user.find({'registeredAt': {
@@ -909,7 +1078,7 @@ def get_usage_stats():
     return stats_pb2.UsersCount(
         total_user_count=_DB.user.count(),
         weekly_new_user_count=weekly_new_user_count,
-        daily_scores_count=daily_scores_count,
+        daily_scores_count={score['_id']: score['count'] for score in daily_scores},
     )
 
 
@@ -924,10 +1093,45 @@ def redirect_eterritoire(city_id):
 app.register_blueprint(evaluation.app, url_prefix='/api/eval')
 
 
+@app.route('/api/metrics', methods=['GET'])
+@auth.require_admin
+def get_metrics():
+    """Export the metrics of the server, aggregated across processes, for Prometheus."""
+    return flask.Response(metrics.render(), content_type='text/plain; version=0.0.4')
+
+
+def _collect_metrics():
+    for cache_name, (hits, misses) in scoring.get_cache_stats().items():
+        yield 'counter', 'bob_cache_hits_total', {'cache': cache_name}, hits
+        yield 'counter', 'bob_cache_misses_total', {'cache': cache_name}, misses
+    for host_name, stats in http_client.get_stats().items():
+        labels = {'host': host_name}
+        yield 'counter', 'bob_external_calls_total', labels, stats.get('calls', 0)
+        yield 'counter', 'bob_external_errors_total', labels, stats.get('errors', 0)
+        yield 'counter', 'bob_external_latency_seconds_total', labels, \
+            stats.get('latency_ms', 0) / 1000
+    for model_name, stats in advisor.get_model_stats().items():
+        labels = {'model': model_name}
+        yield 'counter', 'bob_scoring_model_calls_total', labels, stats['calls']
+        yield 'counter', 'bob_scoring_model_seconds_total', labels, stats['seconds']
+        yield 'counter', 'bob_scoring_model_db_calls_total', labels, stats['db_calls']
+        yield 'counter', 'bob_scoring_model_errors_total', labels, stats['errors']
+
+
+metrics.register_collector(_collect_metrics)
+
+
 @app.before_request
 def _before_request():
     flask.g.start = time.time()
     flask.g.ticks = []
+    metrics.add_to_gauge('bob_http_requests_in_flight', 1)
+
+
+@app.after_request
+def _after_request(response):
+    flask.g.status_code = response.status_code
+    return response
 
 
 def _tick(tick_name):
@@ -947,6 +1151,7 @@ def _is_test_user(user_proto):
 @app.teardown_request
 def _teardown_request(unused_exception=None):
     total_duration = time.time() - flask.g.start
+    _record_request_metrics(total_duration)
     if total_duration <= _LONG_REQUEST_DURATION_SECONDS:
         return
     logging.warning('Long request: %d seconds', total_duration)
@@ -956,6 +1161,33 @@ def _teardown_request(unused_exception=None):
             '%.4f: Tick %s (%.4f since last tick)',
             tick.time - flask.g.start, tick.name, tick.time - last_tick_time)
         last_tick_time = tick.time
+    scoring_models = flask.g.get('scoring_models', {})
+    for model_name, stats in sorted(
+            scoring_models.items(), key=lambda item: item[1]['seconds'], reverse=True)[:5]:
+        logging.warning(
+            'Scoring model %s: %.4f seconds in %d calls, %d DB calls',
+            model_name, stats['seconds'], stats['calls'], stats['db_calls'])
+
+
+def _record_request_metrics(total_duration):
+    rule = flask.request.url_rule
+    endpoint = rule.rule if rule else 'unknown'
+    metrics.add_to_gauge('bob_http_requests_in_flight', -1)
+    metrics.increment(
+        'bob_http_responses_total', endpoint=endpoint, method=flask.request.method,
+        # Requests that failed with an unhandled exception do not get to after_request.
+        status=flask.g.get('status_code', 500))
+    metrics.observe(
+        'bob_http_request_duration_seconds', total_duration,
+        endpoint=endpoint, method=flask.request.method)
+    # The time spent before each tick.
+    last_tick_time = flask.g.start
+    for tick in sorted(flask.g.ticks, key=lambda t: t.time):
+        metrics.observe(
+            'bob_http_request_segment_duration_seconds', tick.time - last_tick_time,
+            endpoint=endpoint, segment=tick.name)
+        last_tick_time = tick.time
+    metrics.flush()
 
 
 app.config['DATABASE'] = _DB
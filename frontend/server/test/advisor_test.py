@@ -1,7 +1,9 @@
 """Unit tests for the bob_emploi.frontend.advisor module."""
+import collections
 import datetime
 import unittest
 
+import flask
 import mock
 import mongomock
 
@@ -26,22 +28,23 @@ class _BaseTestCase(unittest.TestCase):
             features_enabled=user_pb2.Features(advisor=user_pb2.ACTIVE),
             profile=user_pb2.UserProfile(name='Margaux', gender=user_pb2.FEMININE))
         advisor.clear_cache()
+        advisor.scoring.clear_cache()
 
 
-@mock.patch(advisor.mail.__name__ + '.send_template')
+@mock.patch(advisor.outbox.__name__ + '.enqueue')
 class MaybeAdviseTestCase(_BaseTestCase):
     """Unit tests for the maybe_advise function."""
 
-    def test_no_advice_if_project_incomplete(self, mock_send_template):
+    def test_no_advice_if_project_incomplete(self, mock_enqueue):
         """Test that the advice do not get populated when the project is marked as incomplete."""
         project = project_pb2.Project(is_incomplete=True)
         advisor.maybe_advise(self.user, project, self.database)
 
         self.assertEqual(len(project.advices), 0)
 
-        mock_send_template.assert_not_called()
+        mock_enqueue.assert_not_called()
 
-    def test_missing_module(self, mock_send_template):
+    def test_missing_module(self, mock_enqueue):
         """Test that the advisor does not crash when a module is missing."""
         project = project_pb2.Project(advices=[project_pb2.Advice(
             advice_id='does-not-exist',
@@ -51,12 +54,10 @@ class MaybeAdviseTestCase(_BaseTestCase):
 
         self.assertEqual(project_before, str(project))
 
-        mock_send_template.assert_not_called()
+        mock_enqueue.assert_not_called()
 
-    def test_find_all_pieces_of_advice(self, mock_send_template):
+    def test_find_all_pieces_of_advice(self, mock_enqueue):
         """Test that the advisor scores all advice modules."""
-        mock_send_template().status_code = 200
-        mock_send_template.reset_mock()
         project = project_pb2.Project(
             project_id='1234',
             target_job=job_pb2.Job(
@@ -83,8 +84,8 @@ class MaybeAdviseTestCase(_BaseTestCase):
         self.assertEqual(['spontaneous-application'], [a.advice_id for a in project.advices])
         self.assertEqual(project_pb2.ADVICE_RECOMMENDED, project.advices[0].status)
 
-        mock_send_template.assert_called_once()
-        data = mock_send_template.call_args[0][2]
+        mock_enqueue.assert_called_once()
+        data = mock_enqueue.call_args[0][4]
         self.assertEqual(
             ['advices', 'baseUrl', 'firstName', 'ofProjectTitle', 'projectId'],
             sorted(data.keys()))
@@ -93,7 +94,7 @@ class MaybeAdviseTestCase(_BaseTestCase):
         self.assertEqual("d'hôtesse", data['ofProjectTitle'])
         self.assertEqual('1234', data['projectId'])
 
-    def test_recommend_advice_none(self, mock_send_template):
+    def test_recommend_advice_none(self, mock_enqueue):
         """Test that the advisor does not recommend anyting if all modules score 0."""
         project = project_pb2.Project()
         self.database.advice_modules.insert_many([
@@ -113,9 +114,9 @@ class MaybeAdviseTestCase(_BaseTestCase):
 
         self.assertFalse(project.advices)
 
-        mock_send_template.assert_not_called()
+        mock_enqueue.assert_not_called()
 
-    def test_recommend_all_modules(self, mock_send_template):
+    def test_recommend_all_modules(self, mock_enqueue):
         """Test that all advice are recommended when all_modules is true even if incompatible."""
         project = project_pb2.Project()
         self.database.advice_modules.insert_many([
@@ -147,12 +148,10 @@ class MaybeAdviseTestCase(_BaseTestCase):
             ['spontaneous-application', 'other-work-env', 'new-advice'],
             [a.advice_id for a in project.advices])
 
-        mock_send_template.assert_called_once()
+        mock_enqueue.assert_called_once()
 
-    def test_incompatible_advice_modules(self, mock_send_template):
+    def test_incompatible_advice_modules(self, mock_enqueue):
         """Test that the advisor discard incompatible advice modules."""
-        mock_send_template().status_code = 200
-        mock_send_template.reset_mock()
         project = project_pb2.Project()
         self.database.advice_modules.insert_many([
             {
@@ -182,14 +181,12 @@ class MaybeAdviseTestCase(_BaseTestCase):
         self.assertEqual(
             ['spontaneous-application', 'final-one'],
             [a.advice_id for a in project.advices])
-        mock_send_template.assert_called_once()
+        mock_enqueue.assert_called_once()
 
     @mock.patch(advisor.scoring.__name__ + '.SCORING_MODELS', new_callable=dict)
     @mock.patch(advisor.logging.__name__ + '.exception')
-    def test_module_crashes(self, mock_logger, mock_scoring_models, mock_send_template):
+    def test_module_crashes(self, mock_logger, mock_scoring_models, mock_enqueue):
         """Test that the advisor does not crash if one module does."""
-        mock_send_template().status_code = 200
-        mock_send_template.reset_mock()
 
         mock_scoring_models['constant(1)'] = mock.MagicMock(spec=['score'])
         mock_scoring_models['constant(1)'].score.return_value = 1
@@ -213,7 +210,7 @@ class MaybeAdviseTestCase(_BaseTestCase):
         advisor.maybe_advise(self.user, project, self.database)
 
         self.assertEqual(['network'], [a.advice_id for a in project.advices])
-        mock_send_template.assert_called_once()
+        mock_enqueue.assert_called_once()
         mock_logger.assert_called_once()
 
 
@@ -222,9 +219,8 @@ class ExtraDataTestCase(_BaseTestCase):
 
     def setUp(self):
         super(ExtraDataTestCase, self).setUp()
-        self.mail_patcher = mock.patch(advisor.mail.__name__ + '.send_template')
-        mock_send_template = self.mail_patcher.start()
-        mock_send_template().status_code = 200
+        self.mail_patcher = mock.patch(advisor.outbox.__name__ + '.enqueue')
+        self.mail_patcher.start()
 
     def tearDown(self):
         self.mail_patcher.stop()
@@ -290,6 +286,7 @@ class ExtraDataTestCase(_BaseTestCase):
             'isReadyForProd': True,
         })
         advisor.clear_cache()
+        advisor.scoring.clear_cache()
 
         advisor.maybe_advise(self.user, project, self.database)
 
@@ -318,6 +315,7 @@ class ExtraDataTestCase(_BaseTestCase):
             'isReadyForProd': True,
         })
         advisor.clear_cache()
+        advisor.scoring.clear_cache()
 
         advisor.maybe_advise(self.user, project, self.database)
 
@@ -373,6 +371,7 @@ class ExtraDataTestCase(_BaseTestCase):
             {'name': 'M.F.P MULTIMEDIA FRANCE PRODUCTIONS'},
         ])
         advisor.clear_cache()
+        advisor.scoring.clear_cache()
 
         advisor.maybe_advise(self.user, project, self.database)
 
@@ -418,6 +417,7 @@ class ExtraDataTestCase(_BaseTestCase):
             'isReadyForProd': True,
         })
         advisor.clear_cache()
+        advisor.scoring.clear_cache()
 
         advisor.maybe_advise(self.user, project, self.database)
 
@@ -447,6 +447,7 @@ class ExtraDataTestCase(_BaseTestCase):
             'isReadyForProd': True,
         })
         advisor.clear_cache()
+        advisor.scoring.clear_cache()
 
         advisor.maybe_advise(self.user, project, self.database)
 
@@ -477,6 +478,7 @@ class ExtraDataTestCase(_BaseTestCase):
             'isReadyForProd': True,
         })
         advisor.clear_cache()
+        advisor.scoring.clear_cache()
 
         advisor.maybe_advise(self.user, project, self.database)
 
@@ -519,6 +521,7 @@ class ExtraDataTestCase(_BaseTestCase):
             },
         ])
         advisor.clear_cache()
+        advisor.scoring.clear_cache()
 
         advisor.maybe_advise(self.user, project, self.database)
 
@@ -594,14 +597,155 @@ class ExtraDataTestCase(_BaseTestCase):
         self.assertEqual(123, first_dep.job_groups[0].offers)
 
 
+class ComputeAdvicesForUsersTestCase(_BaseTestCase):
+    """Unit tests for the compute_advices_for_users function."""
+
+    def _make_user(self, rome_id, departement_id):
+        user = user_pb2.User()
+        user.CopyFrom(self.user)
+        project = user.projects.add()
+        project.target_job.job_group.rome_id = rome_id
+        project.mobility.city.departement_id = departement_id
+        return user
+
+    def test_compute_advices_for_users(self):
+        """Advise on many users, fetching market data once per job group and département."""
+        self.database.advice_modules.insert_one({
+            'adviceId': 'one-ring',
+            'isReadyForProd': True,
+            'triggerScoringModel': 'constant(2)',
+        })
+        users = [
+            self._make_user('A1234', '75'),
+            self._make_user('B5678', '75'),
+            self._make_user('A1234', '75'),
+        ]
+
+        with mock.patch(advisor.scoring.__name__ + '.prefetch') as mock_prefetch:
+            results = dict(advisor.compute_advices_for_users(users, self.database))
+
+        self.assertEqual({0, 1, 2}, set(results))
+        for advices in results.values():
+            self.assertEqual(['one-ring'], [a.advice_id for a in advices.advices])
+        self.assertEqual(
+            [1, 2], sorted(len(call[0][0]) for call in mock_prefetch.call_args_list))
+
+
+@mock.patch(advisor.scoring.__name__ + '.SCORING_MODELS', new_callable=dict)
+class ModelStatsTestCase(_BaseTestCase):
+    """Unit tests for the instrumentation of the scoring models."""
+
+    def setUp(self):
+        super(ModelStatsTestCase, self).setUp()
+        stats_patcher = mock.patch(
+            advisor.__name__ + '._MODEL_STATS', collections.defaultdict(collections.Counter))
+        stats_patcher.start()
+        self.addCleanup(stats_patcher.stop)
+        self.database.advice_modules.insert_many([
+            {
+                'adviceId': 'chatty',
+                'triggerScoringModel': 'chatty',
+                'isReadyForProd': True,
+            },
+            {
+                'adviceId': 'crash',
+                'triggerScoringModel': 'crash-me',
+                'isReadyForProd': True,
+            },
+        ])
+        self.project = self.user.projects.add()
+
+    def _add_models(self, scoring_models):
+        def _score_with_db_calls(unused_project):
+            listener = advisor.ModelCommandListener()
+            listener.started(None)
+            listener.started(None)
+            return 2
+
+        scoring_models['chatty'] = mock.MagicMock(spec=['score'])
+        scoring_models['chatty'].score.side_effect = _score_with_db_calls
+        scoring_models['crash-me'] = mock.MagicMock(spec=['score'])
+        scoring_models['crash-me'].score.side_effect = ValueError('ouch')
+
+    @mock.patch(advisor.logging.__name__ + '.exception', mock.MagicMock())
+    def test_model_stats(self, mock_scoring_models):
+        """Count calls, DB calls and errors of each scoring model."""
+        self._add_models(mock_scoring_models)
+
+        advisor.compute_advices_for_project(self.user, self.project, self.database)
+        # DB calls out of the scoring models are not counted.
+        advisor.ModelCommandListener().started(None)
+
+        stats = advisor.get_model_stats()
+        self.assertEqual({'chatty', 'crash-me'}, set(stats))
+        # Scoring, then computing extra data.
+        self.assertEqual(2, stats['chatty']['calls'])
+        self.assertEqual(2, stats['chatty']['db_calls'])
+        self.assertEqual(0, stats['chatty']['errors'])
+        self.assertGreaterEqual(stats['chatty']['seconds'], 0)
+        self.assertEqual(1, stats['crash-me']['calls'])
+        self.assertEqual(1, stats['crash-me']['errors'])
+
+    @mock.patch(advisor.logging.__name__ + '.exception', mock.MagicMock())
+    def test_request_ticks(self, mock_scoring_models):
+        """Time the scoring models in the ticks of the current request."""
+        self._add_models(mock_scoring_models)
+
+        with flask.Flask(__name__).test_request_context():
+            flask.g.ticks = []
+            advisor.compute_advices_for_project(self.user, self.project, self.database)
+
+            self.assertEqual(
+                ['Model chatty', 'Model crash-me', 'Model chatty'],
+                [tick.name for tick in flask.g.ticks])
+            self.assertEqual(2, flask.g.scoring_models['chatty']['db_calls'])
+
+    @mock.patch(advisor.__name__ + '._SLOW_MODEL_SECONDS', -1)
+    @mock.patch(advisor.random.__name__ + '.random', mock.MagicMock(return_value=0))
+    @mock.patch(advisor.logging.__name__ + '.warning')
+    def test_log_slow_model(self, mock_warning, mock_scoring_models):
+        """Log the inputs of slow scoring models."""
+        mock_scoring_models['chatty'] = mock.MagicMock(spec=['score'])
+        mock_scoring_models['chatty'].score.return_value = 0
+        self.project.target_job.job_group.rome_id = 'A1234'
+
+        advisor.compute_advices_for_project(self.user, self.project, self.database)
+
+        slow_logs = [
+            call[0] for call in mock_warning.call_args_list
+            if call[0][0].startswith('Slow scoring model')]
+        self.assertEqual(1, len(slow_logs))
+        self.assertEqual('chatty', slow_logs[0][1])
+        self.assertIn('A1234', slow_logs[0][-1])
+
+
+class ListAllTipsTestCase(_BaseTestCase):
+    """Unit tests for the list_all_tips function."""
+
+    def test_fill_cache(self):
+        """Give back the scoring project through the cache of the caller."""
+        self.database.advice_modules.insert_one({
+            'adviceId': 'one-ring',
+            'isReadyForProd': True,
+            'triggerScoringModel': 'constant(1)',
+        })
+        project = self.user.projects.add()
+        cache = {}
+
+        advisor.list_all_tips(
+            self.user, project, project_pb2.Advice(advice_id='one-ring'), self.database,
+            cache=cache)
+
+        self.assertEqual(project, cache['scoring_project'].details)
+
+
 class OverrideAdviceTestCase(_BaseTestCase):
     """Unit tests for maybe_advise to have overriden values from modules."""
 
     def setUp(self):
         super(OverrideAdviceTestCase, self).setUp()
-        self.mail_patcher = mock.patch(advisor.mail.__name__ + '.send_template')
-        mock_send_template = self.mail_patcher.start()
-        mock_send_template().status_code = 200
+        self.mail_patcher = mock.patch(advisor.outbox.__name__ + '.enqueue')
+        self.mail_patcher.start()
 
     def tearDown(self):
         self.mail_patcher.stop()
@@ -12,6 +12,7 @@ import mock
 from oauth2client import crypt
 
 from bob_emploi.frontend import auth
+from bob_emploi.frontend import outbox
 from bob_emploi.frontend import server
 from bob_emploi.frontend.test import base_test
 
@@ -198,6 +199,9 @@ class AuthenticateEndpointTestCase(base_test.ServerTestCase):
             '/api/user/reset-password', data='{{"email":"{}"}}'.format(email),
             content_type='application/json')
         self.assertEqual(200, response.status_code, msg=response.get_data(as_text=True))
+        # The email is only sent by the outbox dispatcher.
+        self.assertTrue(self._db.email_outbox.find_one({'status': 'pending'}))
+        outbox.dispatch(self._db)
         self.assertTrue(mock_mailjet_client().send.create.called)
 
         # Extract link from email.
@@ -33,6 +33,11 @@ class ServerTestCase(unittest.TestCase):
         server._DB = self._db  # pylint: disable=protected-access
         server._JOB_GROUPS_INFO.reset_cache()  # pylint: disable=protected-access
         server._CHANTIERS.reset_cache()  # pylint: disable=protected-access
+        server._SHOW_UNVERIFIED_DATA_USERS.reset_cache()  # pylint: disable=protected-access
+        server._UNVERIFIED_DATA_ZONES.reset_cache()  # pylint: disable=protected-access
+        server._USAGE_STATS[0] = None  # pylint: disable=protected-access
+        server.advisor.clear_cache()
+        server.scoring.clear_cache()
         server.advisor._EMAIL_ACTIVATION_ENABLED = False  # pylint: disable=protected-access
         self._db.chantiers.insert_many([
             {'_id': 'c1', 'chantierId': 'c1'},
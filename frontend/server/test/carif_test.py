@@ -3,6 +3,7 @@ from os import path
 import unittest
 
 import mock
+import requests
 
 from bob_emploi.frontend import carif
 
@@ -15,20 +16,20 @@ class CarifTestCase(unittest.TestCase):
         with open(path.join(path.dirname(__file__), 'testdata/carif.xml')) as carif_file:
             cls._carif_xml_response = carif_file.read()
 
-    @mock.patch('requests.get')
-    def test_get_trainings(self, mock_get):
-        """Basic usage of get_trainings."""
+    @mock.patch(carif.http_client.__name__ + '.get')
+    def test_fetch_trainings(self, mock_get):
+        """Basic usage of fetch_trainings."""
         mock_get().text = self._carif_xml_response
         mock_get().status_code = 200
         mock_get.reset_mock()
 
-        trainings = carif.get_trainings('G1201', '75')
+        trainings = carif.fetch_trainings('G1201', '75')
 
         mock_get.assert_called_once()
         args, kwargs = mock_get.call_args
         self.assertEqual(1, len(args))
         self.assertRegex(args[0], r'^http://www.intercariforef.org/')
-        self.assertEqual({'params'}, set(kwargs))
+        self.assertEqual({'params', 'timeout'}, set(kwargs))
         self.assertEqual(
             {'idsMetiers': 'G1201', 'code-departement': '75'},
             kwargs['params'])
@@ -57,27 +58,33 @@ class CarifTestCase(unittest.TestCase):
         self.assertEqual('http://www.intercariforef.org/', trainings[7].url)
         self.assertEqual(['14201', '14270', '15254'], trainings[7].formacodes)
 
-    @mock.patch('requests.get')
+    @mock.patch(carif.http_client.__name__ + '.get')
     def test_error_code(self, mock_get):
-        """Error 500 on InterCarif."""
+        """Error 500 on InterCarif: raise, so that the error is not cached."""
         mock_get().text = self._carif_xml_response
         mock_get().status_code = 500
         mock_get.reset_mock()
 
-        trainings = carif.get_trainings('G1201', '75')
+        with self.assertRaises(IOError):
+            carif.fetch_trainings('G1201', '75')
 
-        self.assertEqual([], trainings)
-
-    @mock.patch('requests.get')
+    @mock.patch(carif.http_client.__name__ + '.get')
     def test_empty_response(self, mock_get):
         """Missing text when calling InterCarif."""
         mock_get().text = ''
         mock_get().status_code = 200
         mock_get.reset_mock()
 
-        trainings = carif.get_trainings('G1201', '75')
+        with self.assertRaises(IOError):
+            carif.fetch_trainings('G1201', '75')
+
+    @mock.patch(carif.http_client.__name__ + '.get')
+    def test_timeout(self, mock_get):
+        """InterCarif is too slow to answer."""
+        mock_get.side_effect = requests.exceptions.ReadTimeout('Too slow')
 
-        self.assertEqual([], trainings)
+        with self.assertRaises(IOError):
+            carif.fetch_trainings('G1201', '75')
 
 
 if __name__ == '__main__':
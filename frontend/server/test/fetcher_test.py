@@ -0,0 +1,141 @@
+"""Tests for the bob_emploi.frontend.fetcher module."""
+import datetime
+import threading
+import unittest
+
+import mock
+
+from bob_emploi.frontend import fetcher
+
+
+class CachedFetcherTestCase(unittest.TestCase):
+    """Unit tests for the CachedFetcher class."""
+
+    def setUp(self):
+        super(CachedFetcherTestCase, self).setUp()
+        self.fetch = mock.MagicMock(__name__='fetch')
+        self.fetcher = fetcher.CachedFetcher(self.fetch, timeout=1)
+
+    def test_get(self):
+        """Fetch a value only once."""
+        self.fetch.return_value = ['a', 'b']
+
+        self.assertEqual(['a', 'b'], self.fetcher.get_value('A1234', '75'))
+        self.assertEqual(['a', 'b'], self.fetcher.get_value('A1234', '75'))
+
+        self.fetch.assert_called_once_with('A1234', '75')
+        self.assertEqual((1, 1), (self.fetcher.hits, self.fetcher.misses))
+
+    def test_different_keys(self):
+        """Fetch a value per key."""
+        self.fetch.side_effect = lambda rome_id, departement_id: rome_id + departement_id
+
+        self.assertEqual('A123475', self.fetcher.get_value('A1234', '75'))
+        self.assertEqual('A123469', self.fetcher.get_value('A1234', '69'))
+
+        self.assertEqual(2, self.fetch.call_count)
+
+    def test_prefetch(self):
+        """Get a value that was fetched in advance."""
+        self.fetch.return_value = ['a', 'b']
+
+        self.fetcher.prefetch('A1234', '75')
+        self.assertEqual(['a', 'b'], self.fetcher.get_value('A1234', '75'))
+
+        self.fetch.assert_called_once_with('A1234', '75')
+
+    @mock.patch(fetcher.__name__ + '.datetime')
+    def test_cache_duration(self, mock_datetime):
+        """Fetch the value again once it is outdated."""
+        mock_datetime.datetime.now.return_value = datetime.datetime(2017, 10, 1)
+        self.fetch.side_effect = [['a'], ['b']]
+
+        self.assertEqual(['a'], self.fetcher.get_value('A1234', '75'))
+
+        mock_datetime.datetime.now.return_value = datetime.datetime(2017, 10, 2)
+        self.assertEqual(['b'], self.fetcher.get_value('A1234', '75'))
+
+    def test_error(self):
+        """Fetch the value again after an error."""
+        self.fetch.side_effect = [ValueError('Oops'), ['a']]
+
+        with self.assertRaises(ValueError):
+            self.fetcher.get_value('A1234', '75')
+
+        self.assertEqual(['a'], self.fetcher.get_value('A1234', '75'))
+
+    def test_max_size(self):
+        """Forget the least recently used values."""
+        self.fetcher = fetcher.CachedFetcher(self.fetch, max_size=2)
+        self.fetch.side_effect = lambda rome_id: rome_id
+
+        self.fetcher.get_value('A1234')
+        self.fetcher.get_value('B1234')
+        self.fetcher.get_value('A1234')
+        self.fetcher.get_value('C1234')
+        self.assertEqual(3, self.fetch.call_count)
+
+        self.fetcher.get_value('A1234')
+        self.assertEqual(3, self.fetch.call_count)
+
+        self.fetcher.get_value('B1234')
+        self.assertEqual(4, self.fetch.call_count)
+
+    def test_timeout(self):
+        """Wait at most once per key for a slow API."""
+        is_released = threading.Event()
+        self.addCleanup(is_released.set)
+        self.fetcher = fetcher.CachedFetcher(self.fetch, timeout=.05)
+
+        def _slow_fetch(unused_rome_id):
+            is_released.wait()
+            return ['a']
+        self.fetch.side_effect = _slow_fetch
+
+        with mock.patch(fetcher.logging.__name__ + '.warning') as mock_warning:
+            self.assertIsNone(self.fetcher.get_value('A1234'))
+            self.assertIsNone(self.fetcher.get_value('A1234'))
+        mock_warning.assert_called_once()
+
+        is_released.set()
+        # Wait for the slow fetch to finish.
+        self.fetcher._fetches[('A1234',)].future.result()  # pylint: disable=protected-access
+        self.assertEqual(['a'], self.fetcher.get_value('A1234'))
+        self.fetch.assert_called_once_with('A1234')
+
+    def test_concurrent_gets(self):
+        """Fetch only once for concurrent calls."""
+        is_released = threading.Event()
+        self.addCleanup(is_released.set)
+
+        def _slow_fetch(unused_rome_id):
+            is_released.wait()
+            return ['a']
+        self.fetch.side_effect = _slow_fetch
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.fetcher.get_value('A1234')))
+            for unused_index in range(3)]
+        for thread in threads:
+            thread.start()
+        is_released.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([['a'], ['a'], ['a']], results)
+        self.fetch.assert_called_once_with('A1234')
+
+    def test_reset_cache(self):
+        """Fetch the value again after resetting the cache."""
+        self.fetch.return_value = ['a']
+
+        self.fetcher.get_value('A1234')
+        self.fetcher.reset_cache()
+        self.fetcher.get_value('A1234')
+
+        self.assertEqual(2, self.fetch.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -1,4 +1,5 @@
 """Tests for filters in the bob_emploi.frontend.scoring module."""
+import collections
 import datetime
 import unittest
 
@@ -6,6 +7,7 @@ import mock
 
 from bob_emploi.frontend import scoring
 from bob_emploi.frontend.api import job_pb2
+from bob_emploi.frontend.api import jobboard_pb2
 from bob_emploi.frontend.api import user_pb2
 from bob_emploi.frontend.test import scoring_test
 
@@ -384,5 +386,70 @@ class FilterUsingScoreTestCase(unittest.TestCase):
         self.assertEqual([], list(filtered))
 
 
+class FilterIndexTestCase(unittest.TestCase):
+    """Unit tests for the FilterIndex class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Test setup."""
+        super(FilterIndexTestCase, cls).setUpClass()
+        scoring.SCORING_MODELS['test-zero'] = scoring.ConstantScoreModel(0)
+        scoring.SCORING_MODELS['test-two'] = scoring.ConstantScoreModel(2)
+
+    def setUp(self):
+        super(FilterIndexTestCase, self).setUp()
+        self.items = collections.OrderedDict([
+            ('a', jobboard_pb2.JobBoard(title='A')),
+            ('b', jobboard_pb2.JobBoard(title='B')),
+            ('c', jobboard_pb2.JobBoard(title='C')),
+            ('d', jobboard_pb2.JobBoard(title='D')),
+        ])
+
+    def _set_filters(self, **filters):
+        for key, item_filters in filters.items():
+            self.items[key].filters.extend(item_filters)
+
+    def test_no_filters(self):
+        """Keep all items in their original order when there are no filters."""
+        index = scoring.FilterIndex(self.items)
+        self.assertEqual(['A', 'B', 'C', 'D'], [i.title for i in index.filter(None)])
+
+    def test_constant_filters(self):
+        """Drop items with at least one failing filter."""
+        self._set_filters(a=['test-zero'], b=['test-two'], c=['test-two', 'test-zero'])
+        index = scoring.FilterIndex(self.items)
+        self.assertEqual(['B', 'D'], [i.title for i in index.filter(None)])
+
+    def test_keys(self):
+        """Restrict and order the items with a list of keys."""
+        self._set_filters(b=['test-zero'])
+        index = scoring.FilterIndex(self.items)
+        self.assertEqual(
+            ['D', 'A'], [i.title for i in index.filter(None, ['d', 'b', 'unknown', 'a'])])
+
+    def test_score_each_filter_once(self):
+        """Compute each distinct filter only once."""
+        model = mock.MagicMock(spec=scoring.ModelBase)
+        model.score.return_value = 3
+        scoring.SCORING_MODELS['test-mock'] = model
+        self.addCleanup(scoring.SCORING_MODELS.pop, 'test-mock')
+        self._set_filters(a=['test-mock'], b=['test-mock', 'test-zero'], c=['test-mock'])
+        index = scoring.FilterIndex(self.items)
+
+        self.assertEqual(['A', 'C', 'D'], [i.title for i in index.filter(None)])
+        self.assertEqual(1, model.score.call_count)
+
+    def test_skip_filters_of_dropped_items(self):
+        """Do not compute filters that only concern items already dropped."""
+        model = mock.MagicMock(spec=scoring.ModelBase)
+        scoring.SCORING_MODELS['test-mock'] = model
+        self.addCleanup(scoring.SCORING_MODELS.pop, 'test-mock')
+        self._set_filters(a=['test-zero'], b=['test-zero', 'test-mock'], c=['test-zero'])
+        index = scoring.FilterIndex(self.items)
+
+        self.assertEqual(['D'], [i.title for i in index.filter(None)])
+        self.assertFalse(model.score.called)
+
+
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
@@ -0,0 +1,130 @@
+"""Tests for the bob_emploi.frontend.http_client module."""
+import unittest
+
+import mock
+import requests
+import requests_mock
+
+from bob_emploi.frontend import http_client
+
+
+@requests_mock.mock()
+class HttpClientTestCase(unittest.TestCase):
+    """Unit tests for the http_client module."""
+
+    def setUp(self):
+        super(HttpClientTestCase, self).setUp()
+        hosts_patcher = mock.patch(http_client.__name__ + '._HOSTS', {})
+        hosts_patcher.start()
+        self.addCleanup(hosts_patcher.stop)
+        # Only patch the module used by http_client, not the global time
+        # module used by other threads.
+        time_patcher = mock.patch(http_client.__name__ + '.time')
+        self.mock_time = time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        self.mock_time.time.return_value = 1000
+        self.mock_sleep = self.mock_time.sleep
+
+    def test_get(self, mock_requests):
+        """Basic usage of get."""
+        mock_requests.get('https://example.com/api?a=b', text='Hello')
+
+        response = http_client.get('https://example.com/api', params={'a': 'b'})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('Hello', response.text)
+        self.assertEqual(
+            {'example.com': {'calls': 1, 'latency_ms': mock.ANY}}, http_client.get_stats())
+
+    def test_post(self, mock_requests):
+        """Basic usage of post."""
+        mock_requests.post('https://example.com/api', text='OK')
+
+        response = http_client.post('https://example.com/api', json={'text': 'Hello'})
+
+        self.assertEqual('OK', response.text)
+        self.assertEqual({'text': 'Hello'}, mock_requests.request_history[0].json())
+
+    def test_default_timeout(self, mock_requests):
+        """Set a default timeout."""
+        mock_requests.get('https://example.com/api', text='Hello')
+
+        http_client.get('https://example.com/api')
+        http_client.get('https://example.com/api', timeout=42)
+
+        self.assertEqual(
+            [http_client._DEFAULT_TIMEOUT, 42],  # pylint: disable=protected-access
+            [r.timeout for r in mock_requests.request_history])
+
+    def test_retry_get(self, mock_requests):
+        """Retry a GET request on a server error."""
+        mock_requests.get('https://example.com/api', [
+            {'status_code': 503},
+            {'exc': requests.exceptions.ReadTimeout},
+            {'text': 'Hello'},
+        ])
+
+        response = http_client.get('https://example.com/api')
+
+        self.assertEqual('Hello', response.text)
+        self.assertEqual(3, mock_requests.call_count)
+        self.assertEqual(2, self.mock_sleep.call_count)
+        self.assertEqual(
+            {'example.com': {'calls': 3, 'errors': 2, 'latency_ms': mock.ANY}},
+            http_client.get_stats())
+
+    def test_retry_budget(self, mock_requests):
+        """Stop retrying after a few errors."""
+        mock_requests.get('https://example.com/api', status_code=503)
+
+        response = http_client.get('https://example.com/api')
+
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(3, mock_requests.call_count)
+        self.assertEqual(2, self.mock_sleep.call_count)
+
+    def test_no_retry_post(self, mock_requests):
+        """Do not retry a POST request that the server might have received."""
+        mock_requests.post('https://example.com/api', exc=requests.exceptions.ReadTimeout)
+
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            http_client.post('https://example.com/api', json={'text': 'Hello'})
+
+        self.assertEqual(1, mock_requests.call_count)
+
+    def test_retry_post_on_connect_timeout(self, mock_requests):
+        """Retry a POST request that never reached the server."""
+        mock_requests.post('https://example.com/api', [
+            {'exc': requests.exceptions.ConnectTimeout},
+            {'text': 'OK'},
+        ])
+
+        response = http_client.post('https://example.com/api', json={'text': 'Hello'})
+
+        self.assertEqual('OK', response.text)
+
+    def test_circuit_breaker(self, mock_requests):
+        """Stop calling a host that keeps failing."""
+        mock_requests.get('https://example.com/api', status_code=500)
+        mock_requests.get('https://other.example.com/api', text='Hello')
+
+        self.assertEqual(500, http_client.get('https://example.com/api').status_code)
+        with self.assertRaises(http_client.CircuitOpenError):
+            http_client.get('https://example.com/api')
+        self.assertEqual(5, mock_requests.call_count)
+
+        with self.assertRaises(http_client.CircuitOpenError):
+            http_client.get('https://example.com/api')
+        self.assertEqual(5, mock_requests.call_count)
+
+        # Other hosts are still available.
+        self.assertEqual('Hello', http_client.get('https://other.example.com/api').text)
+
+        # Try again later.
+        self.mock_time.time.return_value = 1100
+        mock_requests.get('https://example.com/api', text='Back')
+        self.assertEqual('Back', http_client.get('https://example.com/api').text)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
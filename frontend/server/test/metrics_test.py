@@ -0,0 +1,118 @@
+"""Unit tests for the bob_emploi.frontend.metrics module."""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from bob_emploi.frontend import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Unit tests for the metrics functions."""
+
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        registry = metrics._Registry()  # pylint: disable=protected-access
+        registry_patcher = mock.patch(metrics.__name__ + '._REGISTRY', registry)
+        registry_patcher.start()
+        self.addCleanup(registry_patcher.stop)
+
+    def test_counter_and_gauge(self):
+        """Export counters and gauges."""
+        metrics.increment('bob_responses_total', endpoint='/api/user', status=200)
+        metrics.increment('bob_responses_total', endpoint='/api/user', status=200)
+        metrics.increment('bob_responses_total', value=3, endpoint='/api/user', status=404)
+        metrics.add_to_gauge('bob_in_flight', 1)
+
+        self.assertEqual(
+            '# TYPE bob_in_flight gauge\n'
+            'bob_in_flight 1\n'
+            '# TYPE bob_responses_total counter\n'
+            'bob_responses_total{endpoint="/api/user",status="200"} 2\n'
+            'bob_responses_total{endpoint="/api/user",status="404"} 3\n',
+            metrics.render())
+
+    def test_histogram(self):
+        """Export histograms with cumulated buckets."""
+        metrics.observe('bob_duration_seconds', .003, endpoint='/')
+        metrics.observe('bob_duration_seconds', .2, endpoint='/')
+        metrics.observe('bob_duration_seconds', 20, endpoint='/')
+
+        lines = metrics.render().split('\n')
+
+        self.assertEqual('# TYPE bob_duration_seconds histogram', lines[0])
+        self.assertIn('bob_duration_seconds_bucket{endpoint="/",le="0.005"} 1', lines)
+        self.assertIn('bob_duration_seconds_bucket{endpoint="/",le="0.1"} 1', lines)
+        self.assertIn('bob_duration_seconds_bucket{endpoint="/",le="0.25"} 2', lines)
+        self.assertIn('bob_duration_seconds_bucket{endpoint="/",le="10"} 2', lines)
+        self.assertIn('bob_duration_seconds_bucket{endpoint="/",le="+Inf"} 3', lines)
+        self.assertIn('bob_duration_seconds_sum{endpoint="/"} 20.203', lines)
+        self.assertIn('bob_duration_seconds_count{endpoint="/"} 3', lines)
+
+    def test_escape_labels(self):
+        """Escape the values of labels."""
+        metrics.increment('bob_ticks_total', segment='Say "Hello"')
+
+        self.assertIn('bob_ticks_total{segment="Say \\"Hello\\""} 1', metrics.render())
+
+    def test_collector(self):
+        """Export metrics computed elsewhere."""
+        metrics.register_collector(lambda: [
+            ('counter', 'bob_cache_hits_total', {'cache': 'jobs'}, 12),
+        ])
+
+        self.assertEqual(
+            '# TYPE bob_cache_hits_total counter\n'
+            'bob_cache_hits_total{cache="jobs"} 12\n',
+            metrics.render())
+
+    def test_aggregate_processes(self):
+        """Aggregate the metrics dumped by several processes."""
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        dir_patcher = mock.patch(metrics.__name__ + '._METRICS_DIR', metrics_dir)
+        dir_patcher.start()
+        self.addCleanup(dir_patcher.stop)
+
+        # Metrics of another process.
+        metrics.increment('bob_responses_total', status=200)
+        metrics.add_to_gauge('bob_in_flight', 2)
+        metrics.observe('bob_duration_seconds', .2)
+        metrics.flush()
+        os.rename(
+            os.path.join(metrics_dir, '{:d}.json'.format(os.getpid())),
+            os.path.join(metrics_dir, '1.json'))
+        # Metrics of a process that has been gone for a while.
+        metrics.flush(force=True)
+        stale_file = os.path.join(metrics_dir, '2.json')
+        os.rename(os.path.join(metrics_dir, '{:d}.json'.format(os.getpid())), stale_file)
+        os.utime(stale_file, (time.time() - 3600, time.time() - 3600))
+
+        metrics.increment('bob_responses_total', status=200)
+        metrics.add_to_gauge('bob_in_flight', -1)
+        rendered = metrics.render().split('\n')
+
+        self.assertIn('bob_responses_total{status="200"} 4', rendered)
+        # Gauges of processes that are gone are ignored.
+        self.assertIn('bob_in_flight 3', rendered)
+        self.assertIn('bob_duration_seconds_count 3', rendered)
+
+    def test_flush_interval(self):
+        """Do not dump the metrics too often."""
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        with mock.patch(metrics.__name__ + '._METRICS_DIR', metrics_dir):
+            metrics.increment('bob_responses_total')
+            metrics.flush()
+            metrics.increment('bob_responses_total')
+            metrics.flush()
+
+            with open(os.path.join(metrics_dir, '{:d}.json'.format(os.getpid()))) as dump:
+                self.assertIn('"bob_responses_total", [], 1.0', dump.read())
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,81 @@
+"""Unit tests for the bob_emploi.frontend.migration module."""
+import unittest
+
+from bob_emploi.frontend import migration
+from bob_emploi.frontend.api import project_pb2
+from bob_emploi.frontend.api import user_pb2
+
+
+class MigrationTestCase(unittest.TestCase):
+    """Unit tests for the migration functions."""
+
+    def test_upgrade_user(self):
+        """Migrate an old user."""
+        user = user_pb2.User()
+        user.profile.name = 'Pascal'
+        user.profile.situation = user_pb2.FIRST_TIME
+        project = user.projects.add(project_id='0', kind=project_pb2.FIND_JOB)
+        project.diploma_fulfillment_estimate = project_pb2.NOTHING_REQUIRED
+
+        update = migration.upgrade_user(user)
+
+        self.assertEqual(project_pb2.FIND_A_FIRST_JOB, user.projects[0].kind)
+        self.assertEqual(
+            project_pb2.NO_TRAINING_REQUIRED, user.projects[0].training_fulfillment_estimate)
+        self.assertFalse(user.projects[0].diploma_fulfillment_estimate)
+        self.assertFalse(user.profile.situation)
+        self.assertEqual('Pascal', user.profile.name)
+        self.assertTrue(migration.is_up_to_date(user))
+        self.assertEqual(
+            {
+                '$set': {
+                    'projects.0.kind': 'FIND_A_FIRST_JOB',
+                    'projects.0.trainingFulfillmentEstimate': 'NO_TRAINING_REQUIRED',
+                    'schemaVersion': migration.CURRENT_VERSION,
+                },
+                '$unset': {
+                    'profile.situation': '',
+                    'projects.0.diplomaFulfillmentEstimate': '',
+                },
+                '$inc': {'_externalRevision': 1},
+            },
+            update)
+
+    def test_upgrade_user_up_to_date(self):
+        """Do not touch a user that is already up to date."""
+        user = user_pb2.User(schema_version=migration.CURRENT_VERSION)
+        user.profile.situation = user_pb2.FIRST_TIME
+
+        self.assertEqual({}, migration.upgrade_user(user))
+
+        self.assertEqual(user_pb2.FIRST_TIME, user.profile.situation)
+
+    def test_job_search_length(self):
+        """Migrate the job search length to a start date."""
+        user = user_pb2.User()
+        project = user.projects.add(job_search_length_months=6)
+        project.created_at.FromJsonString('2017-10-01T12:00:00Z')
+        user.projects.add(job_search_length_months=-1)
+
+        migration.upgrade_user(user)
+
+        self.assertEqual(
+            '2017-04-01T12:00:00Z', user.projects[0].job_search_started_at.ToJsonString())
+        self.assertTrue(user.projects[1].job_search_has_not_started)
+
+    def test_migrate_user_twice(self):
+        """Migrations leave migrated data untouched."""
+        user = user_pb2.User()
+        user.profile.situation = user_pb2.LOST_QUIT
+        user.projects.add(kind=project_pb2.FIND_JOB, job_search_length_months=3)
+        migration.migrate_user(user)
+        migrated_user = user_pb2.User()
+        migrated_user.CopyFrom(user)
+
+        migration.migrate_user(user)
+
+        self.assertEqual(migrated_user, user)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,30 @@
+"""Helpers to use mongomock as a test double of MongoDB."""
+import mock
+import pymongo
+
+
+def _as_update_many(request):
+    if not isinstance(request, pymongo.UpdateOne):
+        return request
+    # pylint: disable=protected-access
+    return pymongo.UpdateMany(request._filter, request._doc, upsert=request._upsert)
+
+
+def patch_bulk_write(collection):
+    """Patch the bulk_write method of a mongomock collection to accept UpdateOne requests.
+
+    mongomock does not support the UpdateOne requests of recent versions of
+    pymongo. They are run as UpdateMany requests instead, which is the same as
+    long as their filters match only one document.
+
+    Args:
+        collection: a mongomock collection.
+    Returns:
+        a patcher to start and stop, like the ones of mock.patch.
+    """
+    bulk_write = collection.bulk_write
+
+    def _bulk_write(requests, *args, **kwargs):
+        return bulk_write([_as_update_many(request) for request in requests], *args, **kwargs)
+
+    return mock.patch.object(collection, 'bulk_write', side_effect=_bulk_write)
@@ -0,0 +1,331 @@
+"""Unit tests for the bob_emploi.frontend.outbox module."""
+import datetime
+import unittest
+
+import mock
+import mongomock
+import requests
+
+from bob_emploi.frontend import outbox
+from bob_emploi.frontend.api import user_pb2
+
+
+def _response(status_code, message_id=None):
+    response = mock.MagicMock()
+    response.status_code = status_code
+    response.json.return_value = {'Sent': [{'MessageID': message_id}] if message_id else []}
+    return response
+
+
+@mock.patch(outbox.now.__name__ + '.get')
+@mock.patch(outbox.mail.__name__ + '.send_template')
+class OutboxTestCase(unittest.TestCase):
+    """Unit tests for the outbox functions."""
+
+    def setUp(self):
+        super(OutboxTestCase, self).setUp()
+        self._db = mongomock.MongoClient().test
+        self._now = datetime.datetime(2017, 11, 10, 12)
+        self._profile = user_pb2.UserProfile(
+            email='pascal@example.com', name='Pascal', last_name='Corpet')
+
+    def _enqueue(self, key='my-key', **kwargs):
+        return outbox.enqueue(self._db, key, '1234', self._profile, {'foo': 'bar'}, **kwargs)
+
+    def test_enqueue_once(self, mock_send_template, mock_now):
+        """Enqueue a message only once for a given key."""
+        mock_now.return_value = self._now
+
+        self.assertTrue(self._enqueue())
+        self.assertFalse(self._enqueue())
+
+        self.assertEqual(1, outbox.count_pending(self._db))
+        mock_send_template.assert_not_called()
+
+    def test_dispatch(self, mock_send_template, mock_now):
+        """Send the pending messages."""
+        mock_now.return_value = self._now
+        mock_send_template.return_value = _response(200, message_id=4567)
+        self._enqueue(monitoring_category='reset', sender_name='Bob')
+
+        self.assertEqual(1, outbox.dispatch(self._db))
+
+        mock_send_template.assert_called_once()
+        template_id, recipient, template_vars = mock_send_template.call_args[0]
+        self.assertEqual('1234', template_id)
+        self.assertEqual('pascal@example.com', recipient.email)
+        self.assertEqual('Corpet', recipient.last_name)
+        self.assertEqual({'foo': 'bar'}, template_vars)
+        self.assertEqual(
+            {'dry_run': False, 'monitoring_category': 'reset', 'sender_name': 'Bob'},
+            mock_send_template.call_args[1])
+        message = self._db.email_outbox.find_one()
+        self.assertEqual('sent', message['status'])
+        self.assertEqual(4567, message['messageId'])
+        self.assertEqual(0, outbox.count_pending(self._db))
+
+        # Nothing left to send.
+        self.assertEqual(0, outbox.dispatch(self._db))
+        mock_send_template.assert_called_once()
+
+    def test_retry_later(self, mock_send_template, mock_now):
+        """Retry messages that could not be sent, with a backoff."""
+        mock_now.return_value = self._now
+        mock_send_template.side_effect = requests.exceptions.ConnectionError('Oops')
+        self._enqueue()
+
+        self.assertEqual(1, outbox.dispatch(self._db))
+        message = self._db.email_outbox.find_one()
+        self.assertEqual('pending', message['status'])
+        self.assertEqual(self._now + datetime.timedelta(minutes=1), message['nextAttemptAt'])
+
+        # Too soon to retry.
+        self.assertEqual(0, outbox.dispatch(self._db))
+
+        mock_now.return_value = self._now + datetime.timedelta(minutes=2)
+        mock_send_template.side_effect = None
+        mock_send_template.return_value = _response(429)
+        self.assertEqual(1, outbox.dispatch(self._db))
+        message = self._db.email_outbox.find_one()
+        self.assertEqual('pending', message['status'])
+        self.assertEqual(429, message['lastError'])
+        self.assertEqual(self._now + datetime.timedelta(minutes=4), message['nextAttemptAt'])
+
+        mock_now.return_value = self._now + datetime.timedelta(minutes=5)
+        mock_send_template.return_value = _response(200)
+        self.assertEqual(1, outbox.dispatch(self._db))
+        self.assertEqual('sent', self._db.email_outbox.find_one()['status'])
+        self.assertEqual(3, mock_send_template.call_count)
+
+    def test_permanent_error(self, mock_send_template, mock_now):
+        """Do not retry messages that MailJet rejected."""
+        mock_now.return_value = self._now
+        mock_send_template.return_value = _response(400)
+        self._enqueue()
+
+        with mock.patch(outbox.logging.__name__ + '.error') as mock_error:
+            self.assertEqual(1, outbox.dispatch(self._db))
+        mock_error.assert_called_once()
+
+        message = self._db.email_outbox.find_one()
+        self.assertEqual('failed', message['status'])
+        self.assertEqual(400, message['lastError'])
+        self.assertEqual(0, outbox.count_pending(self._db))
+
+    def test_max_attempts(self, mock_send_template, mock_now):
+        """Give up after too many attempts."""
+        mock_send_template.return_value = _response(500)
+        mock_now.return_value = self._now
+        self._enqueue()
+
+        with mock.patch(outbox.logging.__name__ + '.error'):
+            for day in range(10):
+                mock_now.return_value = self._now + datetime.timedelta(days=day)
+                outbox.dispatch(self._db)
+
+        self.assertEqual(5, mock_send_template.call_count)
+        self.assertEqual('failed', self._db.email_outbox.find_one()['status'])
+
+    def test_claim_expired_lock(self, mock_send_template, mock_now):
+        """Send again messages claimed by a dispatcher that crashed."""
+        mock_now.return_value = self._now
+        mock_send_template.side_effect = KeyboardInterrupt
+        self._enqueue()
+        with self.assertRaises(KeyboardInterrupt):
+            outbox.dispatch(self._db)
+        self.assertEqual('sending', self._db.email_outbox.find_one()['status'])
+
+        mock_send_template.side_effect = None
+        mock_send_template.return_value = _response(200)
+        # Still locked.
+        self.assertEqual(0, outbox.dispatch(self._db))
+
+        mock_now.return_value = self._now + datetime.timedelta(minutes=10)
+        self.assertEqual(1, outbox.dispatch(self._db))
+        self.assertEqual('sent', self._db.email_outbox.find_one()['status'])
+
+    def test_max_messages(self, mock_send_template, mock_now):
+        """Send only some messages of the outbox."""
+        mock_now.return_value = self._now
+        mock_send_template.return_value = _response(200)
+        for index in range(3):
+            self._enqueue(key='key-{:d}'.format(index))
+
+        self.assertEqual(2, outbox.dispatch(self._db, max_messages=2))
+        self.assertEqual(1, outbox.count_pending(self._db))
+
+    def test_wait_for_room(self, unused_mock_send_template, mock_now):
+        """Wait for the dispatcher to send messages when the outbox is full."""
+        mock_now.return_value = self._now
+        for index in range(3):
+            self._enqueue(key='key-{:d}'.format(index))
+
+        def _send_one(unused_seconds):
+            self._db.email_outbox.update_one({'status': 'pending'}, {'$set': {'status': 'sent'}})
+
+        mock_sleep = mock.MagicMock(side_effect=_send_one)
+        outbox.wait_for_room(self._db, max_pending=2, sleep=mock_sleep)
+
+        self.assertEqual(2, mock_sleep.call_count)
+        self.assertEqual(1, outbox.count_pending(self._db))
+
+    def test_api_error(self, mock_send_template, mock_now):
+        """Retry messages when the MailJet client raises an error."""
+        mock_now.return_value = self._now
+        mock_send_template.side_effect = outbox.mailjet_rest.client.ApiError('Oops')
+        self._enqueue()
+
+        with mock.patch(outbox.logging.__name__ + '.warning'):
+            self.assertEqual(1, outbox.dispatch(self._db))
+
+        message = self._db.email_outbox.find_one()
+        self.assertEqual('pending', message['status'])
+        self.assertEqual(self._now + datetime.timedelta(minutes=1), message['nextAttemptAt'])
+
+    def test_unexpected_error(self, mock_send_template, mock_now):
+        """Keep sending the other messages when one of them raises an error."""
+        mock_now.return_value = self._now
+        mock_send_template.side_effect = [ValueError('Oops'), _response(200)]
+        self._enqueue(key='key-1')
+        self._enqueue(key='key-2')
+
+        with mock.patch(outbox.logging.__name__ + '.exception') as mock_exception:
+            self.assertEqual(2, outbox.dispatch(self._db))
+        mock_exception.assert_called_once()
+
+        self.assertEqual(
+            ['pending', 'sent'],
+            sorted(message['status'] for message in self._db.email_outbox.find()))
+
+    def test_crash_too_many_times(self, mock_send_template, mock_now):
+        """Give up on messages that keep crashing the dispatchers."""
+        mock_now.return_value = self._now
+        mock_send_template.side_effect = KeyboardInterrupt
+        self._enqueue()
+
+        for attempt in range(5):
+            mock_now.return_value = self._now + datetime.timedelta(minutes=10 * attempt)
+            with self.assertRaises(KeyboardInterrupt):
+                outbox.dispatch(self._db)
+
+        mock_now.return_value = self._now + datetime.timedelta(minutes=50)
+        with mock.patch(outbox.logging.__name__ + '.error') as mock_error:
+            self.assertEqual(1, outbox.dispatch(self._db))
+        mock_error.assert_called_once()
+
+        self.assertEqual(5, mock_send_template.call_count)
+        self.assertEqual('failed', self._db.email_outbox.find_one()['status'])
+        self.assertEqual(0, outbox.count_pending(self._db))
+
+    def test_ensure_indexes(self, unused_mock_send_template, unused_mock_now):
+        """Index the messages by status and time of the next attempt."""
+        outbox.ensure_indexes(self._db)
+
+        indexed_keys = [
+            index['key'] for index in self._db.email_outbox.index_information().values()]
+        self.assertIn([('status', 1), ('nextAttemptAt', 1)], indexed_keys)
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    """Unit tests for the TokenBucket class."""
+
+    def setUp(self):
+        super(TokenBucketTestCase, self).setUp()
+        self._time = 100.
+
+        def _sleep(seconds):
+            self.sleeps.append(seconds)
+            self._time += seconds
+
+        self.sleeps = []
+        self._bucket = outbox.TokenBucket(
+            2, capacity=3, clock=lambda: self._time, sleep=_sleep)
+
+    def test_burst(self):
+        """Allow bursts up to the capacity, then limit to the rate."""
+        for unused_index in range(3):
+            self._bucket.acquire()
+        self.assertEqual([], self.sleeps)
+
+        self._bucket.acquire()
+        self._bucket.acquire()
+        self.assertEqual([.5, .5], self.sleeps)
+
+    def test_refill(self):
+        """Refill the bucket with time, up to its capacity."""
+        for unused_index in range(3):
+            self._bucket.acquire()
+
+        self._time += 60
+        for unused_index in range(3):
+            self._bucket.acquire()
+        self.assertEqual([], self.sleeps)
+
+        self._bucket.acquire()
+        self.assertEqual([.5], self.sleeps)
+
+
+class MongoTokenBucketTestCase(unittest.TestCase):
+    """Unit tests for the MongoTokenBucket class."""
+
+    def setUp(self):
+        super(MongoTokenBucketTestCase, self).setUp()
+        self._db = mongomock.MongoClient().test
+        self._time = 100.
+
+        def _sleep(seconds):
+            self.sleeps.append(seconds)
+            self._time += seconds
+
+        self.sleeps = []
+        self._buckets = [
+            outbox.MongoTokenBucket(
+                self._db, 2, capacity=3, clock=lambda: self._time, sleep=_sleep)
+            for unused_index in range(2)]
+
+    def test_shared(self):
+        """Share the tokens between all the buckets with the same name."""
+        self._buckets[0].acquire(2)
+        self._buckets[1].acquire()
+        self.assertEqual([], self.sleeps)
+
+        self._buckets[0].acquire()
+        self._buckets[1].acquire()
+        self.assertEqual([.5, .5], self.sleeps)
+
+    def test_refill(self):
+        """Refill the bucket with time, up to its capacity."""
+        self._buckets[0].acquire(3)
+
+        self._time += 60
+        self._buckets[1].acquire(3)
+        self.assertEqual([], self.sleeps)
+
+        self._buckets[0].acquire()
+        self.assertEqual([.5], self.sleeps)
+
+    def test_updated_concurrently(self):
+        """Do not lose the tokens taken by another process in between."""
+        self._buckets[0].acquire()
+        real_find_one = self._db.email_rate_limit.find_one
+        concurrent_updates = []
+
+        def _find_one_then_take(*args, **kwargs):
+            stored = real_find_one(*args, **kwargs)
+            if not concurrent_updates:
+                # Another process takes 3 tokens, half a second later.
+                concurrent_updates.append(self._db.email_rate_limit.update_one(
+                    {'_id': 'mailjet'},
+                    {'$inc': {'tokens': -3}, '$set': {'updatedAt': self._time + .5}}))
+            return stored
+
+        with mock.patch.object(
+                self._db.email_rate_limit, 'find_one', side_effect=_find_one_then_take):
+            self._buckets[1].acquire()
+
+        # 3 tokens at first, minus 1, minus 3 taken concurrently, minus 1.
+        self.assertEqual([1.], self.sleeps)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,118 @@
+"""Benchmark of the bob_emploi.frontend.proto.parse_from_mongo function.
+
+Compares the parsing of a large user document with json_format, and with
+the converters compiled from the descriptors.
+
+Run it with:
+    python -m bob_emploi.frontend.test.proto_benchmark
+"""
+import copy
+import datetime
+import timeit
+
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import user_pb2
+
+
+def make_user_dict(num_projects=3, num_actions=30, num_emails=50):
+    """Create a large user document as stored in MongoDB."""
+    now = datetime.datetime(2017, 10, 1, 12, 34, 56, 789000)
+    return {
+        '_id': 'my-user-id',
+        'profile': {
+            'name': 'Pascal',
+            'lastName': 'Corpet',
+            'email': 'pascal@example.com',
+            'gender': 'MASCULINE',
+            'yearOfBirth': 1982,
+            'highestDegree': 'DEA_DESS_MASTER_PHD',
+            'isNewsletterEnabled': True,
+        },
+        'registeredAt': now,
+        'featuresEnabled': {'alpha': True, 'lbbIntegration': 'ACTIVE'},
+        'projects': [
+            {
+                'projectId': 'project-{}'.format(project_index),
+                'title': 'Boulanger à Lyon',
+                'status': 'PROJECT_CURRENT',
+                'createdAt': now,
+                'targetJob': {
+                    'codeOgr': '12345',
+                    'name': 'Boulanger',
+                    'jobGroup': {'romeId': 'D1102', 'name': 'Boulangerie'},
+                },
+                'mobility': {
+                    'city': {
+                        'cityId': '69123',
+                        'name': 'Lyon',
+                        'departementId': '69',
+                        'regionId': '84',
+                        'latitude': 45.75,
+                        'longitude': 4.85,
+                    },
+                    'areaType': 'CITY',
+                },
+                'minSalary': 21000.,
+                'employmentTypes': ['CDI', 'CDD_OVER_3_MONTHS'],
+                'activatedChantiers': {'chantier-{}'.format(i): True for i in range(5)},
+                'networkEstimate': 2,
+                'totalInterviewCount': 3,
+                'actions': [
+                    {
+                        'actionId': 'action-{}'.format(action_index),
+                        'title': 'Envoyer une candidature spontanée',
+                        'shortDescription': 'Une candidature spontanée à une entreprise.',
+                        'status': 'ACTION_DONE',
+                        'createdAt': now,
+                        'stoppedAt': now,
+                        'actionTemplateId': 'template-{}'.format(action_index),
+                    }
+                    for action_index in range(num_actions)
+                ],
+                'advices': [
+                    {
+                        'adviceId': 'advice-{}'.format(advice_index),
+                        'status': 'ADVICE_RECOMMENDED',
+                        'numStars': 2,
+                        'score': 5,
+                    }
+                    for advice_index in range(10)
+                ],
+            }
+            for project_index in range(num_projects)
+        ],
+        'emailsSent': [
+            {
+                'sentAt': now,
+                'mailjetTemplate': '100819',
+                'campaignId': 'focus-network',
+                'mailjetMessageId': 123456789 + email_index,
+                'status': 'EMAIL_SENT_OPENED',
+            }
+            for email_index in range(num_emails)
+        ],
+    }
+
+
+def _parse_with_json_format(user_dict):
+    proto._parse_with_json_format(user_dict, user_pb2.User())  # pylint: disable=protected-access
+
+
+def _parse_from_mongo(user_dict):
+    proto.parse_from_mongo(user_dict, user_pb2.User())
+
+
+def main(number=200):
+    """Print the time spent to parse a large user with each method."""
+    user_dict = make_user_dict()
+    for name, parse in (
+            ('json_format', _parse_with_json_format), ('parse_from_mongo', _parse_from_mongo)):
+        # Each parse modifies its input dict, so each one gets a fresh copy.
+        dicts = [copy.deepcopy(user_dict) for unused_index in range(number)]
+        duration = timeit.timeit(
+            lambda parse=parse, dicts=dicts: parse(dicts.pop()), number=number)
+        print('{}: {:.2f}ms per user'.format(name, duration / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
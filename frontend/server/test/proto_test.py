@@ -1,15 +1,24 @@
 """Unit tests for the bob_emploi.frontend.proto module."""
+import copy
 import datetime
+import gzip
+import json
+import threading
+import time
 import unittest
 from urllib import parse
 
 import flask
+from google.protobuf import json_format
 import mock
 import mongomock
+from werkzeug import exceptions
 
 from bob_emploi.frontend import proto
 from bob_emploi.frontend.api import action_pb2
 from bob_emploi.frontend.api import job_pb2
+from bob_emploi.frontend.api import user_pb2
+from bob_emploi.frontend.test import proto_benchmark
 
 app = flask.Flask(__name__)  # pylint: disable=invalid-name
 
@@ -25,7 +34,7 @@ class DecoratorTestCase(unittest.TestCase):
             job.rome_id = 'A1234'
             return job
 
-        self.assertEqual('{\n  "romeId": "A1234"\n}', _func())
+        self.assertEqual('{"romeId":"A1234"}', _func())
 
     def test_proto_api_wrong_return(self):
         """Check that @flask_api enforces the type of the return value."""
@@ -108,6 +117,63 @@ class DecoratorTestCase(unittest.TestCase):
         self.assertEqual(['A1234'], [job_group.rome_id for job_group in calls])
         self.assertEqual(r'A1234 \o/', result)
 
+    def test_proto_api_json_response(self):
+        """Send a compact JSON response."""
+        @proto.flask_api(out_type=job_pb2.JobGroup)
+        def _func():
+            return job_pb2.JobGroup(rome_id='A1234', name='Boulangère')
+
+        with app.test_request_context(method='GET'):
+            response = _func()
+
+        self.assertEqual('application/json', response.mimetype)
+        self.assertEqual('{"romeId":"A1234","name":"Boulangère"}', response.get_data(as_text=True))
+        self.assertFalse(response.content_encoding)
+
+    def test_proto_api_binary_proto(self):
+        """Accept and send binary protos."""
+        @proto.flask_api(in_type=job_pb2.JobGroup, out_type=job_pb2.JobGroup)
+        def _func(job_group):
+            job_group.name = 'Boulangerie'
+            return job_group
+
+        with app.test_request_context(
+                method='POST', data=job_pb2.JobGroup(rome_id='A1234').SerializeToString(),
+                content_type='application/x-protobuf',
+                headers={'Accept': 'application/x-protobuf'}):
+            response = _func()  # pylint: disable=no-value-for-parameter
+
+        self.assertEqual('application/x-protobuf', response.mimetype)
+        self.assertEqual(
+            job_pb2.JobGroup(rome_id='A1234', name='Boulangerie'),
+            job_pb2.JobGroup.FromString(response.get_data()))
+
+    def test_proto_api_wrong_binary_proto(self):
+        """Check that an invalid binary proto raises a 422 error."""
+        @proto.flask_api(in_type=job_pb2.JobGroup, out_type=job_pb2.JobGroup)
+        def _func(job_group):
+            return job_group
+
+        with app.test_request_context(
+                method='POST', data=b'\xff\xff', content_type='application/x-protobuf'), \
+                self.assertRaises(exceptions.UnprocessableEntity):
+            _func()  # pylint: disable=no-value-for-parameter
+
+    def test_proto_api_compressed_response(self):
+        """Compress large responses."""
+        @proto.flask_api(out_type=job_pb2.JobGroup)
+        def _func():
+            return job_pb2.JobGroup(rome_id='A1234', name='Boulangerie' * 200)
+
+        with app.test_request_context(method='GET', headers={'Accept-Encoding': 'gzip'}):
+            response = _func()
+
+        self.assertEqual('gzip', response.content_encoding)
+        self.assertEqual(
+            'Boulangerie' * 200,
+            json.loads(gzip.decompress(response.get_data()).decode('utf-8'))['name'])
+        self.assertLess(len(response.get_data()), 1000)
+
 
 class CacheMongoTestCase(unittest.TestCase):
     """Unit tests for the MongoCachedCollection class."""
@@ -143,6 +209,32 @@ class CacheMongoTestCase(unittest.TestCase):
         cache = [g for g in self._collection.get_collection(self._db)]
         self.assertEqual(['A124'], [g.rome_id for g in cache])
 
+    @mock.patch(proto.__name__ + '._META_CHECK_INTERVAL', new=datetime.timedelta(0))
+    @mock.patch(proto.__name__ + '._REFRESH_CACHE_IN_BACKGROUND', new=False)
+    def test_new_import(self):
+        """The cache is reloaded when the collection is imported again."""
+        self._db.basic.insert_many([
+            {'_id': 'A123', 'romeId': 'A123', 'name': 'Job Group 1'},
+            {'_id': 'A124', 'romeId': 'A124', 'name': 'Job Group 2'},
+        ])
+        self._db.meta.insert_one({'_id': 'basic', 'updated_at': datetime.datetime(2017, 10, 1)})
+
+        cache = [g for g in self._collection.get_collection(self._db)]
+        self.assertEqual(['A123', 'A124'], [g.rome_id for g in cache])
+
+        # Update the collection behind the scene, without recording an import.
+        self._db.basic.delete_one({'_id': 'A123'})
+
+        cache = [g for g in self._collection.get_collection(self._db)]
+        self.assertEqual(['A123', 'A124'], [g.rome_id for g in cache])
+
+        # Record an import.
+        self._db.meta.update_one(
+            {'_id': 'basic'}, {'$set': {'updated_at': datetime.datetime(2017, 10, 2)}})
+
+        cache = [g for g in self._collection.get_collection(self._db)]
+        self.assertEqual(['A124'], [g.rome_id for g in cache])
+
     def test_as_dict(self):
         """Test use with a dict cache."""
         self._db.basic.insert_many([
@@ -156,6 +248,222 @@ class CacheMongoTestCase(unittest.TestCase):
         self.assertEqual('Job Group 2', cache.get('A124').name)
 
 
+class CacheRefreshTestCase(unittest.TestCase):
+    """Unit tests for the refresh of cached collections."""
+
+    def setUp(self):
+        super(CacheRefreshTestCase, self).setUp()
+        self._populate_calls = 0
+        self._can_populate = threading.Event()
+        self._can_populate.set()
+
+    def _populate(self, cache):
+        self._populate_calls += 1
+        value = self._populate_calls
+        self._can_populate.wait()
+        cache['value'] = value
+
+    def _wait_for(self, func):
+        for unused_index in range(100):
+            if func():
+                return
+            time.sleep(.01)
+        self.fail('Timed out')  # pragma: no cover
+
+    def test_refresh_inline(self):
+        """Refresh an expired cache on the calling thread."""
+        cache = proto._MongoCachedCollection(  # pylint: disable=protected-access
+            self._populate, cache_duration=datetime.timedelta(0), refresh_in_background=False)
+
+        self.assertEqual(1, cache.get('value'))
+        self.assertEqual(2, cache.get('value'))
+
+    def test_refresh_in_background(self):
+        """Serve an expired cache while it is refreshed in the background."""
+        cache = proto._MongoCachedCollection(  # pylint: disable=protected-access
+            self._populate, cache_duration=datetime.timedelta(0), refresh_in_background=True)
+        self.assertEqual(1, cache.get('value'))
+
+        self._can_populate.clear()
+        self.assertEqual(1, cache.get('value'))
+        self.assertEqual(1, cache.get('value'))
+        self._wait_for(lambda: self._populate_calls > 1)
+        self.assertEqual(1, cache.get('value'))
+        # Only one background refresh is running at a time.
+        self.assertEqual(2, self._populate_calls)
+
+        self._can_populate.set()
+        self._wait_for(lambda: cache.get('value') > 1)
+
+    def test_too_stale_for_background(self):
+        """Refresh inline a cache that expired too long ago."""
+        cache = proto._MongoCachedCollection(  # pylint: disable=protected-access
+            self._populate, cache_duration=datetime.timedelta(0),
+            max_stale_duration=datetime.timedelta(0), refresh_in_background=True)
+
+        self.assertEqual(1, cache.get('value'))
+        self.assertEqual(2, cache.get('value'))
+
+
+class CachedDocumentsTestCase(unittest.TestCase):
+    """Unit tests for the MongoCachedDocuments class."""
+
+    def setUp(self):
+        """Set up mock environment."""
+        super(CachedDocumentsTestCase, self).setUp()
+        self._db = mongomock.MongoClient().get_database('test')
+        self._db.basic.insert_many([
+            {'_id': 'A123', 'romeId': 'A123', 'name': 'Job Group 1'},
+            {'_id': 'A124', 'romeId': 'A124', 'name': 'Job Group 2'},
+            {'_id': 'A125', 'romeId': 'A125', 'name': 'Job Group 3'},
+        ])
+        self._cache = proto.MongoCachedDocuments(job_pb2.JobGroup, 'basic', max_size=2)
+
+    def test_basic(self):
+        """Test basic usage."""
+        self.assertEqual('Job Group 1', self._cache.get_proto(self._db, 'A123').name)
+        self.assertIsNone(self._cache.get_proto(self._db, 'Z999'))
+        self.assertEqual((0, 2), (self._cache.hits, self._cache.misses))
+
+        # Update the collection behind the scene.
+        self._db.basic.delete_one({'_id': 'A123'})
+        self._db.basic.insert_one({'_id': 'Z999', 'romeId': 'Z999'})
+
+        self.assertEqual('Job Group 1', self._cache.get_proto(self._db, 'A123').name)
+        self.assertIsNone(self._cache.get_proto(self._db, 'Z999'))
+        self.assertEqual((2, 2), (self._cache.hits, self._cache.misses))
+
+        self._cache.reset_cache()
+
+        self.assertIsNone(self._cache.get_proto(self._db, 'A123'))
+        self.assertEqual('Z999', self._cache.get_proto(self._db, 'Z999').rome_id)
+
+    def test_get_many(self):
+        """Get many documents at once."""
+        self.assertEqual(
+            {'A123': 'Job Group 1', 'A124': 'Job Group 2'},
+            {k: v.name for k, v in self._cache.get_many(self._db, ['A123', 'A124', 'Z']).items()})
+
+    def test_least_recently_used(self):
+        """Evicts the least recently used documents."""
+        self._cache.get_proto(self._db, 'A123')
+        self._cache.get_proto(self._db, 'A124')
+        self._cache.get_proto(self._db, 'A123')
+        self._cache.get_proto(self._db, 'A125')
+
+        self._db.basic.drop()
+
+        self.assertTrue(self._cache.get_proto(self._db, 'A123'))
+        self.assertTrue(self._cache.get_proto(self._db, 'A125'))
+        self.assertIsNone(self._cache.get_proto(self._db, 'A124'))
+
+    def test_expiry(self):
+        """Documents are fetched again once they have expired."""
+        cache = proto.MongoCachedDocuments(
+            job_pb2.JobGroup, 'basic', cache_duration=datetime.timedelta(0))
+        cache.get_proto(self._db, 'A123')
+        self._db.basic.drop()
+
+        self.assertIsNone(cache.get_proto(self._db, 'A123'))
+        self.assertEqual(2, cache.misses)
+
+    @mock.patch(proto.__name__ + '._META_CHECK_INTERVAL', new=datetime.timedelta(0))
+    def test_new_import(self):
+        """Documents are fetched again when the collection is imported again."""
+        self._cache.get_proto(self._db, 'A123')
+        self._db.basic.update_one({'_id': 'A123'}, {'$set': {'name': 'New Job Group 1'}})
+        self.assertEqual('Job Group 1', self._cache.get_proto(self._db, 'A123').name)
+
+        self._db.meta.insert_one({'_id': 'basic', 'updated_at': datetime.datetime(2017, 10, 1)})
+        self.assertEqual('New Job Group 1', self._cache.get_proto(self._db, 'A123').name)
+
+    def test_concurrent_misses(self):
+        """Concurrent misses on the same document only fetch it once."""
+        database = mock.MagicMock()
+
+        def _slow_find(unused_filter):
+            time.sleep(.05)
+            return [{'_id': 'A123', 'name': 'Job Group 1'}]
+        database.get_collection().find.side_effect = _slow_find
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self._cache.get_proto(database, 'A123')))
+            for unused_index in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(['Job Group 1'] * 5, [r.name for r in results])
+        database.get_collection().find.assert_called_once()
+
+
+class CachedIdsTestCase(unittest.TestCase):
+    """Unit tests for the MongoCachedIds class."""
+
+    def setUp(self):
+        """Set up mock environment."""
+        super(CachedIdsTestCase, self).setUp()
+        self._db = mongomock.MongoClient().get_database('test')
+        self._db.basic.insert_many([{'_id': 'A123'}, {'_id': 'A124'}])
+        self._ids = proto.MongoCachedIds('basic')
+
+    def test_basic(self):
+        """Test basic usage."""
+        self.assertTrue(self._ids.contains(self._db, 'A123'))
+        self.assertTrue(self._ids.contains(self._db, 'A124'))
+        self.assertFalse(self._ids.contains(self._db, 'Z999'))
+
+    def test_missing_id_without_request(self):
+        """Check a missing ID without any request to MongoDB."""
+        database = mock.MagicMock()
+        database.meta.find_one.return_value = None
+        database.get_collection().find.return_value = [{'_id': 'A123'}]
+
+        self.assertFalse(self._ids.contains(database, 'Z999'))
+        self.assertFalse(self._ids.contains(database, 'Z998'))
+
+        database.get_collection().find.assert_called_once_with({}, {'_id': 1})
+
+    def test_exact_check(self):
+        """Positive answers are confirmed in MongoDB."""
+        self._ids.contains(self._db, 'A123')
+        self._db.basic.delete_one({'_id': 'A123'})
+
+        self.assertFalse(self._ids.contains(self._db, 'A123'))
+
+    def test_empty_collection(self):
+        """Check IDs in an empty collection."""
+        self.assertFalse(proto.MongoCachedIds('empty').contains(self._db, 'A123'))
+
+    @mock.patch(proto.__name__ + '._META_CHECK_INTERVAL', new=datetime.timedelta(0))
+    def test_new_import(self):
+        """IDs are loaded again when the collection is imported again."""
+        self._ids.contains(self._db, 'A123')
+        self._db.basic.insert_one({'_id': 'B123'})
+        self._db.meta.insert_one({'_id': 'basic', 'updated_at': datetime.datetime(2017, 10, 1)})
+
+        self.assertTrue(self._ids.contains(self._db, 'B123'))
+
+    def test_reset_cache(self):
+        """IDs are loaded again after resetting the cache."""
+        self._ids.contains(self._db, 'A123')
+        self._db.basic.insert_one({'_id': 'B123'})
+        self._ids.reset_cache()
+
+        self.assertTrue(self._ids.contains(self._db, 'B123'))
+
+    def test_bloom_filter(self):
+        """The Bloom filter never misses a value and has few false positives."""
+        values = ['value-{}'.format(i) for i in range(10000)]
+        bloom_filter = proto._BloomFilter(values, .01)  # pylint: disable=protected-access
+
+        self.assertTrue(all(value in bloom_filter for value in values))
+        false_positives = sum('other-{}'.format(i) in bloom_filter for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
 @mock.patch(proto.__name__ + '._IS_TEST_ENV', new=False)
 class ParseFromMongoTestCase(unittest.TestCase):
     """Unit tests for the parse_from_mongo function."""
@@ -188,6 +496,192 @@ class ParseFromMongoTestCase(unittest.TestCase):
         self.assertEqual('JobGroup', str(mock_warning.call_args[0][2]))
         self.assertEqual("{'romeId': 123}", str(mock_warning.call_args[0][3]))
 
+    def test_same_as_json_format(self):
+        """Parse a large document as json_format does."""
+        user_dict = proto_benchmark.make_user_dict()
+        user = user_pb2.User()
+        self.assertTrue(proto.parse_from_mongo(copy.deepcopy(user_dict), user))
+
+        expected_user = user_pb2.User()
+        # pylint: disable=protected-access
+        self.assertTrue(proto._parse_with_json_format(user_dict, expected_user))
+        self.assertEqual(expected_user, user)
+        self.assertEqual('Lyon', user.projects[2].mobility.city.name)
+        self.assertEqual(
+            datetime.datetime(2017, 10, 1, 12, 34, 56, 789000),
+            user.emails_sent[49].sent_at.ToDatetime())
+
+    def test_converted_values(self):
+        """Parse values that need a conversion."""
+        local_stats = job_pb2.LocalJobStats()
+        self.assertTrue(proto.parse_from_mongo({
+            'numAvailableJobOffers': 12.0,
+            'num_job_offers_previous_year': '14',
+            'numJobOffersPerYear': {'2016': 3, '2017': 5},
+        }, local_stats))
+        self.assertEqual(12, local_stats.num_available_job_offers)
+        self.assertEqual(14, local_stats.num_job_offers_previous_year)
+        self.assertEqual({2016: 3, 2017: 5}, dict(local_stats.num_job_offers_per_year))
+
+    def test_map_of_messages(self):
+        """Parse a map of messages."""
+        job_group = job_pb2.JobGroup()
+        self.assertTrue(proto.parse_from_mongo({
+            'applicationModes': {
+                'R4Z92': {'modes': [{'mode': 'SPONTANEOUS_APPLICATION', 'percentage': 45.5}]},
+                'R4Z93': {},
+            },
+        }, job_group))
+        self.assertEqual(
+            job_pb2.SPONTANEOUS_APPLICATION, job_group.application_modes['R4Z92'].modes[0].mode)
+        self.assertIn('R4Z93', job_group.application_modes)
+
+    def test_empty_message(self):
+        """Keep track of empty messages."""
+        job_group = job_pb2.JobGroup()
+        self.assertTrue(proto.parse_from_mongo({'requirements': {}}, job_group))
+        self.assertTrue(job_group.HasField('requirements'))
+
+    def test_merge(self):
+        """Merge values in a proto that already has some."""
+        job_group = job_pb2.JobGroup(rome_id='A1234', name='Old name')
+        self.assertTrue(proto.parse_from_mongo({'name': 'New name'}, job_group))
+        self.assertEqual(job_pb2.JobGroup(rome_id='A1234', name='New name'), job_group)
+
+    def test_merge_same_as_json_format(self):
+        """Merge values in a proto that already has some as json_format does."""
+        user = user_pb2.User(
+            profile=user_pb2.UserProfile(name='Pascal', email='pascal@example.com'),
+            latest_changelog_seen='v1')
+        user.projects.add(title='First project')
+        user.projects.add(title='Second project')
+        user.likes['a'] = 1
+        user.emails_sent.add(campaign_id='focus-network')
+        user_dict = {
+            'profile': {'name': 'Cyrille'},
+            'projects': [{'title': 'New project'}],
+            'likes': {'b': 2},
+            'emailsSent': None,
+            'latestChangelogSeen': 'v2',
+        }
+
+        expected_user = user_pb2.User()
+        expected_user.CopyFrom(user)
+        # pylint: disable=protected-access
+        self.assertTrue(proto._parse_with_json_format(copy.deepcopy(user_dict), expected_user))
+
+        self.assertTrue(proto.parse_from_mongo(user_dict, user))
+        self.assertEqual(expected_user, user)
+        self.assertEqual(['New project'], [project.title for project in user.projects])
+        self.assertEqual('pascal@example.com', user.profile.email)
+
+    def test_unknown_enum_number(self):
+        """Let json_format decide whether to accept unknown enum numbers."""
+        profile = user_pb2.UserProfile()
+        with mock.patch(proto.__name__ + '._parse_with_json_format') as mock_parse:
+            proto.parse_from_mongo({'gender': 4242}, profile)
+        mock_parse.assert_called_once()
+
+    @mock.patch(proto.__name__ + '.logging.warning')
+    def test_weird_nested_objects(self, mock_warning):
+        """Do not parse a document with a value of the wrong type deep down."""
+        job_group = job_pb2.JobGroup()
+        self.assertFalse(proto.parse_from_mongo(
+            {'requirements': {'diplomas': [{'name': 'Bac'}, {'name': 12}]}}, job_group))
+        mock_warning.assert_called_once()
+
+    @mock.patch(proto.__name__ + '.logging.warning')
+    def test_multiple_oneof_fields(self, mock_warning):
+        """Do not parse a document with multiple fields of the same oneof."""
+        requirement = job_pb2.JobRequirement()
+        self.assertFalse(proto.parse_from_mongo(
+            {'diploma': {'name': 'Bac'}, 'officeSkillsLevel': 2}, requirement))
+        mock_warning.assert_called_once()
+
+    @mock.patch(proto.__name__ + '.logging.warning', new=mock.MagicMock())
+    def test_unknown_field_in_test_env(self):
+        """Unknown fields are errors in test environment."""
+        with mock.patch(proto.__name__ + '._IS_TEST_ENV', new=True), \
+                self.assertRaises(json_format.ParseError):
+            proto.parse_from_mongo({'name': 'Name', 'unknownField': 14}, job_pb2.JobGroup())
+
+
+class GetMongoUpdateTestCase(unittest.TestCase):
+    """Unit tests for the get_mongo_update function."""
+
+    def test_same_documents(self):
+        """No update for the same document."""
+        self.assertEqual({}, proto.get_mongo_update(
+            {'_id': 'my-id', 'a': 1, 'b': {'c': [1, 2]}}, {'a': 1, 'b': {'c': [1, 2]}}))
+
+    def test_set_and_unset(self):
+        """Set and unset only the modified fields."""
+        update = proto.get_mongo_update(
+            {'_id': 'my-id', 'a': 1, 'b': {'c': 'old', 'd': 'same'}, 'e': True},
+            {'a': 1, 'b': {'c': 'new', 'd': 'same', 'f': 3}})
+        self.assertEqual({
+            '$set': {'b.c': 'new', 'b.f': 3},
+            '$unset': {'e': ''},
+        }, update)
+
+    def test_private_fields(self):
+        """Keep the stored fields prefixed by "_" that are not in the new document."""
+        update = proto.get_mongo_update(
+            {'_id': 'my-id', '_externalRevision': 3, '_server': 'old', 'a': 1},
+            {'_server': 'new', 'a': 1})
+        self.assertEqual({'$set': {'_server': 'new'}}, update)
+
+    def test_change_type(self):
+        """Set a value that has the same value but a different type."""
+        self.assertEqual({'$set': {'a': True}}, proto.get_mongo_update({'a': 1}, {'a': True}))
+
+    def test_push(self):
+        """Push the items appended to a list."""
+        update = proto.get_mongo_update(
+            {'emailsSent': [{'campaignId': 'a'}, {'campaignId': 'b'}]},
+            {'emailsSent': [{'campaignId': 'a'}, {'campaignId': 'b'}, {'campaignId': 'c'}]})
+        self.assertEqual({'$push': {'emailsSent': {'$each': [{'campaignId': 'c'}]}}}, update)
+
+    def test_list_same_size(self):
+        """Update the modified items of a list."""
+        update = proto.get_mongo_update(
+            {'projects': [{'title': 'a', 'kind': 'X'}, {'title': 'b'}]},
+            {'projects': [{'title': 'a', 'kind': 'Y'}, {'title': 'b'}]})
+        self.assertEqual({'$set': {'projects.0.kind': 'Y'}}, update)
+
+    def test_list_modified(self):
+        """Replace a list that was not only appended to."""
+        update = proto.get_mongo_update(
+            {'projects': [{'title': 'a'}, {'title': 'b'}]},
+            {'projects': [{'title': 'b'}, {'title': 'c'}, {'title': 'd'}]})
+        self.assertEqual(
+            {'$set': {'projects': [{'title': 'b'}, {'title': 'c'}, {'title': 'd'}]}}, update)
+
+    def test_unsafe_keys(self):
+        """Set the whole dict when its keys cannot be used in a path."""
+        update = proto.get_mongo_update(
+            {'likes': {'a.b': 1, 'c': 2}}, {'likes': {'a.b': 1, 'c': 3}})
+        self.assertEqual({'$set': {'likes': {'a.b': 1, 'c': 3}}}, update)
+
+    def test_apply_update(self):
+        """The update gives the new document once applied."""
+        database = mongomock.MongoClient().test
+        stored = {
+            '_id': 'my-id',
+            'profile': {'name': 'Pascal', 'gender': 'MASCULINE'},
+            'projects': [{'title': 'a', 'actions': [{'actionId': '1'}]}],
+            'emailsSent': [{'campaignId': 'a'}],
+            'old': 'field',
+        }
+        new = {
+            'profile': {'name': 'Pascal', 'email': 'pascal@example.com'},
+            'projects': [{'title': 'b', 'actions': [{'actionId': '1'}, {'actionId': '2'}]}],
+            'emailsSent': [{'campaignId': 'a'}, {'campaignId': 'b'}],
+        }
+        database.user.insert_one(stored)
+        database.user.update_one({'_id': 'my-id'}, proto.get_mongo_update(stored, new))
+        self.assertEqual(dict(new, _id='my-id'), database.user.find_one({'_id': 'my-id'}))
+
 
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
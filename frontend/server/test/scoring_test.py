@@ -106,6 +106,7 @@ def ScoringModelTestBase(model_id):  # pylint: disable=invalid-name
         def setUp(self):
             super(_TestCase, self).setUp()
             self.database = mongomock.MongoClient().test
+            scoring.clear_cache()
             self.now = None
             self.assertIsInstance(
                 self.model, scoring.ModelBase, msg='model ID: "{}".'.format(self.model_id))
@@ -153,29 +154,29 @@ class TrainingAdviceScoringModelTestCase(ScoringModelTestBase('advice-training')
             training_pb2.Training(),
         ]
 
-    @mock.patch(scoring.carif.__name__ + '.get_trainings')
-    def test_low_advice_for_new_de(self, mock_carif_get_trainings):
+    @mock.patch(scoring.carif.__name__ + '.fetch_trainings')
+    def test_low_advice_for_new_de(self, mock_carif_fetch_trainings):
         """The user just started searching for a job."""
-        mock_carif_get_trainings.return_value = self._many_trainings
+        mock_carif_fetch_trainings.return_value = self._many_trainings
         self.persona.project.mobility.city.departement_id = '35'
         self.persona.project.target_job.job_group.rome_id = 'A1234'
         self.persona.project.job_search_length_months = 0
         if self.persona.project.kind == project_pb2.REORIENTATION:
             self.persona.project.kind = project_pb2.FIND_JOB
         self.assertGreater(2, self._score_persona(self.persona))
-        mock_carif_get_trainings.assert_called_once_with('A1234', '35')
+        mock_carif_fetch_trainings.assert_called_once_with('A1234', '35')
 
-    @mock.patch(scoring.carif.__name__ + '.get_trainings')
-    def test_three_stars(self, mock_carif_get_trainings):
+    @mock.patch(scoring.carif.__name__ + '.fetch_trainings')
+    def test_three_stars(self, mock_carif_fetch_trainings):
         """The user has been searching for a job for 3 months."""
-        mock_carif_get_trainings.return_value = self._many_trainings
+        mock_carif_fetch_trainings.return_value = self._many_trainings
         self.persona.project.job_search_length_months = 3
         self.assertEqual(3, self._score_persona(self.persona))
 
-    @mock.patch(scoring.carif.__name__ + '.get_trainings')
-    def test_one_month(self, mock_carif_get_trainings):
+    @mock.patch(scoring.carif.__name__ + '.fetch_trainings')
+    def test_one_month(self, mock_carif_fetch_trainings):
         """The user has been searching for a job for 1 month."""
-        mock_carif_get_trainings.return_value = self._many_trainings
+        mock_carif_fetch_trainings.return_value = self._many_trainings
         self.persona.project.job_search_length_months = 1
         if self.persona.project.kind == project_pb2.REORIENTATION:
             self.persona.project.kind = project_pb2.FIND_JOB
@@ -183,19 +184,32 @@ class TrainingAdviceScoringModelTestCase(ScoringModelTestBase('advice-training')
         self.assertGreater(3, score)
         self.assertLess(0, score)
 
-    @mock.patch(scoring.carif.__name__ + '.get_trainings')
-    def test_reorientation(self, mock_carif_get_trainings):
+    @mock.patch(scoring.carif.__name__ + '.fetch_trainings')
+    def test_reorientation(self, mock_carif_fetch_trainings):
         """The user is in reorientation."""
-        mock_carif_get_trainings.return_value = self._many_trainings
+        mock_carif_fetch_trainings.return_value = self._many_trainings
         self.persona.project.kind = project_pb2.REORIENTATION
         self.assertEqual(3, self._score_persona(self.persona))
 
-    @mock.patch(scoring.carif.__name__ + '.get_trainings')
-    def test_no_trainings(self, mock_carif_get_trainings):
+    @mock.patch(scoring.carif.__name__ + '.fetch_trainings')
+    def test_no_trainings(self, mock_carif_fetch_trainings):
         """There are no trainings for this combination."""
-        mock_carif_get_trainings.return_value = []
+        mock_carif_fetch_trainings.return_value = []
         self.assertEqual(0, self._score_persona(self.persona))
 
+    @mock.patch(scoring.logging.__name__ + '.warning')
+    @mock.patch(scoring.carif.__name__ + '.fetch_trainings')
+    def test_error_not_cached(self, mock_carif_fetch_trainings, mock_warning):
+        """Fetch the trainings again after an error."""
+        mock_carif_fetch_trainings.side_effect = [IOError('Oops'), self._many_trainings]
+        self.persona.project.job_search_length_months = 3
+
+        self.assertEqual(0, self._score_persona(self.persona))
+        mock_warning.assert_called_once()
+
+        self.assertEqual(3, self._score_persona(self.persona))
+        self.assertEqual(2, mock_carif_fetch_trainings.call_count)
+
 
 class ConstantScoreModelTestCase(ScoringModelTestBase('constant(2)')):
     """Unit test for the constant scoring model."""
@@ -210,10 +224,10 @@ class ConstantScoreModelTestCase(ScoringModelTestBase('constant(2)')):
 class PersonasTestCase(unittest.TestCase):
     """Tests all scoring models and all personas."""
 
-    @mock.patch(scoring.carif.__name__ + '.get_trainings')
-    def test_run_all(self, mock_carif_get_trainings):
+    @mock.patch(scoring.carif.__name__ + '.fetch_trainings')
+    def test_run_all(self, mock_carif_fetch_trainings):
         """Run all scoring models on all personas."""
-        mock_carif_get_trainings.return_value = [
+        mock_carif_fetch_trainings.return_value = [
             training_pb2.Training(),
             training_pb2.Training(),
             training_pb2.Training(),
@@ -268,6 +282,60 @@ class PersonasTestCase(unittest.TestCase):
         self.assertFalse(models_with_same_score, msg='Some models always have the same scores')
 
 
+class PrefetchTestCase(unittest.TestCase):
+    """Unit tests for the prefetch of market data."""
+
+    def setUp(self):
+        super(PrefetchTestCase, self).setUp()
+        self.database = mongomock.MongoClient().test
+        scoring.clear_cache()
+        self.database.job_group_info.insert_many([
+            {'_id': 'A1234', 'inDomain': 'dans la banque'},
+            {'_id': 'B5678', 'inDomain': 'dans la boulangerie'},
+        ])
+        self.database.local_diagnosis.insert_one(
+            {'_id': '75:A1234', 'imt': {'yearlyAvgOffersDenominator': 10}})
+
+    def _scoring_project(self, rome_id, departement_id):
+        project = project_pb2.Project()
+        project.target_job.job_group.rome_id = rome_id
+        project.mobility.city.departement_id = departement_id
+        return scoring.ScoringProject(
+            project, user_pb2.UserProfile(), user_pb2.Features(), self.database)
+
+    def test_prefetch(self):
+        """Prefetch market data for many projects at once."""
+        projects = [
+            self._scoring_project('A1234', '75'),
+            self._scoring_project('B5678', '75'),
+            self._scoring_project('A1234', '69'),
+        ]
+
+        scoring.prefetch(projects)
+
+        # Drop the data from the DB to make sure it is not fetched anymore.
+        self.database.job_group_info.drop()
+        self.database.local_diagnosis.drop()
+
+        self.assertEqual(
+            ['dans la banque', 'dans la boulangerie', 'dans la banque'],
+            [p.job_group_info().in_domain for p in projects])
+        self.assertEqual(
+            [10, 0, 0],
+            [p.local_diagnosis().imt.yearly_avg_offers_denominator for p in projects])
+
+    def test_no_prefetch(self):
+        """Market data is fetched lazily, and only once, if it was not prefetched."""
+        project = self._scoring_project('A1234', '75')
+
+        self.assertEqual({'_id': 'A1234', 'inDomain': 'dans la banque'}, project.get_document(
+            'job_group_info', 'A1234'))
+        self.assertIsNone(project.get_document('job_group_info', 'C0000'))
+
+        self.database.job_group_info.insert_one({'_id': 'C0000', 'inDomain': 'dans le vide'})
+        self.assertIsNone(project.get_document('job_group_info', 'C0000'))
+
+
 class LifeBalanceTestCase(ScoringModelTestBase('advice-life-balance')):
     """Unit tests for the "Work/Life balance" advice."""
 
@@ -11,7 +11,6 @@ from urllib import parse
 from bson import objectid
 import mock
 import mongomock
-import requests
 
 from bob_emploi.frontend import now
 from bob_emploi.frontend import server
@@ -96,7 +95,7 @@ class OtherEndpointTestCase(base_test.ServerTestCase):
         }
         return self.create_user_with_token(data=user_data, email='foo@bar.fr')
 
-    @mock.patch(requests.__name__ + '.post')
+    @mock.patch(server.http_client.__name__ + '.post')
     def test_feedback(self, mock_post):
         """Basic call to "/api/feedback"."""
         server._SLACK_FEEDBACK_URL = 'https://slack.example.com/url'
@@ -128,7 +127,7 @@ class OtherEndpointTestCase(base_test.ServerTestCase):
         self.assertIn('\n> Aaaaaaaaaaaaawesome!\n> second line', text)
         self.assertIn(feedback_id, text, msg='Show the MongoDB ID of the feedback in slack')
 
-    @mock.patch(requests.__name__ + '.post')
+    @mock.patch(server.http_client.__name__ + '.post')
     def test_feedback_no_user(self, mock_post):
         """Testing /api/feedback with missing user ID."""
         server._SLACK_FEEDBACK_URL = 'https://slack.example.com/url'
@@ -160,7 +159,7 @@ class OtherEndpointTestCase(base_test.ServerTestCase):
             headers={'Authorization': 'Bearer ' + auth_token})
         self.assertEqual(403, response.status_code)
 
-    @mock.patch(requests.__name__ + '.post')
+    @mock.patch(server.http_client.__name__ + '.post')
     def test_feedback_missing_project(self, mock_post):
         """Testing /api/feedback with missing project ID but correct user ID."""
         server._SLACK_FEEDBACK_URL = 'https://slack.example.com/url'
@@ -216,6 +215,62 @@ class OtherEndpointTestCase(base_test.ServerTestCase):
             },
             self.json_from_response(response))
 
+    @mock.patch(now.__name__ + '.get')
+    def test_usage_stats_cached(self, mock_now):
+        """Compute the usage stats only once in a while."""
+        self._db.user.insert_one({'registeredAt': '2017-06-10T11:00:00Z'})
+        mock_now.return_value = datetime.datetime(
+            2017, 6, 10, 12, 30, tzinfo=datetime.timezone.utc)
+        self.assertEqual(
+            {'totalUserCount': 1, 'weeklyNewUserCount': 1},
+            self.json_from_response(self.app.get('/api/usage/stats')))
+
+        self._db.user.insert_one({'registeredAt': '2017-06-10T12:00:00Z'})
+        mock_now.return_value += datetime.timedelta(seconds=30)
+        self.assertEqual(
+            {'totalUserCount': 1, 'weeklyNewUserCount': 1},
+            self.json_from_response(self.app.get('/api/usage/stats')))
+
+        # Other servers use the stats stored in MongoDB.
+        server._USAGE_STATS[0] = None  # pylint: disable=protected-access
+        self.assertEqual(
+            {'totalUserCount': 1, 'weeklyNewUserCount': 1},
+            self.json_from_response(self.app.get('/api/usage/stats')))
+
+        mock_now.return_value += datetime.timedelta(minutes=15)
+        self.assertEqual(
+            {'totalUserCount': 2, 'weeklyNewUserCount': 2},
+            self.json_from_response(self.app.get('/api/usage/stats')))
+
+    @mock.patch(now.__name__ + '.get')
+    def test_usage_stats_refreshed_once(self, mock_now):
+        """Only one server refreshes the stored usage stats when they are outdated."""
+        self._db.user.insert_one({'registeredAt': '2017-06-10T11:00:00Z'})
+        self._db.usage_stats.insert_one({
+            '_id': 'latest',
+            'computedAt': datetime.datetime(2017, 6, 10, 12),
+            'stats': {'totalUserCount': 42},
+        })
+        mock_now.return_value = datetime.datetime(
+            2017, 6, 10, 12, 30, tzinfo=datetime.timezone.utc)
+        real_find_one = self._db.usage_stats.find_one
+
+        def _find_one_then_refresh(*args, **kwargs):
+            stored_stats = real_find_one(*args, **kwargs)
+            # Another server starts refreshing the stats in between.
+            self._db.usage_stats.update_one(
+                {'_id': 'latest'}, {'$set': {'computedAt': datetime.datetime(2017, 6, 10, 12, 29)}})
+            return stored_stats
+
+        with mock.patch.object(
+                self._db.usage_stats, 'find_one', side_effect=_find_one_then_refresh), \
+                mock.patch(server.__name__ + '._compute_usage_stats') as mock_compute:
+            self.assertEqual(
+                {'totalUserCount': 42},
+                self.json_from_response(self.app.get('/api/usage/stats')))
+
+        self.assertFalse(mock_compute.called)
+
     def test_redirect_eterritoire(self):
         """Check the /api/redirect/eterritoire endpoint."""
         self._db.eterritoire_links.insert_one({
@@ -257,6 +312,106 @@ class OtherEndpointTestCase(base_test.ServerTestCase):
         advice = self.json_from_response(response)
         self.assertEqual({'advices': [{'adviceId': 'one-ring', 'numStars': 1}]}, advice)
 
+    def test_compute_advices_for_users(self):
+        """Check the /api/project/compute-advices/batch endpoint."""
+        auth._ADMIN_AUTH_TOKEN = ''
+        self._db.advice_modules.insert_one({
+            'adviceId': 'one-ring',
+            'isReadyForProd': True,
+            'triggerScoringModel': 'constant(1)',
+        })
+        response = self.app.post(
+            '/api/project/compute-advices/batch',
+            data='{"users": [{"projects": [{}]}, {"projects": [{}]}]}',
+            content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('application/x-ndjson', response.mimetype)
+        lines = sorted(
+            (json.loads(line) for line in response.get_data(as_text=True).strip().split('\n')),
+            key=lambda user_advices: user_advices.get('userIndex', 0))
+        self.assertEqual(
+            [
+                {'advices': [{'adviceId': 'one-ring', 'numStars': 1}]},
+                {'userIndex': 1, 'advices': [{'adviceId': 'one-ring', 'numStars': 1}]},
+            ],
+            lines)
+
+    def test_compute_advices_for_users_missing_project(self):
+        """Check the /api/project/compute-advices/batch endpoint without projects."""
+        auth._ADMIN_AUTH_TOKEN = ''
+        response = self.app.post(
+            '/api/project/compute-advices/batch',
+            data='{"users": [{"projects": [{}]}, {}]}', content_type='application/json')
+        self.assertEqual(422, response.status_code)
+
+
+class MetricsEndpointTestCase(base_test.ServerTestCase):
+    """Tests for the /api/metrics endpoint."""
+
+    def setUp(self):
+        super(MetricsEndpointTestCase, self).setUp()
+        # pylint: disable=protected-access
+        registry = server.metrics._Registry()
+        registry.collectors = server.metrics._REGISTRY.collectors
+        registry_patcher = mock.patch(server.metrics.__name__ + '._REGISTRY', registry)
+        registry_patcher.start()
+        self.addCleanup(registry_patcher.stop)
+        auth._ADMIN_AUTH_TOKEN = ''
+
+    def test_request_metrics(self):
+        """Export metrics about the requests."""
+        self.create_user(email='foo@bar.fr')
+        self.app.get('/api/unknown-endpoint')
+
+        response = self.app.get('/api/metrics')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/plain; version=0.0.4', response.headers['Content-Type'])
+        lines = response.get_data(as_text=True).split('\n')
+        self.assertIn(
+            'bob_http_responses_total{endpoint="/api/user",method="POST",status="200"} 1', lines)
+        self.assertIn(
+            'bob_http_responses_total{endpoint="unknown",method="GET",status="404"} 1', lines)
+        self.assertIn(
+            'bob_http_request_duration_seconds_count{endpoint="/api/user",method="POST"} 1',
+            lines)
+        self.assertIn(
+            'bob_http_request_segment_duration_seconds_count'
+            '{endpoint="/api/user",segment="Save user"} 1', lines)
+        # Only the request exporting the metrics is in flight.
+        self.assertIn('bob_http_requests_in_flight 1', lines)
+        cache_metric = 'bob_cache_misses_total{cache="job_group_info"} '
+        self.assertTrue(any(line.startswith(cache_metric) for line in lines), lines)
+
+    def test_scoring_model_metrics(self):
+        """Export metrics about the scoring models."""
+        self._db.advice_modules.insert_one({
+            'adviceId': 'one-ring',
+            'isReadyForProd': True,
+            'triggerScoringModel': 'constant(1)',
+        })
+        self.app.post(
+            '/api/project/compute-advices',
+            data='{"projects": [{}]}', content_type='application/json')
+
+        response = self.app.get('/api/metrics')
+
+        lines = response.get_data(as_text=True).split('\n')
+        model_metric = 'bob_scoring_model_calls_total{model="constant(1)"} '
+        self.assertTrue(any(line.startswith(model_metric) for line in lines), lines)
+        self.assertIn(
+            'bob_http_request_segment_duration_seconds_count'
+            '{endpoint="/api/project/compute-advices",segment="Model constant(1)"} 2', lines)
+
+    def test_metrics_missing_auth(self):
+        """Only admins can get the metrics."""
+        auth._ADMIN_AUTH_TOKEN = 'cryptic-admin-auth-token-123'
+        self.addCleanup(setattr, auth, '_ADMIN_AUTH_TOKEN', '')
+
+        response = self.app.get('/api/metrics')
+
+        self.assertEqual(401, response.status_code)
+
 
 class NPSSurveyEndpointTestCase(base_test.ServerTestCase):
     """Tests for the /api/user/nps-survey-response endpoint."""
@@ -394,6 +549,30 @@ class UserEndpointTestCase(base_test.ServerTestCase):
         self.assertGreaterEqual(user_info['requestedByUserAtDate'], before.isoformat())
         self.assertEqual(user_info['requestedByUserAtDate'][:16], later.isoformat()[:16])
 
+    @mock.patch(now.__name__ + '.get')
+    def test_app_use_only_modified_fields(self, mock_now):
+        """The app/use endpoint reads the user once and only writes the fields that changed."""
+        mock_now.side_effect = datetime.datetime.now
+        user_id, auth_token = self.create_user_with_token()
+
+        mock_now.side_effect = None
+        mock_now.return_value = datetime.datetime.now() + datetime.timedelta(hours=25)
+
+        with mock.patch.object(self._db.user, 'find_one', wraps=self._db.user.find_one) \
+                as mock_find_one, \
+                mock.patch.object(self._db.user, 'update_one', wraps=self._db.user.update_one) \
+                as mock_update_one:
+            response = self.app.post(
+                '/api/app/use/{}'.format(user_id),
+                headers={'Authorization': 'Bearer ' + auth_token})
+        self.assertEqual(200, response.status_code, response.get_data(as_text=True))
+
+        mock_find_one.assert_called_once()
+        mock_update_one.assert_called_once()
+        update = mock_update_one.call_args[0][1]
+        self.assertEqual({'$set'}, set(update))
+        self.assertEqual({'requestedByUserAtDate', 'revision'}, set(update['$set']))
+
     def test_delete_user(self):
         """Test deleting a user and all their data."""
         user_info = {'profile': {'city': {'name': 'foobar'}}, 'projects': [{}]}
@@ -444,6 +623,7 @@ class UserEndpointTestCase(base_test.ServerTestCase):
         user_info.pop('projects')
         user_info2.pop('featuresEnabled')
         user_info2.pop('revision')
+        user_info2.pop('schemaVersion')
         self.assertEqual(user_info, user_info2)
 
         self.assertEqual(1, len(projects), projects)
@@ -455,6 +635,86 @@ class UserEndpointTestCase(base_test.ServerTestCase):
         self.assertGreater(
             job_search_started_at, datetime.datetime.now() - datetime.timedelta(days=200))
 
+    def test_get_user_not_modified(self):
+        """Do not send the user again if the client already has it."""
+        user_id, auth_token = self.create_user_with_token(data={'profile': {'name': 'Pascal'}})
+        headers = {'Authorization': 'Bearer ' + auth_token}
+        response = self.app.get('/api/user/' + user_id, headers=headers)
+        etag = response.headers.get('ETag')
+        self.assertTrue(etag)
+
+        with mock.patch(server.__name__ + '._load_user_data') as mock_load_user_data:
+            response = self.app.get(
+                '/api/user/' + user_id, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(304, response.status_code)
+        self.assertFalse(response.get_data())
+        self.assertEqual(etag, response.headers.get('ETag'))
+        mock_load_user_data.assert_not_called()
+
+        # Modify the user.
+        user_info = self.get_user_info(user_id, auth_token)
+        user_info['profile']['name'] = 'Cyrille'
+        self.app.post(
+            '/api/user', data=json.dumps(user_info), content_type='application/json',
+            headers=headers)
+
+        response = self.app.get(
+            '/api/user/' + user_id, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('Cyrille', self.json_from_response(response)['profile']['name'])
+        self.assertNotEqual(etag, response.headers.get('ETag'))
+
+    def test_get_user_modified_outside_saves(self):
+        """Send the user again if it was modified by another endpoint."""
+        user_id, auth_token = self.create_user_with_token(data={'profile': {'name': 'Pascal'}})
+        headers = {'Authorization': 'Bearer ' + auth_token}
+        etag = self.app.get('/api/user/' + user_id, headers=headers).headers.get('ETag')
+
+        self.app.post(
+            '/api/user/likes', data=json.dumps({'userId': user_id, 'likes': {'advisor': 1}}),
+            content_type='application/json', headers=headers)
+
+        response = self.app.get(
+            '/api/user/' + user_id, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'advisor': 1}, self.json_from_response(response)['likes'])
+        self.assertNotEqual(etag, response.headers.get('ETag'))
+
+    def test_get_user_not_modified_unauthorized(self):
+        """Check the authorization before answering that the user is not modified."""
+        user_id, auth_token = self.create_user_with_token()
+        etag = self.app.get(
+            '/api/user/' + user_id,
+            headers={'Authorization': 'Bearer ' + auth_token}).headers.get('ETag')
+
+        response = self.app.get('/api/user/' + user_id, headers={'If-None-Match': etag})
+
+        self.assertEqual(401, response.status_code)
+
+    def test_get_user_with_old_schema(self):
+        """Migrate a user with an old schema and save it."""
+        user_id, auth_token = self.create_user_with_token(
+            data={'projects': [{'kind': 'FIND_A_NEW_JOB'}]})
+        self._db.user.update_one({'_id': mongomock.ObjectId(user_id)}, {
+            '$set': {
+                'profile.situation': 'LOST_QUIT',
+                'projects.0.kind': 'FIND_JOB',
+                'projects.0.oldUnknownField': 3,
+            },
+            '$unset': {'schemaVersion': ''},
+        })
+
+        user_info = self.get_user_info(user_id, auth_token)
+
+        self.assertEqual('FIND_A_NEW_JOB', user_info['projects'][0]['kind'])
+        self.assertNotIn('situation', user_info['profile'])
+        stored_user_info = self.user_info_from_db(user_id)
+        self.assertEqual(server.migration.CURRENT_VERSION, stored_user_info['schemaVersion'])
+        self.assertEqual('FIND_A_NEW_JOB', stored_user_info['projects'][0]['kind'])
+        self.assertNotIn('situation', stored_user_info['profile'])
+        # Fields that are not touched by the migrations are kept as is.
+        self.assertEqual(3, stored_user_info['projects'][0]['oldUnknownField'])
+
     def test_get_user_unauthorized(self):
         """When calling get user with unauthorized_token, endpoint should return error."""
         user_info = {'profile': {'gender': 'FEMININE'}, 'projects': [{
@@ -495,11 +755,11 @@ class UserEndpointTestCase(base_test.ServerTestCase):
         self.assertEqual(
             {
                 'featuresEnabled': {},
-                'profile': {
-                    'city': {'name': 'fobar'},
-                    'email': 'foo@bar.fr',
-                },
-                'revision': 1,
+                # The old city field has been migrated.
+                'profile': {'email': 'foo@bar.fr'},
+                # Saved once on authentication, then once here.
+                'revision': 2,
+                'schemaVersion': server.migration.CURRENT_VERSION,
                 'userId': user_id,
             },
             user_info)
@@ -524,11 +784,9 @@ class UserEndpointTestCase(base_test.ServerTestCase):
         self.assertEqual(
             {
                 'featuresEnabled': {},
-                'profile': {
-                    'city': {'name': 'fobar'},
-                    'email': 'foo@bar.fr',
-                },
-                'revision': 1,
+                'profile': {'email': 'foo@bar.fr'},
+                'revision': 2,
+                'schemaVersion': server.migration.CURRENT_VERSION,
                 'userId': user_id,
             },
             stored_user_info)
@@ -764,6 +1022,127 @@ class UserEndpointTestCase(base_test.ServerTestCase):
         user_in_db = self.user_info_from_db(user_id)
         self.assertEqual('very different', user_in_db['profile']['name'])
 
+    def test_update_advises_with_stored_features(self):
+        """Advising on a saved user uses its stored features, not the ones sent by the client."""
+        user_id, auth_token = self.create_user_with_token(
+            data={'profile': {'name': 'Pascal'}}, email='foo@bar.fr')
+        self._db.user.update_one(
+            {'_id': mongomock.ObjectId(user_id)},
+            {'$set': {'featuresEnabled.advisor': 'CONTROL'}})
+        user_info = self.get_user_info(user_id, auth_token)
+        user_info['featuresEnabled']['advisor'] = 'ACTIVE'
+        user_info['registeredAt'] = '2010-01-01T00:00:00Z'
+        user_info['projects'] = [{
+            'targetJob': {'jobGroup': {'romeId': 'A1234'}},
+            'mobility': {'city': {'cityId': '31555'}},
+        }]
+
+        with mock.patch(server.advisor.__name__ + '.compute_advices_for_project') \
+                as mock_compute_advices:
+            response = self.app.post(
+                '/api/user', data=json.dumps(user_info), content_type='application/json',
+                headers={'Authorization': 'Bearer ' + auth_token})
+        user_info = self.json_from_response(response)
+
+        self.assertFalse(mock_compute_advices.called)
+        self.assertEqual('CONTROL', user_info['featuresEnabled']['advisor'])
+        self.assertNotEqual('2010-01-01T00:00:00Z', user_info['registeredAt'])
+        user_in_db = self.user_info_from_db(user_id)
+        self.assertEqual('CONTROL', user_in_db['featuresEnabled']['advisor'])
+        self.assertEqual(user_info['registeredAt'], user_in_db['registeredAt'])
+
+    def test_update_keeps_emails_sent(self):
+        """Saving an outdated user does not overwrite the emails sent in between."""
+        user_id, auth_token = self.create_user_with_token(
+            data={'profile': {'name': 'Pascal'}}, email='foo@bar.fr')
+        user_info = self.get_user_info(user_id, auth_token)
+        user_info['profile']['name'] = 'very different'
+        self._db.user.update_one(
+            {'_id': mongomock.ObjectId(user_id)},
+            {'$push': {'emailsSent': {'campaignId': 'focus-network'}}})
+
+        with mock.patch.object(self._db.user, 'update_one', wraps=self._db.user.update_one) \
+                as mock_update_one:
+            response = self.app.post(
+                '/api/user', data=json.dumps(user_info), content_type='application/json',
+                headers={'Authorization': 'Bearer ' + auth_token})
+        user_info = self.json_from_response(response)
+
+        self.assertEqual([{'campaignId': 'focus-network'}], user_info.get('emailsSent'))
+        update = mock_update_one.call_args[0][1]
+        self.assertEqual({'$set'}, set(update))
+        self.assertEqual({'profile.name', 'revision'}, set(update['$set']))
+        user_in_db = self.user_info_from_db(user_id)
+        self.assertEqual('very different', user_in_db['profile']['name'])
+        self.assertEqual([{'campaignId': 'focus-network'}], user_in_db.get('emailsSent'))
+
+    def test_update_cannot_change_email(self):
+        """Updating a user checks that its credentials did not change."""
+        user_id, auth_token = self.create_user_with_token(
+            data={'profile': {'name': 'Pascal'}}, email='foo@bar.fr')
+        user_info = self.get_user_info(user_id, auth_token)
+        user_info['profile']['email'] = 'other@bar.fr'
+
+        response = self.app.post(
+            '/api/user', data=json.dumps(user_info), content_type='application/json',
+            headers={'Authorization': 'Bearer ' + auth_token})
+
+        self.assertEqual(403, response.status_code)
+        self.assertEqual('foo@bar.fr', self.user_info_from_db(user_id)['profile']['email'])
+
+    def test_update_only_modified_fields(self):
+        """Updating a user only writes the fields that changed."""
+        user_id, auth_token = self.create_user_with_token(
+            data={'profile': {'name': 'Pascal'}}, email='foo@bar.fr')
+        user_info = self.get_user_info(user_id, auth_token)
+        user_info['profile']['name'] = 'very different'
+
+        with mock.patch.object(self._db.user, 'update_one', wraps=self._db.user.update_one) \
+                as mock_update_one, \
+                mock.patch.object(self._db.user, 'replace_one') as mock_replace_one:
+            response = self.app.post(
+                '/api/user', data=json.dumps(user_info), content_type='application/json',
+                headers={'Authorization': 'Bearer ' + auth_token})
+        self.assertEqual(200, response.status_code, response.get_data(as_text=True))
+
+        self.assertFalse(mock_replace_one.called)
+        mock_update_one.assert_called_once()
+        update = mock_update_one.call_args[0][1]
+        self.assertEqual({'$set'}, set(update))
+        self.assertEqual({'profile.name', 'revision'}, set(update['$set']))
+        self.assertEqual('very different', self.user_info_from_db(user_id)['profile']['name'])
+
+    @mock.patch(server.__name__ + '._give_feedback')
+    def test_update_concurrently(self, mock_give_feedback):
+        """Do not overwrite a user that was saved in between and return the new version."""
+        user_id, auth_token = self.create_user_with_token(
+            data={'profile': {'name': 'Pascal'}, 'projects': [{}]}, email='foo@bar.fr')
+        user_info = self.get_user_info(user_id, auth_token)
+        user_info['profile']['name'] = 'my name'
+        user_info['projects'][0]['feedback'] = {'text': 'Great'}
+
+        real_migrate_user = server.migration.migrate_user
+
+        def _save_concurrently(user_data):
+            self._db.user.update_one(
+                {'_id': mongomock.ObjectId(user_id)},
+                {'$set': {'profile.name': 'concurrent name', 'revision': 42}})
+            return real_migrate_user(user_data)
+
+        with mock.patch(server.migration.__name__ + '.migrate_user', _save_concurrently), \
+                mock.patch(server.__name__ + '.logging.warning') as mock_warning:
+            response = self.app.post(
+                '/api/user', data=json.dumps(user_info), content_type='application/json',
+                headers={'Authorization': 'Bearer ' + auth_token})
+
+        user_info = self.json_from_response(response)
+        self.assertEqual('concurrent name', user_info['profile']['name'])
+        self.assertEqual(42, user_info['revision'])
+        self.assertEqual('concurrent name', self.user_info_from_db(user_id)['profile']['name'])
+        mock_warning.assert_called_once()
+        # The feedback was not saved, so nobody is notified.
+        self.assertFalse(mock_give_feedback.called)
+
     def test_update_revision(self):
         """Updating a user to an old revision does not work and return the new version."""
         user_id, auth_token = self.create_user_with_token(email='foo@bar.fr')
@@ -170,6 +170,13 @@ class PopulateProjectTemplateTest(unittest.TestCase):
             'Je suis %jobName à 5% depuis %experienceDuration.')
         self.assertEqual('Je suis steward à 5% depuis plus de 6 ans.', sentence)
 
+    def test_unknown_experience_duration(self):
+        """Present the situation of a jobseeker who did not give their seniority."""
+        self.project.target_job.masculine_name = 'Steward'
+
+        sentence = self._populate_template('Je suis %jobName depuis %experienceDuration.')
+        self.assertEqual('Je suis steward depuis .', sentence)
+
     @mock.patch(scoring.logging.__name__ + '.warning')
     def test_missing_variables(self, mock_warning):
         """ Template still has some variable not replaced."""
@@ -207,6 +214,22 @@ class PopulateProjectTemplateTest(unittest.TestCase):
         sentence = self._populate_template('Contactez vos connaissances qui travaillent %inDomain')
         self.assertEqual('Contactez vos connaissances qui travaillent en boulangerie', sentence)
 
+    def test_compute_vars_once(self):
+        """Compute the template variables only once per project."""
+        self.database.job_group_info.insert_one({'_id': 'Z9007', 'inDomain': 'en boulangerie'})
+
+        with mock.patch.object(
+                self.scoring_project, 'job_group_info',
+                wraps=self.scoring_project.job_group_info) as mock_job_group_info:
+            self.assertEqual('Lyon', self._populate_template('%cityName'))
+            mock_job_group_info.assert_not_called()
+            self.assertEqual(
+                'Vos connaissances en boulangerie à Lyon',
+                self._populate_template('Vos connaissances %inDomain %inCity'))
+            self.assertEqual(
+                'Travaillez en boulangerie', self._populate_template('Travaillez %inDomain'))
+            self.assertEqual(1, mock_job_group_info.call_count)
+
 
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover